@@ -1,61 +1,89 @@
+import logging
 import uuid
 
 import chainlit as cl
-from langfuse import Langfuse, observe
-from langfuse.openai import AsyncOpenAI
+from langfuse import observe
 
-from lib.rag import RAG
+from lib.admission import AdmissionRejected, admission_session
+from lib.logs import configure_logging
+from lib.service import get_rag, get_sessions
+from lib.tracing import trace_route
 
-rag = RAG()
+configure_logging()
+logger = logging.getLogger("app")
 
-client = AsyncOpenAI()
+# Connects nothing yet, see `warm_up`
+rag = get_rag()
 
-langfuse = Langfuse(blocked_instrumentation_scopes=["chainlit"])
+# Share the RAG's Langfuse client and its connection pool
+langfuse = rag.langfuse
 
-client_settings = {
-    "model": "gpt-4o",
-    "temperature": 0.3,
-}
+# Trace updates and feedback scores are queued and sent in batches
+tracing = rag.tracing
+
+# History and feedback actions, shared by every worker with an external store
+sessions = get_sessions()
+
+
+@cl.on_app_startup
+async def warm_up():
+    # Only runs under `chainlit run`; main.py does this in its lifespan
+    rag.start()
+
+
+@cl.on_app_shutdown
+async def shut_down():
+    await rag.close()
+    await sessions.close()
+
+
+async def remove_feedback_actions(message_id: str):
+    # Stored serialized, the click may reach another worker than the answer
+    for stored_action in await sessions.pop_actions(message_id):
+        await cl.Action.from_dict(stored_action).remove()
+
+
+async def load_session(session_id: str) -> dict:
+    """Return the session's fields, initializing them on its first use."""
+    fields = await sessions.get_fields(session_id)
+    if not fields:
+        fields = {
+            "uuid": str(uuid.uuid4()),
+            # Get current knowledge version for this session
+            "knowledge_version": await rag.get_knowledge_version(),
+        }
+        await sessions.set_fields(session_id, **fields)
+    return fields
 
 
 @cl.action_callback("thumbs_up_button")
 async def on_thumbs_up(action):
-    langfuse.create_score(
-        trace_id=action.payload["trace_id"],
-        name="user_feedback_helpful",
-        value=1,
-        data_type="BOOLEAN",
-    )
+    # Traces that were sampled out aren't in Langfuse to be scored
+    if action.payload.get("sampled", True):
+        tracing.score(
+            action.payload["trace_id"],
+            name="user_feedback_helpful",
+            value=1,
+            data_type="BOOLEAN",
+        )
 
     # Remove both thumbs up and thumbs down actions after rating
-    trace_id = action.payload["trace_id"]
-    stored_actions = cl.user_session.get("feedback_actions", {})
-    if trace_id in stored_actions:
-        for stored_action in stored_actions[trace_id]:
-            await stored_action.remove()
-        # Clean up the stored actions for this trace
-        del stored_actions[trace_id]
-        cl.user_session.set("feedback_actions", stored_actions)
+    await remove_feedback_actions(action.payload["message_id"])
 
 
 @cl.action_callback("thumbs_down_button")
 async def on_thumbs_down(action):
-    langfuse.create_score(
-        trace_id=action.payload["trace_id"],
-        name="user_feedback_helpful",
-        value=0,
-        data_type="BOOLEAN",
-    )
+    # Traces that were sampled out aren't in Langfuse to be scored
+    if action.payload.get("sampled", True):
+        tracing.score(
+            action.payload["trace_id"],
+            name="user_feedback_helpful",
+            value=0,
+            data_type="BOOLEAN",
+        )
 
     # Remove both thumbs up and thumbs down actions after rating
-    trace_id = action.payload["trace_id"]
-    stored_actions = cl.user_session.get("feedback_actions", {})
-    if trace_id in stored_actions:
-        for stored_action in stored_actions[trace_id]:
-            await stored_action.remove()
-        # Clean up the stored actions for this trace
-        del stored_actions[trace_id]
-        cl.user_session.set("feedback_actions", stored_actions)
+    await remove_feedback_actions(action.payload["message_id"])
 
 
 @cl.set_starters
@@ -79,47 +107,55 @@ async def set_starters():
     ]
 
 
-@cl.on_chat_start
-def start_chat():
-    cl.user_session.set("uuid", str(uuid.uuid4()))
-    cl.user_session.set(
-        "message_history",
-        [],  # Initialize with an empty list
+async def reject_message(thinking_msg: cl.Message, knowledge_version, error):
+    """Tell the user to try again when their question wasn't admitted."""
+    tracing.update_trace(
+        output=error.message, tags=[knowledge_version, "rejected", error.reason]
     )
-    cl.user_session.set("feedback_actions", {})  # Initialize feedback actions storage
+    thinking_msg.content = error.message
+    await thinking_msg.update()
+
 
-    # Get current knowledge version for this session
-    knowledge_version = rag.get_knowledge_version()
-    cl.user_session.set("knowledge_version", knowledge_version)
+@cl.on_chat_start
+async def start_chat():
+    await load_session(cl.context.session.id)
 
 
 @cl.on_message
+async def on_message(message: cl.Message):
+    # Sampled at the chat rate of RAG_TRACE_SAMPLE_RATES, and questions
+    # are rate limited per session
+    with trace_route("chat"), admission_session(cl.context.session.id):
+        await handle_message(message)
+
+
 @observe()
 async def handle_message(message: cl.Message):
     # Show thinking indicator
     thinking_msg = cl.Message(content="🤔 Thinking...")
     await thinking_msg.send()
 
+    # Session state lives in the shared store, any worker can serve the turn
+    session_id = cl.context.session.id
+    session = await load_session(session_id)
+
     # Get session-specific knowledge version
-    knowledge_version = cl.user_session.get("knowledge_version")
+    knowledge_version = session["knowledge_version"]
 
-    langfuse.update_current_trace(
+    tracing.update_trace(
         input=message.content,
-        session_id=cl.user_session.get("uuid"),
+        session_id=session["uuid"],
         tags=[knowledge_version],
     )
 
     # get current trace id
     trace_id = langfuse.get_current_trace_id()
+    sampled = tracing.current_trace_sampled()
 
     # Get message history before calling RAG
-    message_history = cl.user_session.get("message_history", [])
-
-    # Ensure message_history is always a list
-    if not isinstance(message_history, list):
-        message_history = []
+    message_history = await sessions.history(session_id)
 
-    print(f"🔍 [DEBUG] Current message history length: {len(message_history)}")
+    logger.debug("🔍 Current message history length: %d", len(message_history))
 
     # Show debug message about starting agentic RAG
     # debug_msg = cl.Message(
@@ -127,13 +163,52 @@ async def handle_message(message: cl.Message):
     # )
     # await debug_msg.send()
 
-    # Agentic RAG: Get answer using the new approach
-    answer, context_data, used_web_search = rag.generate_answer(
-        message.content, message_history
-    )
+    # Agentic RAG: stream the routing decision, the context and then the answer
+    answer_stream = rag.stream_answer(message.content, message_history)
+    try:
+        _, result = await anext(answer_stream)
+        _, context_data = await anext(answer_stream)
+    except AdmissionRejected as e:
+        await reject_message(thinking_msg, knowledge_version, e)
+        return
+    used_web_search = result == "INSUFFICIENT_BUT_RELEVANT"
+
     context_str = context_data[0]  # The first element is the context string
     db_results = context_data[1]
 
+    msg = cl.Message(content="", elements=[])
+
+    # Sending action buttons within chatbot message; the trace id is None
+    # when tracing is off, so they are looked up by message id
+    payload = {"trace_id": trace_id, "message_id": msg.id, "sampled": sampled}
+    msg.actions = [
+        cl.Action(name="thumbs_up_button", payload=payload, icon="thumbs-up"),
+        cl.Action(name="thumbs_down_button", payload=payload, icon="thumbs-down"),
+    ]
+
+    # Store actions for later removal, they are shown with this message
+    await sessions.save_actions(
+        msg.id, [{**action.to_dict(), "forId": msg.id} for action in msg.actions]
+    )
+
+    try:
+        async for _, token in answer_stream:
+            # Remove thinking indicator before sending the first token
+            if not msg.streaming:
+                await thinking_msg.remove()
+            await msg.stream_token(token)
+    except AdmissionRejected as e:
+        # Answers are admitted before their first token
+        await sessions.pop_actions(msg.id)
+        await reject_message(thinking_msg, knowledge_version, e)
+        return
+
+    # An empty answer never streamed a token
+    if not msg.streaming:
+        await thinking_msg.remove()
+
+    answer = msg.content
+
     # Update debug message with decision
     # if used_web_search:
     #     debug_msg.content = "🔄 **[DEBUG]** Enhanced Agentic RAG Decision: **WEB SEARCH** 🌐\n\n✅ Process completed:\n1. 📚 Retrieved context from local knowledge base\n2. 🤔 Evaluated: Context insufficient BUT topic relevant\n3. 🌐 Using web search for current information"
@@ -146,7 +221,7 @@ async def handle_message(message: cl.Message):
     #         debug_msg.content = "🔄 **[DEBUG]** Enhanced Agentic RAG Decision: **LOCAL RAG** ✅\n\n✅ Process completed:\n1. 📚 Retrieved context from local knowledge base\n2. 🤔 Evaluated: Context sufficient for this topic\n3. 📖 Using local knowledge base"
     #     await debug_msg.update()
 
-    langfuse.update_current_trace(
+    tracing.update_trace(
         metadata={"context": context_str, "used_web_search": used_web_search}
     )
 
@@ -154,95 +229,37 @@ async def handle_message(message: cl.Message):
     if used_web_search:
         sources = "**Information retrieved from web search** 🌐\n *This answer was generated using current web search results as the local knowledge base didn't contain sufficient information for this Molecule/DeSci-related question.*\n\n\n"
         # Add a note about web search being used
-        langfuse.update_current_trace(tags=[knowledge_version, "web-search-used"])
+        tracing.update_trace(tags=[knowledge_version, "web-search-used"])
     else:
         # Check if this was a disclaimer case
         if "outside" in answer.lower() and "expertise" in answer.lower():
             sources = "**Information from local knowledge base (with disclaimer)** ⚠️\n *This question appears to be outside the primary scope of Molecule and DeSci topics. The response is based on limited available information.*\n\n"
-            for _, row in db_results.iterrows():
-                sources += f"**{row['metadata']['page_title']}** \n {row['metadata']['url']} \n *Source: {row['metadata']['source']}*\n\n\n"
-            langfuse.update_current_trace(
-                tags=[knowledge_version, "out-of-scope-disclaimer"]
-            )
+            for document in db_results:
+                sources += f"**{document.page_title}** \n {document.url} \n *Source: {document.source}*\n\n\n"
+            tracing.update_trace(tags=[knowledge_version, "out-of-scope-disclaimer"])
         else:
             sources = "**Information from local knowledge base** 📚\n"
-            for _, row in db_results.iterrows():
-                sources += f"**{row['metadata']['page_title']}** \n {row['metadata']['url']} \n *Source: {row['metadata']['source']}*\n\n\n"
+            for document in db_results:
+                sources += f"**{document.page_title}** \n {document.url} \n *Source: {document.source}*\n\n\n"
             # Add a note about local knowledge being used
-            langfuse.update_current_trace(
-                tags=[knowledge_version, "local-knowledge-used"]
-            )
+            tracing.update_trace(tags=[knowledge_version, "local-knowledge-used"])
 
     # Used to debug, hide for now
     # elements = [cl.Text(name="Sources", content=sources, display="inline")]
 
-    # Sending action buttons within chatbot message
-    actions = [
-        cl.Action(
-            name="thumbs_up_button",
-            payload={"trace_id": trace_id},
-            icon="thumbs-up",
-        ),
-        cl.Action(
-            name="thumbs_down_button",
-            payload={"trace_id": trace_id},
-            icon="thumbs-down",
-        ),
-    ]
-
-    # Store actions in user session for later removal
-    stored_actions = cl.user_session.get("feedback_actions", {})
-    stored_actions[trace_id] = actions
-    cl.user_session.set("feedback_actions", stored_actions)
-
-    # Remove thinking indicator before sending actual response
-    await thinking_msg.remove()
-
-    # For web search, we already have the complete answer
-    if used_web_search:
-        msg = cl.Message(content=answer, elements=[], actions=actions)
-        await msg.send()
-    else:
-        # For local RAG, use streaming as before
-        # Get prompt from Langfuse
-        langfuse_prompt = langfuse.get_prompt("Simple Q&A prompt")
-
-        # Create dynamic system prompt
-        dynamic_system_prompt = langfuse_prompt.compile(context=context_str)
-
-        # Prepare messages for API call: dynamic system prompt + history + current user message
-        api_messages = (
-            [{"role": "system", "content": dynamic_system_prompt}]
-            + message_history
-            + [{"role": "user", "content": message.content}]
-        )
-
-        msg = cl.Message(content="", elements=[], actions=actions)
-
-        stream = await client.chat.completions.create(
-            messages=api_messages,
-            stream=True,
-            langfuse_prompt=langfuse_prompt,  # capture used prompt version in trace
-            **client_settings,
-        )
-
-        async for part in stream:
-            if token := part.choices[0].delta.content or "":
-                await msg.stream_token(token)
-
     # Update message history with the user's current message and the assistant's response
     # Ensure we have valid content before adding to history
     assistant_content = msg.content if msg.content else ""
 
-    updated_history = message_history + [
+    await sessions.append_history(
+        session_id,
         {"role": "user", "content": message.content},
         {"role": "assistant", "content": assistant_content},
-    ]
+    )
 
-    print(f"🔍 [DEBUG] Updated message history length: {len(updated_history)}")
-    cl.user_session.set("message_history", updated_history)
+    logger.debug("🔍 Updated message history length: %d", len(message_history) + 2)
 
-    langfuse.update_current_trace(output=msg.content)
+    tracing.update_trace(output=msg.content)
 
-    if not used_web_search:
-        await msg.update()
+    # Ends the stream; unlike `update()` it also sends the feedback actions
+    await msg.send()
@@ -0,0 +1,431 @@
+"""End-to-end load test for `RAG.stream_answer` against a mock OpenAI/Langfuse.
+
+Starts `bench.mock_server` in a subprocess, points the OpenAI and Langfuse
+clients at it, builds a local knowledge base from the benchmark fixtures and
+runs many concurrent simulated chat sessions in one event loop, once per
+route (local / web-search / out-of-scope) and once with a mix. Reports
+sessions per second, time to first token, full answer latency and event
+loop lag per phase as JSON. Each turn is traced and scored like a chat
+message in the app; `--tracing` switches tracing between batched, direct,
+sampled and off. `--spike` starts every session with the same starter, as
+after an announcement, and `--coalesce` lets those share one answer.
+`--llm-rpm` and `--llm-queue-size` tighten admission control; turns that
+are not admitted are reported under the `rejected` route.
+
+    python -m bench.loadtest --sessions 200 --concurrency 50 --output load.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import uuid
+
+from langfuse import observe
+
+from bench.retrieval import FIXTURES, _git_commit, _read_jsonl, build_table
+from lib.admission import AdmissionRejected, admission_session
+from lib.coalescing import AnswerCoalescer
+from lib.context_budget import ContextBudget
+from lib.tracing import trace_route
+
+PHASES = {
+    "local": {"local": 1.0, "web": 0.0, "out": 0.0},
+    "web": {"local": 0.0, "web": 1.0, "out": 0.0},
+    "out": {"local": 0.0, "web": 0.0, "out": 1.0},
+    "mixed": {"local": 0.6, "web": 0.3, "out": 0.1},
+}
+
+# Evaluator verdict -> route name used in the report
+ROUTES = {
+    "SUFFICIENT": "local",
+    "INSUFFICIENT_BUT_RELEVANT": "web",
+    "INSUFFICIENT_AND_IRRELEVANT": "out",
+}
+
+# Environment of each --tracing mode
+TRACING_MODES = {
+    "on": lambda args: {},
+    "direct": lambda args: {"RAG_TRACE_BATCHING": "false"},
+    "sampled": lambda args: {
+        "RAG_TRACE_SAMPLE_RATES": f"chat={args.trace_sample_rate}"
+    },
+    "off": lambda args: {"LANGFUSE_TRACING_ENABLED": "false"},
+}
+
+
+def admission_limits(args) -> dict:
+    """Environment for the admission controller options."""
+    # 0 lifts the production limits, the mock has none
+    return {
+        "RAG_LLM_RPM": f"gpt-4o={args.llm_rpm},gpt-4o-search-preview={args.llm_rpm}",
+        "RAG_LLM_QUEUE_SIZE": str(args.llm_queue_size),
+    }
+
+
+STARTERS = [
+    "What is DeSci all about, and what does Molecule do?",
+    "What DeSci tools and Molecule products can I use to fund and advance my research?",
+    "What does it mean to tokenize my IP, and how do I start?",
+]
+
+
+def _percentiles(samples: list) -> dict:
+    if len(samples) < 2:
+        samples = samples * 2 or [0.0, 0.0]
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {
+        "p50_ms": cuts[49] * 1000,
+        "p95_ms": cuts[94] * 1000,
+        "p99_ms": cuts[98] * 1000,
+        "max_ms": max(samples) * 1000,
+    }
+
+
+def _post_json(url: str, payload: dict):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(payload).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return json.load(response)
+
+
+def start_mock_server(args):
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "bench.mock_server",
+            "--port",
+            str(args.port),
+            "--latency",
+            str(args.latency),
+            "--tokens-per-second",
+            str(args.tokens_per_second),
+            "--answer-tokens",
+            str(args.answer_tokens),
+        ]
+    )
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"{args.mock_url}/_mock/health", timeout=1)
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Mock server did not start")
+
+
+class LoopLagMonitor:
+    """Samples how late the event loop wakes up from a short sleep."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - started - self.interval))
+
+    def start(self):
+        self.samples = []
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        return self.samples
+
+
+# The trace input is set below; capturing the arguments would serialize `rag`
+@observe(capture_input=False)
+async def answer_turn(rag, question: str, history: list, session_id: str):
+    """Answer one question, traced and scored like `app.handle_message`."""
+    tracing = rag.tracing
+    started = time.perf_counter()
+    first_token = None
+    route = context_data = None
+    tokens = []
+
+    tracing.update_trace(input=question, session_id=session_id, tags=["loadtest"])
+    trace_id = rag.langfuse.get_current_trace_id()
+    sampled = tracing.current_trace_sampled()
+
+    async for kind, data in rag.stream_answer(question, history):
+        if kind == "route":
+            route = data
+        elif kind == "context":
+            context_data = data
+        else:
+            if first_token is None:
+                first_token = time.perf_counter() - started
+            tokens.append(data)
+
+    answer = "".join(tokens)
+    tracing.update_trace(
+        metadata={
+            "context": context_data[0],
+            "used_web_search": route == "INSUFFICIENT_BUT_RELEVANT",
+        }
+    )
+    tracing.update_trace(tags=["loadtest", ROUTES.get(route, route)])
+    tracing.update_trace(output=answer)
+    if sampled:
+        tracing.score(
+            trace_id, name="user_feedback_helpful", value=1, data_type="BOOLEAN"
+        )
+
+    return route, answer, first_token, time.perf_counter() - started
+
+
+async def run_session(rag, questions: list, turns: int, think_time: float):
+    """Simulate one chat session; returns per-turn measurements."""
+    history = []
+    measurements = []
+    session_id = uuid.uuid4().hex
+
+    for turn in range(turns):
+        question = questions[turn % len(questions)]
+        started = time.perf_counter()
+        try:
+            with trace_route("chat"), admission_session(session_id):
+                route, answer, first_token, latency = await answer_turn(
+                    rag, question, history, session_id
+                )
+        except AdmissionRejected:
+            # The user sees a "try again" message and the session goes on
+            measurements.append(
+                {
+                    "route": "rejected",
+                    "ttft": None,
+                    "latency": time.perf_counter() - started,
+                }
+            )
+            continue
+
+        measurements.append(
+            {
+                "route": ROUTES.get(route, route),
+                "ttft": first_token,
+                "latency": latency,
+            }
+        )
+        history += [
+            {"role": "user", "content": question},
+            {"role": "assistant", "content": answer},
+        ]
+        if think_time:
+            await asyncio.sleep(think_time)
+
+    return measurements
+
+
+async def run_phase(rag, questions: list, args) -> dict:
+    monitor = LoopLagMonitor()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(index: int):
+        async with semaphore:
+            # Start each session from a different question, or all from
+            # the first starter as when one was announced
+            offset = 0 if args.spike else index % len(questions)
+            return await run_session(
+                rag,
+                questions[offset:] + questions[:offset],
+                args.turns,
+                args.think_time,
+            )
+
+    coalesced = rag.coalescer.stats["coalesced"] if rag.coalescer else 0
+    admission = dict(rag.admission.stats)
+    speculation = dict(rag.speculation_stats)
+    monitor.start()
+    started = time.perf_counter()
+    sessions = await asyncio.gather(
+        *(one(i) for i in range(args.sessions)), return_exceptions=True
+    )
+    elapsed = time.perf_counter() - started
+    lag = await monitor.stop()
+
+    errors = [s for s in sessions if isinstance(s, BaseException)]
+    turns = [m for s in sessions if not isinstance(s, BaseException) for m in s]
+
+    by_route = {}
+    for route in sorted({m["route"] for m in turns}):
+        route_turns = [m for m in turns if m["route"] == route]
+        by_route[route] = {
+            "turns": len(route_turns),
+            "ttft": _percentiles([m["ttft"] for m in route_turns if m["ttft"]]),
+            "latency": _percentiles([m["latency"] for m in route_turns]),
+        }
+
+    return {
+        "sessions": args.sessions,
+        "errors": len(errors),
+        "error_samples": sorted({repr(e)[:200] for e in errors})[:5],
+        "sessions_per_second": (args.sessions - len(errors)) / elapsed,
+        "elapsed_s": elapsed,
+        "loop_lag": _percentiles(lag),
+        "ttft": _percentiles([m["ttft"] for m in turns if m["ttft"]]),
+        "latency": _percentiles([m["latency"] for m in turns]),
+        "coalesced": (rag.coalescer.stats["coalesced"] - coalesced)
+        if rag.coalescer
+        else 0,
+        "admission": {
+            key: value - admission[key] for key, value in rag.admission.stats.items()
+        },
+        "speculation": {
+            key: value - speculation[key]
+            for key, value in rag.speculation_stats.items()
+        },
+        "routes": by_route,
+    }
+
+
+def build_knowledge_base(path: str):
+    # Also sets the knowledge version in the `config` table
+    build_table(path, _read_jsonl(os.path.join(FIXTURES, "corpus.jsonl")))
+
+
+async def main(args):
+    questions = STARTERS + [
+        q["query"] for q in _read_jsonl(os.path.join(FIXTURES, "queries.jsonl"))
+    ]
+
+    mock = start_mock_server(args)
+    try:
+        os.environ.update(
+            OPENAI_BASE_URL=f"{args.mock_url}/v1",
+            OPENAI_API_KEY="sk-mock",
+            LANGFUSE_HOST=args.mock_url,
+            LANGFUSE_PUBLIC_KEY="pk-lf-mock",
+            LANGFUSE_SECRET_KEY="sk-lf-mock",
+            # Unused for a local table, but lancedb rejects unset options
+            DO_SPACES_ACCESS_KEY_ID="mock",
+            DO_SPACES_SECRET_ACCESS_KEY="mock",
+            **TRACING_MODES[args.tracing](args),
+            **admission_limits(args),
+        )
+
+        # Imported after the environment points the clients at the mock
+        from lib.rag import RAG
+
+        with tempfile.TemporaryDirectory() as tmp:
+            build_knowledge_base(tmp)
+            rag = RAG(
+                temperature=0.3,
+                db_uri=tmp,
+                speculative=args.speculative,
+                coalescer=AnswerCoalescer() if args.coalesce else None,
+                # No tokenizer download: token counts are estimated offline
+                context_budget=ContextBudget(model=None),
+            )
+
+            results = {}
+            for phase in args.phases:
+                _post_json(f"{args.mock_url}/_mock/config", {"routes": PHASES[phase]})
+                results[phase] = await run_phase(rag, questions, args)
+                print(
+                    f"{phase}: {results[phase]['sessions_per_second']:.1f} sessions/s",
+                    file=sys.stderr,
+                )
+            await rag.tracing.close()
+            rag.langfuse.flush()
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {
+            "sessions": args.sessions,
+            "concurrency": args.concurrency,
+            "turns": args.turns,
+            "latency": args.latency,
+            "tokens_per_second": args.tokens_per_second,
+            "answer_tokens": args.answer_tokens,
+            "speculative": args.speculative,
+            "coalesce": args.coalesce,
+            "llm_rpm": args.llm_rpm,
+            "llm_queue_size": args.llm_queue_size,
+            "spike": args.spike,
+            "tracing": args.tracing,
+            "trace_sample_rate": args.trace_sample_rate,
+        },
+        "results": results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=25)
+    parser.add_argument("--turns", type=int, default=1)
+    parser.add_argument("--think-time", type=float, default=0.0)
+    parser.add_argument("--phases", nargs="+", default=list(PHASES), choices=PHASES)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--tokens-per-second", type=float, default=60.0)
+    parser.add_argument("--answer-tokens", type=int, default=120)
+    parser.add_argument("--speculative", action="store_true")
+    parser.add_argument(
+        "--coalesce",
+        action="store_true",
+        help="Share one answer between identical first questions in flight",
+    )
+    parser.add_argument(
+        "--spike",
+        action="store_true",
+        help="Start every session with the same starter question",
+    )
+    parser.add_argument(
+        "--llm-rpm",
+        type=int,
+        default=0,
+        help="Admit this many LLM calls per minute and model (default: no limit)",
+    )
+    parser.add_argument(
+        "--llm-queue-size",
+        type=int,
+        default=100,
+        help="LLM calls that may wait for admission before new ones are rejected",
+    )
+    parser.add_argument(
+        "--tracing",
+        default="on",
+        choices=TRACING_MODES,
+        help="on: batched trace updates; direct: through the Langfuse SDK inline",
+    )
+    parser.add_argument(
+        "--trace-sample-rate",
+        type=float,
+        default=0.1,
+        help="Share of chat traces kept with --tracing sampled",
+    )
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args(argv)
+    args.mock_url = f"http://127.0.0.1:{args.port}"
+    return args
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args(sys.argv[1:])))
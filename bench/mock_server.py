@@ -0,0 +1,223 @@
+"""Local stand-in for the OpenAI and Langfuse APIs used by the load test.
+
+Serves chat completions (streaming and not, including web-search
+citations), Langfuse prompts and a sink for Langfuse trace exports, with
+configurable latency and token-streaming rates. The evaluator verdict mix
+can be changed at runtime through `POST /_mock/config`.
+
+    python -m bench.mock_server --port 8765 --latency 0.3 --tokens-per-second 60
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+PROMPTS = {
+    "Simple Q&A prompt": "Answer using only this context:\n{{context}}",
+    "Local-Or-Websearch-Eval": (
+        "Reply SUFFICIENT, INSUFFICIENT_BUT_RELEVANT or "
+        "INSUFFICIENT_AND_IRRELEVANT.\nQuestion: {{query}}\nContext: {{context}}"
+    ),
+    "Websearch-Prompt": "Search the web to answer: {{query}}",
+}
+
+VERDICTS = {
+    "local": "SUFFICIENT",
+    "web": "INSUFFICIENT_BUT_RELEVANT",
+    "out": "INSUFFICIENT_AND_IRRELEVANT",
+}
+
+config = {
+    # Seconds before the first token (or the whole response) is sent
+    "latency": 0.3,
+    "tokens_per_second": 60.0,
+    "answer_tokens": 120,
+    # Relative weights of the evaluator verdicts by route
+    "routes": {"local": 1.0, "web": 0.0, "out": 0.0},
+    # Pages the web-search model cites
+    "citation_urls": ["https://www.molecule.to/about"],
+    # Share of chat completions rejected with 429, and their retry-after
+    "rate_limited": 0.0,
+    "retry_after": 0.2,
+}
+
+app = FastAPI()
+
+
+def _answer_words(count: int) -> list:
+    return [f"word{i} " for i in range(count)]
+
+
+def _pick_verdict() -> str:
+    routes = config["routes"]
+    route = random.choices(list(routes), weights=list(routes.values()))[0]
+    return VERDICTS[route]
+
+
+def _completion(model: str, content: str, annotations=None, completion_tokens=0):
+    message = {"role": "assistant", "content": content}
+    if annotations:
+        message["annotations"] = annotations
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+        "usage": {
+            "prompt_tokens": 500,
+            "completion_tokens": completion_tokens,
+            "total_tokens": 500 + completion_tokens,
+        },
+    }
+
+
+async def _stream(model: str, words: list, include_usage: bool = False):
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    await asyncio.sleep(config["latency"])
+    for word in words:
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {"index": 0, "delta": {"content": word}, "finish_reason": None}
+            ],
+        }
+        yield f"data: {json.dumps(chunk)}\n\n"
+        await asyncio.sleep(1 / config["tokens_per_second"])
+    if include_usage:
+        usage = _completion(model, "", completion_tokens=len(words))["usage"]
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [],
+            "usage": usage,
+        }
+        yield f"data: {json.dumps(chunk)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "gpt-4o")
+
+    if random.random() < config["rate_limited"]:
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached", "type": "requests"}},
+            status_code=429,
+            headers={"retry-after": str(config["retry_after"])},
+        )
+
+    if body.get("stream"):
+        return StreamingResponse(
+            _stream(
+                model,
+                _answer_words(config["answer_tokens"]),
+                (body.get("stream_options") or {}).get("include_usage", False),
+            ),
+            media_type="text/event-stream",
+        )
+
+    # The evaluator is the only caller that caps max_tokens this low
+    if body.get("max_tokens") == 50:
+        await asyncio.sleep(config["latency"])
+        return _completion(model, _pick_verdict(), completion_tokens=3)
+
+    words = _answer_words(config["answer_tokens"])
+    await asyncio.sleep(config["latency"] + len(words) / config["tokens_per_second"])
+    content = "".join(words)
+
+    annotations = None
+    if model == "gpt-4o-search-preview":
+        annotations = [
+            {
+                "type": "url_citation",
+                "url_citation": {
+                    "url": url,
+                    "title": f"Source {i + 1}",
+                    "start_index": 0,
+                    "end_index": len(content),
+                },
+            }
+            for i, url in enumerate(config["citation_urls"])
+        ]
+
+    return _completion(model, content, annotations, len(words))
+
+
+@app.get("/api/public/v2/prompts/{name}")
+async def get_prompt(name: str):
+    if name not in PROMPTS:
+        return JSONResponse({"message": "Prompt not found"}, status_code=404)
+    return {
+        "type": "text",
+        "name": name,
+        "version": 1,
+        "prompt": PROMPTS[name],
+        "config": {},
+        "labels": ["production"],
+        "tags": [],
+    }
+
+
+@app.post("/api/public/otel/v1/traces")
+@app.post("/api/public/scores")
+async def ingest():
+    return Response(status_code=200)
+
+
+@app.post("/api/public/ingestion")
+async def ingest_batch(request: Request):
+    batch = (await request.json())["batch"]
+    return JSONResponse(
+        {
+            "successes": [{"id": event["id"], "status": 201} for event in batch],
+            "errors": [],
+        },
+        status_code=207,
+    )
+
+
+@app.get("/_mock/health")
+async def health():
+    return {"ok": True}
+
+
+@app.post("/_mock/config")
+async def update_config(request: Request):
+    config.update(await request.json())
+    return config
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=config["latency"])
+    parser.add_argument(
+        "--tokens-per-second", type=float, default=config["tokens_per_second"]
+    )
+    parser.add_argument("--answer-tokens", type=int, default=config["answer_tokens"])
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config.update(
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        answer_tokens=args.answer_tokens,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
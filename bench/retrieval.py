@@ -0,0 +1,206 @@
+"""Offline retrieval benchmark for `Retriever.get_context`.
+
+Builds a local LanceDB table from a fixture corpus with deterministic fake
+embeddings, replays a labelled query set through hybrid, vector-only and
+FTS-only search and writes latency, throughput, memory and recall@k as
+JSON. No network access is needed.
+
+    python -m bench.retrieval --output bench_retrieval.json
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import lancedb
+import numpy as np
+from lancedb.embeddings import TextEmbeddingFunction, get_registry, register
+
+from lib.context_budget import ContextBudget
+from lib.ingest import ingest
+from lib.reranking import RelevanceCutoff
+from lib.retrieval import Retriever
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+_TOKEN = re.compile(r"\w+")
+
+
+@register("bench-hash")
+class HashEmbeddings(TextEmbeddingFunction):
+    """Deterministic bag-of-words/character-trigram hashing embeddings."""
+
+    dim: int = 128
+
+    def ndims(self):
+        return self.dim
+
+    def generate_embeddings(self, texts):
+        embeddings = []
+        for text in texts:
+            vector = np.zeros(self.dim, dtype=np.float32)
+            for word in _TOKEN.findall(str(text).lower()):
+                features = [word] + [word[i : i + 3] for i in range(len(word) - 2)]
+                for feature in features:
+                    digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+                    vector[int.from_bytes(digest, "little") % self.dim] += 1.0
+            norm = np.linalg.norm(vector)
+            embeddings.append((vector / norm if norm else vector).tolist())
+        return embeddings
+
+
+def _read_jsonl(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def build_table(path: str, corpus: list):
+    """Build the `molrag` table with the ingestion pipeline used in production."""
+    db = lancedb.connect(path)
+    ingest(db, corpus, embedding=get_registry().get("bench-hash").create())
+    return db.open_table("molrag")
+
+
+def _percentiles(samples: list) -> dict:
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {
+        "p50_ms": cuts[49] * 1000,
+        "p95_ms": cuts[94] * 1000,
+        "p99_ms": cuts[98] * 1000,
+        "mean_ms": statistics.fmean(samples) * 1000,
+    }
+
+
+def _rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+
+
+async def bench_mode(retriever, queries, url_to_id, mode, args) -> dict:
+    for query in queries:
+        await retriever.get_context(query["query"], args.num_results, mode)
+
+    rss_before = _rss_mb()
+    latencies = []
+    recalls = []
+    chunks = []
+    tokens = []
+    for _ in range(args.repeat):
+        for query in queries:
+            started = time.perf_counter()
+            context, documents = await retriever.get_context(
+                query["query"], args.num_results, mode
+            )
+            latencies.append(time.perf_counter() - started)
+            chunks.append(len(documents))
+            tokens.append(retriever.context_budget.count(context))
+
+            found = {url_to_id.get(document.url) for document in documents}
+            relevant = set(query["relevant"])
+            recalls.append(len(found & relevant) / len(relevant))
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(query):
+        async with semaphore:
+            await retriever.get_context(query, args.num_results, mode)
+
+    workload = [q["query"] for q in queries] * args.repeat
+    started = time.perf_counter()
+    await asyncio.gather(*(one(query) for query in workload))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "latency": _percentiles(latencies),
+        "throughput_qps": len(workload) / elapsed,
+        "concurrency": args.concurrency,
+        f"recall_at_{args.num_results}": statistics.fmean(recalls),
+        "mean_chunks": statistics.fmean(chunks),
+        "mean_context_tokens": statistics.fmean(tokens),
+        "rss_growth_mb": _rss_mb() - rss_before,
+        "queries": len(latencies),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args):
+    corpus = _read_jsonl(args.corpus)
+    queries = _read_jsonl(args.queries)
+    url_to_id = {doc["url"]: doc["id"] for doc in corpus}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        table = build_table(args.db or tmp, corpus)
+        # No tokenizer download: token counts are estimated offline
+        retriever = Retriever(
+            table,
+            ContextBudget(model=None),
+            cutoff=RelevanceCutoff.from_env() if args.cutoff else None,
+            candidates=args.candidates,
+        )
+
+        results = {}
+        for mode in args.modes:
+            results[mode] = await bench_mode(retriever, queries, url_to_id, mode, args)
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {
+            "corpus_size": len(corpus),
+            "query_count": len(queries),
+            "num_results": args.num_results,
+            "repeat": args.repeat,
+            "cutoff": args.cutoff,
+            "candidates": args.candidates,
+        },
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "results": results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", default=os.path.join(FIXTURES, "corpus.jsonl"))
+    parser.add_argument("--queries", default=os.path.join(FIXTURES, "queries.jsonl"))
+    parser.add_argument("--db", help="Build the table here instead of a temp dir")
+    parser.add_argument("--modes", nargs="+", default=["hybrid", "vector", "fts"])
+    parser.add_argument("--num-results", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--cutoff",
+        action="store_true",
+        help="Keep only chunks close to the best one (RAG_CUTOFF_* settings)",
+    )
+    parser.add_argument(
+        "--candidates", type=int, default=24, help="Results reranked with --cutoff"
+    )
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args(sys.argv[1:])))
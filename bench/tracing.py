@@ -0,0 +1,138 @@
+"""Request latency with tracing on, sampled and off.
+
+Runs `bench.loadtest` on the mixed route phase once per tracing mode, in a
+fresh process each time so every mode starts with its own Langfuse client,
+and reports time to first token, answer latency, event loop lag and
+throughput side by side as JSON. With `--repeat`, each mode runs several
+times and the median of each number is reported.
+
+    python -m bench.tracing --sessions 200 --concurrency 50 --output tracing.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.loadtest import TRACING_MODES
+from bench.retrieval import _git_commit
+
+METRICS = ("ttft", "latency", "loop_lag")
+
+
+def run_loadtest(mode: str, args) -> dict:
+    """Run one load test in a subprocess and return its mixed phase results."""
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, "load.json")
+        subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "bench.loadtest",
+                "--phases",
+                "mixed",
+                "--tracing",
+                mode,
+                "--trace-sample-rate",
+                str(args.trace_sample_rate),
+                "--sessions",
+                str(args.sessions),
+                "--concurrency",
+                str(args.concurrency),
+                "--turns",
+                str(args.turns),
+                "--latency",
+                str(args.latency),
+                "--tokens-per-second",
+                str(args.tokens_per_second),
+                "--answer-tokens",
+                str(args.answer_tokens),
+                "--port",
+                str(args.port),
+                "--output",
+                output,
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        with open(output) as f:
+            return json.load(f)["results"]["mixed"]
+
+
+def summarize(runs: list) -> dict:
+    """Median of each reported number over repeated runs."""
+    summary = {
+        "errors": sum(run["errors"] for run in runs),
+        "sessions_per_second": statistics.median(
+            run["sessions_per_second"] for run in runs
+        ),
+    }
+    for metric in METRICS:
+        summary[metric] = {
+            key: statistics.median(run[metric][key] for run in runs)
+            for key in runs[0][metric]
+        }
+    return summary
+
+
+def main(args):
+    results = {}
+    for mode in args.modes:
+        runs = [run_loadtest(mode, args) for _ in range(args.repeat)]
+        results[mode] = summarize(runs)
+        print(
+            f"{mode}: p50 {results[mode]['latency']['p50_ms']:.0f} ms, "
+            f"p95 {results[mode]['latency']['p95_ms']:.0f} ms",
+            file=sys.stderr,
+        )
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {
+            "sessions": args.sessions,
+            "concurrency": args.concurrency,
+            "turns": args.turns,
+            "latency": args.latency,
+            "tokens_per_second": args.tokens_per_second,
+            "answer_tokens": args.answer_tokens,
+            "trace_sample_rate": args.trace_sample_rate,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        default=["off", "sampled", "on", "direct"],
+        choices=TRACING_MODES,
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--sessions", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=25)
+    parser.add_argument("--turns", type=int, default=2)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--tokens-per-second", type=float, default=60.0)
+    parser.add_argument("--answer-tokens", type=int, default=120)
+    parser.add_argument("--trace-sample-rate", type=float, default=0.1)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    main(parse_args(sys.argv[1:]))
@@ -0,0 +1,411 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from lib.metrics import Counter, Gauge, Histogram, register_collector
+
+logger = logging.getLogger(__name__)
+
+LLM_ADMISSIONS = Counter(
+    "mira_llm_admissions",
+    "LLM calls by whether they were admitted or why they were rejected",
+    ["model", "priority", "result"],
+)
+LLM_QUEUE_DEPTH = Gauge(
+    "mira_llm_queue_depth",
+    "LLM calls waiting for admission, by priority",
+    ["priority"],
+)
+SESSION_ADMISSIONS = Counter(
+    "mira_session_admissions",
+    "Questions by whether their session was within its rate limit",
+    ["result"],
+)
+LLM_QUEUE_WAIT_SECONDS = Histogram(
+    "mira_llm_queue_wait_seconds",
+    "Time LLM calls waited for admission",
+    ["model", "priority"],
+)
+
+# Lower goes first: the evaluator call is short and every answer needs one
+PRIORITIES = {"evaluation": 0, "generation": 1}
+
+# Per-minute limits allow bursts of this many seconds' worth of calls
+_BURST_SECONDS = 10
+
+# Requests per minute by model; RAG_LLM_RPM and RAG_LLM_TPM override them
+DEFAULT_LIMITS = {
+    "gpt-4o": {"rpm": 500},
+    "gpt-4o-search-preview": {"rpm": 100},
+}
+
+# Completion tokens assumed for calls without `max_tokens`
+_COMPLETION_TOKENS = 500
+
+BUSY_MESSAGE = (
+    "I'm answering a lot of questions right now. Please try again in a minute."
+)
+SESSION_MESSAGE = (
+    "You're asking questions faster than I can answer them. "
+    "Please wait a moment and try again."
+)
+
+_session = contextvars.ContextVar("admission_session", default=None)
+
+
+@contextmanager
+def admission_session(session_id: str):
+    """Count the questions asked inside the block against `session_id`, and
+    queue their LLM calls fairly with other sessions'."""
+    token = _session.set(session_id)
+    try:
+        yield
+    finally:
+        _session.reset(token)
+
+
+async def without_session(events):
+    """Yield from the async iterator `events` outside of any session.
+
+    For work shared by several sessions, such as a coalesced answer, which
+    shouldn't be queued as any one of them. Iterate it from a single task.
+    """
+    with admission_session(None):
+        async for event in events:
+            yield event
+
+
+class AdmissionRejected(Exception):
+    """An LLM call that was not admitted; `message` can be shown to the user."""
+
+    def __init__(self, reason: str, message: str = BUSY_MESSAGE):
+        super().__init__(f"LLM call rejected: {reason}")
+        self.reason = reason
+        self.message = message
+
+
+class TokenBucket:
+    """Allows `rate` units per second on average and bursts of `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float = 1.0) -> float:
+        """Seconds until `amount` units are available, 0 if they are now."""
+        self._refill(time.monotonic())
+        # A call larger than the bucket waits for a full one
+        missing = min(amount, self.capacity) - self.tokens
+        return max(missing / self.rate, 0.0)
+
+    def take(self, amount: float = 1.0):
+        self._refill(time.monotonic())
+        self.tokens -= min(amount, self.capacity)
+
+    @property
+    def full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class _ModelLimit:
+    """Request and token buckets of one model, paused after a rate limit."""
+
+    def __init__(self, rpm: float = None, tpm: float = None):
+        self.buckets = []
+        if rpm:
+            requests = TokenBucket(rpm / 60, rpm / 60 * _BURST_SECONDS)
+            self.buckets.append((requests, lambda tokens: 1.0))
+        if tpm:
+            budget = TokenBucket(tpm / 60, tpm / 60 * _BURST_SECONDS)
+            self.buckets.append((budget, lambda tokens: tokens))
+        self.resume_at = 0.0
+
+    def delay(self, tokens: int) -> float:
+        delays = [bucket.delay(cost(tokens)) for bucket, cost in self.buckets]
+        return max([self.resume_at - time.monotonic(), 0.0, *delays])
+
+    def take(self, tokens: int):
+        for bucket, cost in self.buckets:
+            bucket.take(cost(tokens))
+
+
+class _Waiter:
+    __slots__ = ("key", "model", "priority", "tokens", "tag", "future", "queued_at")
+
+    def __init__(self, key, model, priority, tokens, tag, future):
+        self.key = key
+        self.model = model
+        self.priority = priority
+        self.tokens = tokens
+        self.tag = tag
+        self.future = future
+        self.queued_at = time.monotonic()
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+
+def estimate_tokens(messages: list, max_tokens: int = None) -> int:
+    """Rough prompt plus completion tokens of a chat completion request."""
+    prompt = sum(len(message["content"]) for message in messages) // 4
+    return prompt + (max_tokens or _COMPLETION_TOKENS)
+
+
+def parse_limits(text: str) -> dict:
+    """Parse `gpt-4o=500,gpt-4o-search-preview=100` into `{model: number}`."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        model, _, value = item.partition("=")
+        limits[model.strip()] = float(value)
+    return limits
+
+
+class AdmissionController:
+    """Admits LLM calls within per-model rate limits, fairly across sessions.
+
+    Each model has token buckets for requests and, optionally, tokens per
+    minute; models without limits are admitted right away. Calls that
+    can't start yet wait in one bounded queue, ordered by priority and
+    then by start-time fair queueing over sessions: a session's calls are
+    spread out behind those of sessions that have asked less, so a burst
+    from one user doesn't hold up the others.
+
+    A call is rejected with AdmissionRejected, without waiting, when the
+    queue is full, and after waiting `max_wait` seconds. After a provider
+    rate limit, `throttle` pauses the model for the retry delay. Separately,
+    `check_session` limits each session to `session_rpm` questions per
+    minute.
+
+    Limits are kept in memory, so they hold per process; `from_env` divides
+    the model limits among `RAG_LLM_WORKERS` processes.
+    """
+
+    def __init__(
+        self,
+        limits: dict = None,
+        max_queue: int = 100,
+        max_wait: float = 30.0,
+        session_rpm: float = 30,
+        session_burst: float = 10,
+    ):
+        limits = DEFAULT_LIMITS if limits is None else limits
+        self.limits = {model: _ModelLimit(**limit) for model, limit in limits.items()}
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.session_rpm = session_rpm
+        self.session_burst = session_burst
+        self._sessions = {}
+        self._queue = []
+        self._sequence = itertools.count()
+        # Start-time fair queueing: virtual time and each session's next tag
+        self._virtual = 0
+        self._finish = {}
+        self._wakeup = None
+        self._dispatcher = None
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0}
+        register_collector(self._collect)
+
+    @classmethod
+    def from_env(cls):
+        """Build a controller configured by the RAG_LLM_* variables."""
+        rpm = parse_limits(os.getenv("RAG_LLM_RPM", ""))
+        tpm = parse_limits(os.getenv("RAG_LLM_TPM", ""))
+        limits = {model: dict(limit) for model, limit in DEFAULT_LIMITS.items()}
+        for model, value in rpm.items():
+            limits.setdefault(model, {})["rpm"] = value
+        for model, value in tpm.items():
+            limits.setdefault(model, {})["tpm"] = value
+        # Every process admits its share of the provider's limits
+        workers = int(os.getenv("RAG_LLM_WORKERS", "1"))
+        for limit in limits.values():
+            for kind in limit:
+                limit[kind] /= workers
+        return cls(
+            limits,
+            max_queue=int(os.getenv("RAG_LLM_QUEUE_SIZE", "100")),
+            max_wait=float(os.getenv("RAG_LLM_QUEUE_TIMEOUT", "30")),
+            session_rpm=float(os.getenv("RAG_LLM_SESSION_RPM", "30")),
+        )
+
+    def _collect(self):
+        depth = dict.fromkeys(PRIORITIES, 0)
+        for waiter in self._queue:
+            if not waiter.future.done():
+                depth[waiter.priority] += 1
+        for priority, count in depth.items():
+            LLM_QUEUE_DEPTH.set(count, priority=priority)
+
+    @property
+    def waiting(self) -> int:
+        return sum(not waiter.future.done() for waiter in self._queue)
+
+    def _waiting_for(self, model: str) -> bool:
+        return any(
+            waiter.model == model and not waiter.future.done() for waiter in self._queue
+        )
+
+    def _reject(self, model: str, priority: str, reason: str):
+        self.stats["rejected"] += 1
+        LLM_ADMISSIONS.inc(model=model, priority=priority, result=reason)
+        logger.warning("⚠️ Rejected %s call to %s: %s", priority, model, reason)
+        raise AdmissionRejected(reason)
+
+    def _admitted(self, model: str, priority: str, waited: float):
+        self.stats["admitted"] += 1
+        LLM_ADMISSIONS.inc(model=model, priority=priority, result="admitted")
+        LLM_QUEUE_WAIT_SECONDS.observe(waited, model=model, priority=priority)
+
+    def check_session(self):
+        """Count a question against the current session's rate limit.
+
+        Raises:
+            AdmissionRejected: The session asked more than `session_rpm`
+                questions in the last minute, beyond its burst
+        """
+        session = _session.get()
+        if session is None or not self.session_rpm:
+            return
+        bucket = self._sessions.get(session)
+        if bucket is None:
+            if len(self._sessions) >= 1024:
+                # Sessions with a full bucket are the same as new ones
+                self._sessions = {
+                    key: bucket
+                    for key, bucket in self._sessions.items()
+                    if not bucket.full
+                }
+            bucket = self._sessions[session] = TokenBucket(
+                self.session_rpm / 60, self.session_burst
+            )
+        if bucket.delay() > 0:
+            self.stats["rejected"] += 1
+            SESSION_ADMISSIONS.inc(result="session_rate")
+            logger.warning("⚠️ Rejected a question: session_rate")
+            raise AdmissionRejected("session_rate", SESSION_MESSAGE)
+        bucket.take()
+        SESSION_ADMISSIONS.inc(result="admitted")
+
+    def _tag(self, session) -> int:
+        tag = max(self._virtual, self._finish.get(session, 0))
+        self._finish[session] = tag + 1
+        if len(self._finish) > 1024:
+            self._finish = {
+                key: finish
+                for key, finish in self._finish.items()
+                if finish > self._virtual
+            }
+        return tag
+
+    async def admit(self, model: str, priority: str = "generation", tokens: int = 0):
+        """Wait until a call to `model` may start.
+
+        Args:
+            model: Model the call goes to
+            priority: "evaluation" or "generation"
+            tokens: Estimated prompt and completion tokens of the call
+
+        Raises:
+            AdmissionRejected: The queue is full or the call waited
+                `max_wait` seconds
+        """
+        limit = self.limits.get(model)
+        if limit is None:
+            self._admitted(model, priority, 0.0)
+            return
+        if not self._waiting_for(model) and limit.delay(tokens) == 0:
+            limit.take(tokens)
+            self._admitted(model, priority, 0.0)
+            return
+
+        if self.waiting >= self.max_queue:
+            self._reject(model, priority, "queue_full")
+
+        future = asyncio.get_running_loop().create_future()
+        tag = self._tag(_session.get())
+        waiter = _Waiter(
+            (PRIORITIES[priority], tag, next(self._sequence)),
+            model,
+            priority,
+            tokens,
+            tag,
+            future,
+        )
+        heapq.heappush(self._queue, waiter)
+        self.stats["queued"] += 1
+        self._start()
+        self._wakeup.set()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            if not future.done():
+                future.cancel()
+                self._reject(model, priority, "timeout")
+        except asyncio.CancelledError:
+            # The dispatcher skips waiters whose caller went away
+            future.cancel()
+            raise
+        self._admitted(model, priority, time.monotonic() - waiter.queued_at)
+
+    def throttle(self, model: str, delay: float):
+        """Hold calls to `model` for `delay` seconds after a rate limit."""
+        limit = self.limits.get(model)
+        if limit is None:
+            limit = self.limits[model] = _ModelLimit()
+        limit.resume_at = max(limit.resume_at, time.monotonic() + delay)
+        logger.warning(
+            "⏳ Rate limited by %s, holding its calls for %.1fs", model, delay
+        )
+
+    def _start(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    def _admit_ready(self) -> float:
+        """Admit every waiter whose model has room, best first.
+
+        Returns the seconds until the next waiter could be admitted.
+        """
+        blocked = {}
+        remaining = []
+        for waiter in sorted(w for w in self._queue if not w.future.done()):
+            if waiter.model in blocked:
+                remaining.append(waiter)
+                continue
+            limit = self.limits[waiter.model]
+            delay = limit.delay(waiter.tokens)
+            if delay > 0:
+                # Later calls to the same model don't overtake this one
+                blocked[waiter.model] = delay
+                remaining.append(waiter)
+                continue
+            limit.take(waiter.tokens)
+            self._virtual = max(self._virtual, waiter.tag)
+            waiter.future.set_result(None)
+        # Sorted, so still a heap
+        self._queue = remaining
+        return min(blocked.values(), default=None)
+
+    async def _dispatch(self):
+        while self._queue:
+            self._wakeup.clear()
+            delay = self._admit_ready()
+            if delay is None:
+                break
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,153 @@
+import logging
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from lib.embeddings import normalize_vector
+from lib.metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_LOOKUPS = Counter(
+    "mira_answer_cache_lookups",
+    "Answer cache lookups by whether a similar enough question was cached",
+    ["result"],
+)
+ANSWER_CACHE_EVICTIONS = Counter(
+    "mira_answer_cache_evictions",
+    "Cached answers dropped because they expired, the cache was full, or "
+    "the knowledge base changed",
+    ["reason"],
+)
+ANSWER_CACHE_SIMILARITY = Histogram(
+    "mira_answer_cache_similarity",
+    "Similarity of each question to the closest cached one",
+    buckets=(0.8, 0.85, 0.9, 0.93, 0.95, 0.96, 0.97, 0.98, 0.99, 1.0),
+)
+
+# Routes whose answers go stale faster than the knowledge base: web search
+# is used for current information
+WEB_SEARCH_ROUTES = ("INSUFFICIENT_BUT_RELEVANT",)
+
+
+class SemanticAnswerCache:
+    """LRU/TTL cache of answers to first questions, matched by query embedding.
+
+    Only questions asked without conversation history are cached, since an
+    answer to a follow-up depends on what came before it. All entries belong
+    to one knowledge version, and looking up a different version empties the
+    cache. Answers expire after `ttl` seconds, those of the routes in
+    `route_ttls` after theirs; a route with a TTL of 0 is not cached at all,
+    which is the default for web search answers.
+
+    The default `threshold` of 0.97 is a conservative guess, not a measured
+    value: it is meant to match rewordings (case, punctuation, word order)
+    only, but questions that differ in a name or a date can still score
+    above it. Choose it for the embedding model in use from the similarity
+    histogram exported at `/metrics` and the questions behind the hits.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.97,
+        max_entries: int = 512,
+        ttl: float = 3600,
+        route_ttls: dict = None,
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.route_ttls = (
+            dict.fromkeys(WEB_SEARCH_ROUTES, 0) if route_ttls is None else route_ttls
+        )
+        self.knowledge_version = None
+        self._entries = OrderedDict()
+        self._next_key = 0
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "invalidations": 0,
+        }
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def invalidate(self):
+        """Drop every entry, e.g. after the knowledge base changed."""
+        ANSWER_CACHE_EVICTIONS.inc(len(self._entries), reason="invalidated")
+        self._entries.clear()
+        self.stats["invalidations"] += 1
+
+    def _check_version(self, knowledge_version):
+        if knowledge_version != self.knowledge_version:
+            if self._entries:
+                self.invalidate()
+            self.knowledge_version = knowledge_version
+
+    def lookup(self, query_vector, knowledge_version):
+        """Find the stored answer to the most similar earlier question.
+
+        Args:
+            query_vector: Embedding of the incoming question
+            knowledge_version: Knowledge version the answer must come from
+
+        Returns:
+            dict | None: The cached entry ("answer", "context_data", "route")
+                if one is at least `threshold` similar, else None
+        """
+        self._check_version(knowledge_version)
+
+        now = time.monotonic()
+        for key in [k for k, e in self._entries.items() if now > e["expires_at"]]:
+            del self._entries[key]
+            self.stats["evictions"] += 1
+            ANSWER_CACHE_EVICTIONS.inc(reason="expired")
+
+        best_key, best_score = None, self.threshold
+        if self._entries:
+            query_vector = normalize_vector(query_vector)
+            keys = list(self._entries)
+            scores = np.stack([self._entries[k]["vector"] for k in keys]) @ query_vector
+            index = int(np.argmax(scores))
+            ANSWER_CACHE_SIMILARITY.observe(float(scores[index]))
+            if scores[index] >= best_score:
+                best_key, best_score = keys[index], float(scores[index])
+
+        if best_key is None:
+            self.stats["misses"] += 1
+            ANSWER_CACHE_LOOKUPS.inc(result="miss")
+            return None
+
+        self.stats["hits"] += 1
+        ANSWER_CACHE_LOOKUPS.inc(result="hit")
+        self._entries.move_to_end(best_key)
+        logger.debug("💾 Answer cache hit (similarity %.3f)", best_score)
+        return self._entries[best_key]
+
+    def store(self, query_vector, knowledge_version, answer, context_data, route):
+        """Remember an answer for later near-duplicate questions."""
+        ttl = self.route_ttls.get(route, self.ttl)
+        if ttl <= 0:
+            return
+        self._check_version(knowledge_version)
+
+        self._entries[self._next_key] = {
+            "vector": normalize_vector(query_vector),
+            "answer": answer,
+            "context_data": context_data,
+            "route": route,
+            "expires_at": time.monotonic() + ttl,
+        }
+        self._next_key += 1
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+            ANSWER_CACHE_EVICTIONS.inc(reason="full")
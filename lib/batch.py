@@ -0,0 +1,221 @@
+"""Batch question answering for offline evaluation runs.
+
+Reads questions as JSON lines (`query` or `question`, and an optional `id`,
+by default the line number) and writes one JSON line per question with the
+answer, route, ids of the context chunks and per-stage timings. Repeated
+questions are answered once. Rows are written as they complete, so an
+interrupted run picks up where it stopped when started again with the same
+output file; questions that failed are retried, and their error rows dropped.
+
+    python -m lib.batch questions.jsonl --output answers.jsonl
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+from lib.concurrency import AdaptiveConcurrency
+from lib.executor import run_blocking
+from lib.query import normalize_query
+
+logger = logging.getLogger(__name__)
+
+
+def read_questions(path: str) -> list:
+    """Read questions as dicts with `id` and `query`."""
+    # lib.ingest imports LanceDB, which the batch API doesn't need
+    from lib.ingest import read_documents
+
+    questions = []
+    ids = set()
+    for line_number, record in enumerate(read_documents(path), 1):
+        query = record.get("query") or record.get("question")
+        if not query:
+            raise ValueError(f"Line {line_number} has no 'query' or 'question'")
+        question = {"id": record.get("id", line_number), "query": query}
+        if question["id"] in ids:
+            raise ValueError(f"Duplicate question id {question['id']!r}")
+        ids.add(question["id"])
+        questions.append(question)
+    return questions
+
+
+def load_checkpoint(path: str) -> dict:
+    """Map the id of every question answered in an earlier run to its row.
+
+    Rows of questions that failed, and a line cut off by a killed run, are
+    dropped from the file, so once the failed questions are retried each id
+    has a single row.
+    """
+    done = {}
+    if not os.path.exists(path):
+        return done
+    stale = 0
+    with open(path) as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line of a run that was killed mid-write
+                stale += 1
+                continue
+            if "error" in row:
+                stale += 1
+            else:
+                done[row["id"]] = row
+
+    if stale:
+        # Swapped in whole, so being killed here can't lose answered rows
+        rewritten = path + ".tmp"
+        with open(rewritten, "w") as f:
+            for row in done.values():
+                append_row(f, row)
+        os.replace(rewritten, path)
+        logger.info("🧹 Dropped %d failed or partial rows from %s", stale, path)
+    return done
+
+
+def append_row(output, row: dict):
+    output.write(json.dumps(row, ensure_ascii=False) + "\n")
+    # Each row is a checkpoint
+    output.flush()
+
+
+async def run_batch(
+    rag,
+    questions: list,
+    output_path: str,
+    concurrency: int = 8,
+    batch_size: int = 32,
+    num_results: int = 8,
+    max_attempts: int = 5,
+) -> dict:
+    """Answer `questions` into `output_path`, skipping those already there.
+
+    Returns:
+        dict: Counts of questions, answered, resumed, deduplicated, failed
+            and rate limits, per-route counts and the time taken
+    """
+    if max_attempts < 1:
+        raise ValueError("max_attempts must be at least 1")
+    started = time.perf_counter()
+    done = await run_blocking(load_checkpoint, output_path)
+    answered = {normalize_query(row["query"]): row for row in done.values()}
+    stats = {
+        "questions": len(questions),
+        "answered": 0,
+        "resumed": 0,
+        "deduplicated": 0,
+        "failed": 0,
+        "rate_limited": 0,
+        "routes": {},
+    }
+
+    async def write(row):
+        await run_blocking(append_row, output, row)
+        if "error" in row:
+            stats["failed"] += 1
+            return
+        stats["answered"] += 1
+        stats["deduplicated"] += "duplicate_of" in row
+        stats["routes"][row["route"]] = stats["routes"].get(row["route"], 0) + 1
+
+    output = await run_blocking(open, output_path, "a")
+    try:
+        pending = []
+        for question in questions:
+            if question["id"] in done:
+                stats["resumed"] += 1
+            elif earlier := answered.get(normalize_query(question["query"])):
+                # Answered under another id in an earlier run
+                await write({**earlier, **question, "duplicate_of": earlier["id"]})
+            else:
+                pending.append(question)
+
+        if stats["resumed"]:
+            logger.info("⏯️ Resuming: %d questions already answered", stats["resumed"])
+
+        limiter = AdaptiveConcurrency(concurrency)
+        async for row in rag.answer_batch(
+            pending,
+            batch_size=batch_size,
+            num_results=num_results,
+            max_attempts=max_attempts,
+            limiter=limiter,
+        ):
+            await write(row)
+    finally:
+        await run_blocking(output.close)
+
+    stats["rate_limited"] = limiter.rate_limited
+    stats["seconds"] = time.perf_counter() - started
+    logger.info(
+        "📦 Batch done: %d answered, %d failed, %d resumed in %.1fs",
+        stats["answered"],
+        stats["failed"],
+        stats["resumed"],
+        stats["seconds"],
+    )
+    return stats
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("questions", help='JSON lines file, or "-" for stdin')
+    parser.add_argument(
+        "--output", required=True, help="JSON lines file, appended to on resume"
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--batch-size", type=int, default=32, help="Questions per vector search"
+    )
+    parser.add_argument("--num-results", type=int, default=8)
+    parser.add_argument(
+        "--max-attempts",
+        type=positive_int,
+        default=5,
+        help="Attempts per question when rate limited",
+    )
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--temperature", type=float, default=0.3)
+    return parser.parse_args(argv)
+
+
+def main(args):
+    from lib.logs import configure_logging
+    from lib.rag import RAG
+
+    configure_logging()
+
+    questions = read_questions(args.questions)
+    rag = RAG(model=args.model, temperature=args.temperature)
+    try:
+        stats = asyncio.run(
+            run_batch(
+                rag,
+                questions,
+                args.output,
+                concurrency=args.concurrency,
+                batch_size=args.batch_size,
+                num_results=args.num_results,
+                max_attempts=args.max_attempts,
+            )
+        )
+    finally:
+        rag.langfuse.flush()
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main(parse_args(sys.argv[1:]))
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+
+from lib.metrics import Counter, Gauge, register_collector
+
+logger = logging.getLogger(__name__)
+
+COALESCED_ANSWERS = Counter(
+    "mira_coalesced_answers",
+    "Answers by whether they started a pipeline or joined an identical "
+    "question in flight",
+    ["result"],
+)
+ANSWERS_IN_FLIGHT = Gauge(
+    "mira_answers_in_flight",
+    "Shared answer pipelines running for first questions",
+)
+
+
+class _Flight:
+    """Events of one shared answer, replayed to every subscriber."""
+
+    def __init__(self):
+        self.events = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def publish(self, event):
+        self.events.append(event)
+        self._notify()
+
+    def finish(self, error: BaseException = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self):
+        # Wake everyone waiting now; later waiters get a fresh event
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self):
+        await self._changed.wait()
+
+
+class AnswerCoalescer:
+    """Single-flight answers: identical questions in flight share one pipeline.
+
+    Requests with the same key subscribe to one answer stream, run in a
+    task of its own. Every event is kept, so a request that joins late
+    first catches up on the events it missed and then receives the rest as
+    they arrive. The pipeline is cancelled once every subscriber has gone
+    away, and an error is raised to all of them. Finished answers are not
+    kept; the answer cache is for that.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self.stats = {"started": 0, "coalesced": 0}
+        register_collector(lambda: ANSWERS_IN_FLIGHT.set(len(self._flights)))
+
+    def __contains__(self, key) -> bool:
+        return key in self._flights
+
+    async def stream(self, key, produce):
+        """Yield the events of `produce()`, shared with identical requests.
+
+        Args:
+            key: Hashable identity of the request, e.g. normalized question
+                and knowledge version
+            produce: Called without arguments to start the shared async
+                iterator when no request with `key` is in flight
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.stats["coalesced"] += 1
+            COALESCED_ANSWERS.inc(result="coalesced")
+            logger.debug(
+                "🔗 Joined an answer in flight (%d events)", len(flight.events)
+            )
+        else:
+            self.stats["started"] += 1
+            COALESCED_ANSWERS.inc(result="started")
+            flight = self._flights[key] = _Flight()
+            # The task copies the context, so its spans nest in this trace
+            flight.task = asyncio.create_task(self._run(key, flight, produce()))
+
+        flight.subscribers += 1
+        try:
+            index = 0
+            while True:
+                while index < len(flight.events):
+                    yield flight.events[index]
+                    index += 1
+                if flight.done:
+                    break
+                await flight.wait()
+            if flight.error is not None:
+                raise flight.error
+        finally:
+            flight.subscribers -= 1
+            if not flight.subscribers and not flight.done:
+                # Nobody is listening any more
+                self._forget(key, flight)
+                flight.task.cancel()
+
+    async def _run(self, key, flight: _Flight, events):
+        error = None
+        try:
+            async for event in events:
+                flight.publish(event)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = e
+        finally:
+            self._forget(key, flight)
+            flight.finish(error)
+
+    def _forget(self, key, flight: _Flight):
+        # Only if a newer flight didn't take the key in the meantime
+        if self._flights.get(key) is flight:
+            del self._flights[key]
@@ -0,0 +1,75 @@
+"""Retry delays and adaptive concurrency for calls to rate limited services."""
+
+import asyncio
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+def backoff(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """Full-jitter exponential backoff."""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def retry_delay(error, attempt: int, cap: float = 60.0) -> float:
+    """Seconds to wait after a rate limit: the server's `retry-after`, if sent,
+    otherwise full-jitter exponential backoff."""
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            return min(float(response.headers.get("retry-after", "")), cap)
+        except ValueError:
+            pass
+    return backoff(attempt, cap=cap)
+
+
+class AdaptiveConcurrency:
+    """Caps the questions in flight and backs off when rate limited.
+
+    A rate limit halves the cap and holds every new call until its retry
+    delay has passed; each run of successes as long as the cap raises it by
+    one again, up to `limit`.
+    """
+
+    def __init__(self, limit: int):
+        self.max_limit = limit
+        self.limit = limit
+        self.active = 0
+        self.rate_limited = 0
+        self._successes = 0
+        self._resume_at = 0.0
+        self._changed = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+        try:
+            if (delay := self._resume_at - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+            yield
+        finally:
+            async with self._changed:
+                self.active -= 1
+                self._changed.notify_all()
+
+    def succeeded(self):
+        self._successes += 1
+        if self.limit < self.max_limit and self._successes >= self.limit:
+            self.limit += 1
+            self._successes = 0
+
+    def throttle(self, delay: float):
+        self.rate_limited += 1
+        self._successes = 0
+        self.limit = max(1, self.limit // 2)
+        self._resume_at = max(self._resume_at, time.monotonic() + delay)
+        logger.warning(
+            "⏳ Rate limited, pausing %.1fs and lowering concurrency to %d",
+            delay,
+            self.limit,
+        )
@@ -0,0 +1,196 @@
+import logging
+import re
+import threading
+from collections import OrderedDict
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+_WORD = re.compile(r"\w+")
+
+# Words per shingle when comparing chunks for overlap
+_SHINGLE_SIZE = 8
+
+
+class ContextBudget:
+    """Packs retrieved chunks and conversation history into token budgets.
+
+    Tokens are counted with the tokenizer of `model`, or estimated from the
+    text length when `model` is None. The tokenizer may have to be
+    downloaded, so call `load()` off the event loop before counting; the
+    RAG does this while warming up. Counts of the last `count_cache_size`
+    texts are cached, so history and chunks seen before aren't tokenized
+    again.
+
+    Chunks are kept in rank order until `context_tokens` is spent; chunks
+    that mostly repeat an earlier one are dropped. History keeps the most
+    recent turns verbatim within `history_tokens`; older turns are cut down
+    to `trimmed_turn_tokens` each while they still fit, the rest is left out.
+    """
+
+    def __init__(
+        self,
+        model: str = "gpt-4o",
+        context_tokens: int = 6000,
+        history_tokens: int = 3000,
+        trimmed_turn_tokens: int = 80,
+        overlap_threshold: float = 0.8,
+        count_cache_size: int = 4096,
+    ):
+        self.model = model
+        self.context_tokens = context_tokens
+        self.history_tokens = history_tokens
+        self.trimmed_turn_tokens = trimmed_turn_tokens
+        self.overlap_threshold = overlap_threshold
+        self.count_cache_size = count_cache_size
+        self._encoding = None
+        self._counts = OrderedDict()
+        self._counts_lock = threading.Lock()
+
+    def load(self) -> bool:
+        """Load the tokenizer; blocking, it is downloaded on a cold start.
+
+        Returns:
+            bool: Whether tokens are counted with the tokenizer rather than
+                estimated
+        """
+        if self._encoding is None:
+            if self.model is None:
+                # No tokenizer requested, estimate from the text length
+                self._encoding = False
+                return False
+            try:
+                self._encoding = tiktoken.encoding_for_model(self.model)
+            except Exception as e:
+                # Estimate without it rather than fail every request
+                logger.warning("⚠️ Tokenizer unavailable, estimating tokens: %s", e)
+                self._encoding = False
+        return bool(self._encoding)
+
+    @property
+    def encoding(self):
+        if self._encoding is None:
+            # Only when used without `load()`, e.g. by the benchmarks
+            self.load()
+        return self._encoding
+
+    def count(self, text: str) -> int:
+        with self._counts_lock:
+            tokens = self._counts.get(text)
+            if tokens is not None:
+                self._counts.move_to_end(text)
+                return tokens
+
+        if self.encoding:
+            tokens = len(self.encoding.encode(text, disallowed_special=()))
+        else:
+            tokens = (len(text) + 3) // 4
+
+        with self._counts_lock:
+            self._counts[text] = tokens
+            while len(self._counts) > self.count_cache_size:
+                self._counts.popitem(last=False)
+        return tokens
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        if self.encoding:
+            tokens = self.encoding.encode(text, disallowed_special=())
+            if len(tokens) <= max_tokens:
+                return text
+            return self.encoding.decode(tokens[:max_tokens]) + " …"
+        if len(text) <= max_tokens * 4:
+            return text
+        return text[: max_tokens * 4] + " …"
+
+    def _shingles(self, text: str) -> set:
+        words = _WORD.findall(text.lower())
+        if len(words) <= _SHINGLE_SIZE:
+            return {tuple(words)}
+        return {
+            tuple(words[i : i + _SHINGLE_SIZE])
+            for i in range(len(words) - _SHINGLE_SIZE + 1)
+        }
+
+    def pack_documents(self, documents: list) -> list:
+        """Keep the best-ranked, non-overlapping documents that fit the budget.
+
+        Args:
+            documents: ContextDocument list in rank order
+
+        Returns:
+            list[ContextDocument]: The documents to put in the prompt
+        """
+        packed = []
+        seen = set()
+        remaining = self.context_tokens
+
+        for document in documents:
+            shingles = self._shingles(document.text)
+            if len(shingles & seen) >= self.overlap_threshold * len(shingles):
+                continue
+
+            tokens = self.count(document.text)
+            if tokens > remaining:
+                # Only the top document is cut down rather than skipped
+                if packed:
+                    continue
+                document.text = self.truncate(document.text, remaining)
+                tokens = remaining
+
+            packed.append(document)
+            seen |= shingles
+            remaining -= tokens
+
+        if len(packed) < len(documents):
+            logger.debug(
+                "✂️ Packed %d of %d documents into %d tokens",
+                len(packed),
+                len(documents),
+                self.context_tokens - remaining,
+            )
+
+        return packed
+
+    def window_history(self, message_history: list) -> list:
+        """Fit the conversation history into the history budget, newest first.
+
+        Args:
+            message_history: Previous conversation messages, oldest first
+
+        Returns:
+            list: Messages to send, oldest first
+        """
+        windowed = []
+        remaining = self.history_tokens
+        verbatim = True
+
+        for message in reversed(message_history):
+            content = message.get("content") or ""
+            tokens = self.count(content)
+
+            if verbatim and tokens > remaining:
+                verbatim = False
+            if not verbatim:
+                content = self.truncate(content, self.trimmed_turn_tokens)
+                tokens = self.count(content)
+                if tokens > remaining:
+                    break
+
+            windowed.append({**message, "content": content})
+            remaining -= tokens
+
+        windowed.reverse()
+
+        # Don't start the window with a dangling assistant reply
+        while windowed and windowed[0].get("role") == "assistant":
+            windowed.pop(0)
+
+        if len(windowed) < len(message_history) or not verbatim:
+            logger.debug(
+                "✂️ History windowed to %d of %d messages",
+                len(windowed),
+                len(message_history),
+            )
+
+        return windowed
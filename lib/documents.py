@@ -0,0 +1,82 @@
+class ContextDocument:
+    """One retrieved chunk of the knowledge base."""
+
+    __slots__ = ("text", "url", "page_title", "source", "score", "id")
+
+    def __init__(
+        self,
+        text: str,
+        url: str = None,
+        page_title: str = None,
+        source: str = None,
+        score: float = None,
+        id: str = None,
+    ):
+        self.text = text
+        self.url = url
+        self.page_title = page_title
+        self.source = source
+        self.score = score
+        # The chunk's content hash, on tables written by `lib.ingest`
+        self.id = id
+
+    def __repr__(self):
+        return f"ContextDocument(page_title={self.page_title!r}, score={self.score!r})"
+
+
+def documents_from_arrow(results) -> list:
+    """Convert a LanceDB Arrow result into documents, column by column.
+
+    Args:
+        results: pyarrow.Table with `text`, `metadata` and optionally
+            `chunk_hash` and `_relevance_score` or `_score` columns
+
+    Returns:
+        list[ContextDocument]: Documents in result order
+    """
+    texts = results.column("text").to_pylist()
+    metadata = results.column("metadata").to_pylist()
+    # Hybrid results carry a reranker score, full-text results a BM25 score
+    for score_column in ("_relevance_score", "_score"):
+        if score_column in results.column_names:
+            scores = results.column(score_column).to_pylist()
+            break
+    else:
+        scores = [None] * len(texts)
+    if "chunk_hash" in results.column_names:
+        ids = results.column("chunk_hash").to_pylist()
+    else:
+        ids = [None] * len(texts)
+
+    return [
+        ContextDocument(
+            text,
+            meta.get("url"),
+            meta.get("page_title"),
+            meta.get("source"),
+            score,
+            id,
+        )
+        for text, meta, score, id in zip(texts, metadata, scores, ids)
+    ]
+
+
+def format_context(documents: list) -> str:
+    """Render documents into the context block used by the prompts."""
+    contexts = []
+
+    for document in documents:
+        context = "<document>"
+
+        if document.page_title:
+            context += f"\nTitle: {document.page_title}"
+
+        if document.source:
+            context += f"\nSource: {document.source}"
+
+        if document.url:
+            context += f"\nURL: {document.url}"
+
+        contexts.append(context + "\nContent: " + document.text + "\n</document>\n")
+
+    return "\n\n".join(contexts)
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from lib.executor import run_blocking
+from lib.metrics import Counter, Histogram
+from lib.query import normalize_query
+
+logger = logging.getLogger(__name__)
+
+QUERY_EMBEDDINGS = Counter(
+    "mira_query_embeddings",
+    "Query embeddings by whether they came from the cache, a request in "
+    "flight for the same query, or a new request",
+    ["result"],
+)
+EMBEDDING_BATCH_SIZE = Histogram(
+    "mira_embedding_batch_size",
+    "Queries per embedding request",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+
+
+def normalize_vector(vector):
+    """Scale `vector` to unit length, as float32, for cosine similarity."""
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class QueryEmbedder:
+    """Embeds search queries through an LRU cache and a micro-batcher.
+
+    `embed_batch` is a blocking callable embedding a list of texts. Up to
+    `cache_size` vectors are cached by normalized query text, so repeated
+    questions such as the starters are embedded once. Cache misses that
+    arrive within `batch_window` seconds of each other go out as one
+    request of up to `max_batch` queries, and concurrent requests for the
+    same query share a single result.
+    """
+
+    def __init__(
+        self,
+        embed_batch,
+        cache_size: int = 4096,
+        batch_window: float = 0.005,
+        max_batch: int = 64,
+    ):
+        self.embed_batch = embed_batch
+        self.cache_size = cache_size
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self._cache = OrderedDict()
+        # Futures of queries that are pending or being embedded, by key
+        self._inflight = {}
+        self._pending = []
+        self._flush_handle = None
+        self._requests = set()
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "requests": 0}
+
+    @classmethod
+    def from_env(cls, embed_batch):
+        """Build an embedder configured by the RAG_EMBEDDING_* variables."""
+        return cls(
+            embed_batch,
+            cache_size=int(os.getenv("RAG_EMBEDDING_CACHE_SIZE", "4096")),
+            batch_window=float(os.getenv("RAG_EMBEDDING_BATCH_WINDOW_MS", "5")) / 1000,
+        )
+
+    async def embed(self, query: str):
+        """Return the query's embedding, from the cache when possible."""
+        key = normalize_query(query)
+        vector = self._cache.get(key)
+        if vector is not None:
+            self._cache.move_to_end(key)
+            self.stats["hits"] += 1
+            QUERY_EMBEDDINGS.inc(result="hit")
+            return vector
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.stats["coalesced"] += 1
+            QUERY_EMBEDDINGS.inc(result="coalesced")
+        else:
+            self.stats["misses"] += 1
+            QUERY_EMBEDDINGS.inc(result="miss")
+            loop = asyncio.get_running_loop()
+            future = self._inflight[key] = loop.create_future()
+            self._pending.append((key, query))
+            if len(self._pending) >= self.max_batch:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = loop.call_later(self.batch_window, self._flush)
+
+        # A caller that gives up doesn't cancel the request for the others
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            request = asyncio.create_task(self._embed(batch))
+            self._requests.add(request)
+            request.add_done_callback(self._requests.discard)
+
+    async def _embed(self, batch: list):
+        self.stats["requests"] += 1
+        EMBEDDING_BATCH_SIZE.observe(len(batch))
+        try:
+            vectors = await run_blocking(self.embed_batch, [text for _, text in batch])
+        except Exception as e:
+            logger.warning("⚠️ Embedding %d queries failed: %s", len(batch), e)
+            for key, _ in batch:
+                future = self._inflight.pop(key)
+                if not future.done():
+                    future.set_exception(e)
+                    # Don't warn about callers that already gave up
+                    future.exception()
+            return
+
+        for (key, _), vector in zip(batch, vectors):
+            self._cache[key] = vector
+            future = self._inflight.pop(key)
+            if not future.done():
+                future.set_result(vector)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        logger.debug("🧮 Embedded %d queries in one request", len(batch))
@@ -0,0 +1,34 @@
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared pool for the calls that have no async counterpart (LanceDB searches,
+# Langfuse prompt fetches). Bounded so a burst of sessions can't spawn an
+# unbounded number of threads against S3.
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("RAG_BLOCKING_WORKERS", "16")),
+    thread_name_prefix="rag-blocking",
+)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call on the shared executor without stalling the event loop.
+
+    The caller's context is copied into the worker thread so Langfuse
+    `@observe()` spans still nest under the current trace.
+
+    Args:
+        func: Synchronous callable to run
+        *args: Positional arguments for `func`
+        **kwargs: Keyword arguments for `func`
+
+    Returns:
+        Whatever `func` returns
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(
+        _executor, functools.partial(ctx.run, func, *args, **kwargs)
+    )
@@ -0,0 +1,376 @@
+"""Incremental ingestion into the `molrag` knowledge base table.
+
+Reads source documents as JSON lines (`text`, `url`, `page_title`,
+`source`), splits them into chunks and identifies every chunk by a hash of
+its content. Only chunks whose hash is not in the table yet are embedded and
+added, and chunks that no longer come out of the sources are deleted. The
+full-text and vector indexes are then updated in place and the
+`knowledge_version` in the `config` table is bumped in a single commit, so
+running servers pick up the new content.
+
+    python -m lib.ingest corpus.jsonl
+    python -m lib.ingest --db ./data --create --embedding openai corpus.jsonl
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+import lancedb
+import pyarrow as pa
+from lancedb.embeddings import get_registry
+from lancedb.pydantic import LanceModel, Vector
+
+logger = logging.getLogger(__name__)
+
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+
+# Below this many rows a vector search is a fast brute-force scan
+VECTOR_INDEX_MIN_ROWS = 10_000
+
+
+def chunk_text(text: str, chunk_words: int = 250, overlap_words: int = 40) -> list:
+    """Split text into chunks of up to `chunk_words` words along paragraphs.
+
+    Paragraphs are packed together while they fit; a paragraph longer than a
+    chunk is cut into windows overlapping by `overlap_words` words.
+    """
+    chunks = []
+    current = []
+
+    for paragraph in _PARAGRAPH_BREAK.split(text.strip()):
+        words = paragraph.split()
+        if not words:
+            continue
+
+        if len(words) > chunk_words:
+            if current:
+                chunks.append(" ".join(current))
+                current = []
+            step = max(chunk_words - overlap_words, 1)
+            for start in range(0, len(words), step):
+                chunks.append(" ".join(words[start : start + chunk_words]))
+                if start + chunk_words >= len(words):
+                    break
+            continue
+
+        if current and len(current) + len(words) > chunk_words:
+            chunks.append(" ".join(current))
+            current = []
+        current.extend(words)
+
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+
+def chunk_hash(text: str, metadata: dict) -> str:
+    """Identify a chunk by its text and the metadata shown alongside it."""
+    digest = hashlib.sha256()
+    for value in (text, metadata["url"], metadata["page_title"], metadata["source"]):
+        digest.update((value or "").encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def read_documents(path: str):
+    """Stream documents from a JSON lines file, or stdin for "-"."""
+    f = sys.stdin if path == "-" else open(path)
+    try:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def create_table(db, name: str, embedding):
+    """Create an empty knowledge base table embedded by `embedding`."""
+
+    class Metadata(LanceModel):
+        url: str
+        page_title: str
+        source: str
+
+    class Chunk(LanceModel):
+        text: str = embedding.SourceField()
+        vector: Vector(embedding.ndims()) = embedding.VectorField()
+        metadata: Metadata
+        chunk_hash: str
+
+    return db.create_table(name, schema=Chunk)
+
+
+def _chunks(documents, chunk_words: int, overlap_words: int):
+    for document in documents:
+        metadata = {
+            "url": document.get("url") or "",
+            "page_title": document.get("page_title") or "",
+            "source": document.get("source") or "",
+        }
+        for text in chunk_text(document["text"], chunk_words, overlap_words):
+            yield {
+                "text": text,
+                "metadata": metadata,
+                "chunk_hash": chunk_hash(text, metadata),
+            }
+
+
+def _existing_chunks(table) -> dict:
+    """Map the hash of every chunk in the table to its URL."""
+    if "chunk_hash" not in table.schema.names:
+        return {}
+    rows = (
+        table.search()
+        .select(["chunk_hash", "metadata"])
+        .limit(None)
+        .to_arrow()
+        .to_pylist()
+    )
+    return {row["chunk_hash"]: row["metadata"]["url"] for row in rows}
+
+
+def _sql_list(values) -> str:
+    return ", ".join("'" + value.replace("'", "''") + "'" for value in values)
+
+
+def _update_indexes(table):
+    """Add new rows to the existing indexes, creating missing ones once."""
+    indexed = {column for index in table.list_indices() for column in index.columns}
+
+    if "text" not in indexed:
+        table.create_fts_index("text", replace=True)
+    if "chunk_hash" not in indexed:
+        table.create_scalar_index("chunk_hash")
+    if "vector" not in indexed and table.count_rows() >= VECTOR_INDEX_MIN_ROWS:
+        table.create_index(vector_column_name="vector")
+
+    # Merges new fragments into the indexes incrementally and compacts files;
+    # old versions are kept for the default week so readers aren't cut off
+    table.optimize()
+
+
+def _default_version(chunk_hashes) -> str:
+    """A timestamp and a fingerprint of the content, e.g. 20250101120000-1a2b3c4d."""
+    fingerprint = hashlib.sha256("".join(sorted(chunk_hashes)).encode()).hexdigest()
+    return time.strftime("%Y%m%d%H%M%S", time.gmtime()) + "-" + fingerprint[:8]
+
+
+def bump_knowledge_version(db, version: str):
+    """Set `knowledge_version` in the `config` table in a single commit."""
+    row = [{"key": "knowledge_version", "value": version}]
+    if "config" not in db.table_names():
+        db.create_table("config", data=row)
+        return
+
+    (
+        db.open_table("config")
+        .merge_insert("key")
+        .when_matched_update_all()
+        .when_not_matched_insert_all()
+        .execute(row)
+    )
+
+
+def ingest(
+    db,
+    documents,
+    table_name: str = "molrag",
+    embedding=None,
+    batch_size: int = 64,
+    chunk_words: int = 250,
+    overlap_words: int = 40,
+    partial: bool = False,
+    version: str = None,
+) -> dict:
+    """Bring the table in line with `documents`, embedding only new chunks.
+
+    Args:
+        db: LanceDB connection
+        documents: Iterable of dicts with `text`, `url`, `page_title`, `source`
+        table_name: Table to update, created if missing when `embedding` is set
+        embedding: Embedding function for a new table; an existing table uses
+            the one recorded in its schema
+        batch_size: Chunks per embedding call and write
+        chunk_words: Maximum words per chunk
+        overlap_words: Words shared by consecutive windows of a long paragraph
+        partial: Only replace chunks of the URLs in `documents` and keep
+            every other chunk, instead of treating `documents` as the corpus
+        version: Knowledge version to set, by default a timestamp and a
+            fingerprint of the resulting content
+
+    Returns:
+        dict: Counts of documents, chunks added, deleted and unchanged, the
+            time taken and the knowledge version (None if nothing changed)
+    """
+    started = time.perf_counter()
+
+    if table_name in db.table_names():
+        table = db.open_table(table_name)
+    elif embedding is not None:
+        table = create_table(db, table_name, embedding)
+    else:
+        raise ValueError(f"Table '{table_name}' doesn't exist, pass an embedding")
+
+    embedder = table.embedding_functions["vector"].function
+    schema = table.schema
+
+    # Tables written before content hashes existed are rebuilt once
+    rebuild = "chunk_hash" not in schema.names
+    if rebuild:
+        logger.info("🧱 Table '%s' has no chunk hashes, rebuilding it", table_name)
+        schema = schema.append(pa.field("chunk_hash", pa.string()))
+
+    existing = _existing_chunks(table)
+    seen = set()
+    urls = set()
+    pending = []
+    new_rows = []
+    stats = {"documents": 0, "chunks": 0, "added": 0, "deleted": 0, "unchanged": 0}
+
+    def flush():
+        vectors = embedder.compute_source_embeddings([row["text"] for row in pending])
+        for row, vector in zip(pending, vectors):
+            row["vector"] = vector
+        if rebuild:
+            # Written in one overwrite at the end, so readers never see half
+            new_rows.extend(pending)
+        else:
+            data = pa.Table.from_pylist(pending, schema=schema)
+            table.merge_insert("chunk_hash").when_not_matched_insert_all().execute(data)
+        stats["added"] += len(pending)
+        pending.clear()
+
+    def counted(documents):
+        for document in documents:
+            stats["documents"] += 1
+            urls.add(document.get("url") or "")
+            yield document
+
+    for chunk in _chunks(counted(documents), chunk_words, overlap_words):
+        if chunk["chunk_hash"] in seen:
+            continue
+        seen.add(chunk["chunk_hash"])
+        stats["chunks"] += 1
+
+        if chunk["chunk_hash"] in existing:
+            stats["unchanged"] += 1
+            continue
+
+        pending.append(chunk)
+        if len(pending) >= batch_size:
+            flush()
+
+    if pending:
+        flush()
+
+    stale = []
+    if rebuild:
+        stats["deleted"] = table.count_rows()
+        table = db.create_table(
+            table_name,
+            data=pa.Table.from_pylist(new_rows, schema=schema),
+            mode="overwrite",
+        )
+    else:
+        stale = [
+            key
+            for key, url in existing.items()
+            if key not in seen and (not partial or url in urls)
+        ]
+        for start in range(0, len(stale), 500):
+            table.delete(f"chunk_hash IN ({_sql_list(stale[start : start + 500])})")
+        stats["deleted"] = len(stale)
+
+    changed = rebuild or stats["added"] or stats["deleted"]
+    if changed:
+        _update_indexes(table)
+        if version is None:
+            current = seen if rebuild else (existing.keys() - set(stale)) | seen
+            version = _default_version(current)
+        bump_knowledge_version(db, version)
+
+    stats["knowledge_version"] = version if changed else None
+    stats["seconds"] = time.perf_counter() - started
+    logger.info(
+        "📥 Ingested %d documents: %d chunks added, %d deleted, %d unchanged",
+        stats["documents"],
+        stats["added"],
+        stats["deleted"],
+        stats["unchanged"],
+    )
+    return stats
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("documents", help='JSON lines file, or "-" for stdin')
+    parser.add_argument(
+        "--db", default=os.getenv("RAG_DB_URI", "s3://mol-mira-v0"), help="LanceDB URI"
+    )
+    parser.add_argument("--table", default="molrag")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--chunk-words", type=int, default=250)
+    parser.add_argument("--overlap-words", type=int, default=40)
+    parser.add_argument(
+        "--partial",
+        action="store_true",
+        help="Only update the URLs in the input, keep all other chunks",
+    )
+    parser.add_argument("--version", help="Knowledge version to set")
+    parser.add_argument(
+        "--create",
+        action="store_true",
+        help="Create the table if it doesn't exist",
+    )
+    parser.add_argument(
+        "--embedding", default="openai", help="Embedding registry name for --create"
+    )
+    parser.add_argument("--embedding-model", help="Model for --create")
+    return parser.parse_args(argv)
+
+
+def main(args):
+    from lib.logs import configure_logging
+    from lib.transport import HttpTransport
+
+    configure_logging()
+
+    storage_options = {
+        "aws_access_key_id": os.getenv("DO_SPACES_ACCESS_KEY_ID"),
+        "aws_secret_access_key": os.getenv("DO_SPACES_SECRET_ACCESS_KEY"),
+        "aws_endpoint": "https://fra1.digitaloceanspaces.com",
+        "aws_region": "fra1",
+        **HttpTransport.from_env().storage_options(),
+    }
+    # Unset credentials are left out, e.g. for a local --db path
+    storage_options = {k: v for k, v in storage_options.items() if v is not None}
+    db = lancedb.connect(args.db, storage_options=storage_options)
+
+    embedding = None
+    if args.create:
+        options = {"name": args.embedding_model} if args.embedding_model else {}
+        embedding = get_registry().get(args.embedding).create(**options)
+
+    stats = ingest(
+        db,
+        read_documents(args.documents),
+        table_name=args.table,
+        embedding=embedding,
+        batch_size=args.batch_size,
+        chunk_words=args.chunk_words,
+        overlap_words=args.overlap_words,
+        partial=args.partial,
+        version=args.version,
+    )
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main(parse_args(sys.argv[1:]))
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+
+from lib.executor import run_blocking
+
+logger = logging.getLogger(__name__)
+
+
+class KnowledgeVersionWatcher:
+    """Keeps the current knowledge version in memory and announces changes.
+
+    The version is read once up front and then polled in a background task,
+    so callers get it without any I/O. Subscribers are called with
+    `(old_version, new_version)` whenever a poll sees a different version;
+    they run on the event loop and should hand long work off to a task.
+    """
+
+    def __init__(self, read_version, interval: float = 30):
+        self.read_version = read_version
+        self.interval = interval
+        self.version = None
+        self._subscribers = []
+        self._task = None
+
+    def subscribe(self, callback):
+        """Register `callback(old_version, new_version)` for version changes."""
+        self._subscribers.append(callback)
+
+    def load(self):
+        """Read the version synchronously, for use before the event loop runs."""
+        self.version = self.read_version()
+        return self.version
+
+    def _set_version(self, version):
+        old_version, self.version = self.version, version
+        if old_version is None or old_version == version:
+            return
+
+        logger.info("📦 Knowledge version changed: %s -> %s", old_version, version)
+        for callback in self._subscribers:
+            try:
+                callback(old_version, version)
+            except Exception as e:
+                logger.warning("⚠️ Knowledge version subscriber failed: %s", e)
+
+    async def refresh(self):
+        """Read the version now and notify subscribers if it changed."""
+        self._set_version(await run_blocking(self.read_version))
+        return self.version
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                # Keep serving the last known version until the next poll
+                logger.warning("⚠️ Knowledge version refresh failed: %s", e)
+
+    def start(self):
+        """Start polling in the background; a no-op if already running."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
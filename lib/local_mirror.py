@@ -0,0 +1,160 @@
+import logging
+import os
+import shutil
+from urllib.parse import urlparse
+
+import lancedb
+from pyarrow import fs
+
+logger = logging.getLogger(__name__)
+
+
+def _seconds(duration: str):
+    return float(duration.rstrip("s")) if duration else None
+
+
+def _remote_filesystem(uri: str, storage_options: dict):
+    """Build a pyarrow filesystem and root path for a LanceDB database URI."""
+    parsed = urlparse(uri)
+
+    if parsed.scheme == "s3":
+        endpoint = urlparse(storage_options["aws_endpoint"])
+        filesystem = fs.S3FileSystem(
+            access_key=storage_options.get("aws_access_key_id"),
+            secret_key=storage_options.get("aws_secret_access_key"),
+            endpoint_override=endpoint.netloc,
+            scheme=endpoint.scheme or "https",
+            region=storage_options.get("aws_region"),
+            # Shared transport settings, e.g. "5s"
+            connect_timeout=_seconds(storage_options.get("connect_timeout")),
+            request_timeout=_seconds(storage_options.get("timeout")),
+            retry_strategy=fs.AwsStandardS3RetryStrategy(
+                max_attempts=int(storage_options.get("client_max_retries", 3)) + 1
+            ),
+        )
+        return filesystem, (parsed.netloc + parsed.path).rstrip("/")
+
+    # Plain paths (or file:// URIs) are used as a stand-in in development
+    return fs.LocalFileSystem(), os.path.abspath(parsed.path or uri)
+
+
+def _is_manifest(relative_path: str) -> bool:
+    return relative_path.startswith("_versions/") or relative_path == "_latest.manifest"
+
+
+class LocalMirror:
+    """Read-through copy of remote LanceDB tables on local disk.
+
+    Lance datasets are append-only: data, index and deletion files are
+    immutable and a new version only adds files plus a manifest. A sync
+    therefore only downloads files that are missing locally, and copies the
+    manifests last so a local reader never sees a version whose files are
+    not there yet. Files that were cleaned up on the remote, e.g. those of
+    versions older than a compaction keeps, are then deleted locally too.
+    The mirrored `knowledge_version` is stored next to the tables so
+    restarts don't resync an unchanged knowledge base.
+    """
+
+    def __init__(
+        self,
+        uri: str,
+        storage_options: dict,
+        path: str,
+        table_names=("molrag",),
+    ):
+        self.remote_fs, self.remote_root = _remote_filesystem(uri, storage_options)
+        self.path = os.path.abspath(path)
+        self.table_names = table_names
+        self._version_file = os.path.join(self.path, "knowledge_version")
+
+    @property
+    def synced_version(self):
+        """The knowledge version currently on disk, or None before the first sync."""
+        try:
+            with open(self._version_file) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _copy_file(self, source: str, destination: str):
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        partial = destination + ".partial"
+        with (
+            self.remote_fs.open_input_stream(source) as src,
+            open(partial, "wb") as dst,
+        ):
+            shutil.copyfileobj(src, dst, length=8 * 1024 * 1024)
+        os.replace(partial, destination)
+
+    def _sync_table(self, name: str):
+        source_root = f"{self.remote_root}/{name}.lance"
+        destination_root = os.path.join(self.path, f"{name}.lance")
+
+        # Pin the listing: manifests in it only reference files that existed
+        # when it was taken, even if the remote table is written to meanwhile.
+        infos = self.remote_fs.get_file_info(
+            fs.FileSelector(source_root, recursive=True)
+        )
+        files = [info for info in infos if info.type == fs.FileType.File]
+        files.sort(key=lambda info: _is_manifest(info.path[len(source_root) + 1 :]))
+
+        copied_files = 0
+        copied_bytes = 0
+        relative_paths = set()
+        for info in files:
+            relative_path = info.path[len(source_root) + 1 :]
+            relative_paths.add(relative_path)
+            destination = os.path.join(destination_root, relative_path)
+
+            # Everything except the latest-version pointer is immutable
+            if (
+                relative_path != "_latest.manifest"
+                and os.path.exists(destination)
+                and os.path.getsize(destination) == info.size
+            ):
+                continue
+
+            self._copy_file(info.path, destination)
+            copied_files += 1
+            copied_bytes += info.size
+
+        # Only now that the new manifests are in place
+        deleted_files = self._delete_missing(destination_root, relative_paths)
+
+        logger.info(
+            "🪞 Mirrored table '%s': copied %d files (%.1f MB) of %d, deleted %d",
+            name,
+            copied_files,
+            copied_bytes / 1e6,
+            len(files),
+            deleted_files,
+        )
+
+    def _delete_missing(self, root: str, keep: set) -> int:
+        """Delete files under `root` whose relative paths are not in `keep`."""
+        deleted = 0
+        for directory, _, names in os.walk(root):
+            for file_name in names:
+                path = os.path.join(directory, file_name)
+                if os.path.relpath(path, root) not in keep:
+                    os.remove(path)
+                    deleted += 1
+        return deleted
+
+    def sync(self, knowledge_version: str):
+        """Bring the local copy up to date with the remote tables.
+
+        Args:
+            knowledge_version: Version the remote tables are at
+        """
+        for name in self.table_names:
+            self._sync_table(name)
+
+        partial = self._version_file + ".partial"
+        with open(partial, "w") as f:
+            f.write(knowledge_version)
+        os.replace(partial, self._version_file)
+
+    def open_table(self, name: str):
+        """Open a mirrored table at its latest synced version."""
+        return lancedb.connect(self.path).open_table(name)
@@ -0,0 +1,27 @@
+import logging
+import os
+
+# Loggers of the `lib` package and the Chainlit app module
+LOGGER_NAMES = ("lib", "app")
+
+
+def configure_logging(level: str = None):
+    """Send the app's log records to stderr at `level`.
+
+    The level defaults to RAG_LOG_LEVEL or INFO. DEBUG traces every step of
+    every question and is meant for development; OFF silences the app's
+    logs entirely.
+    """
+    level = (level or os.getenv("RAG_LOG_LEVEL", "INFO")).upper()
+
+    for name in LOGGER_NAMES:
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.CRITICAL + 1 if level == "OFF" else level)
+        # Chainlit configures the root logger, keep records from printing twice
+        logger.propagate = False
+        if not logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(
+                logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+            )
+            logger.addHandler(handler)
@@ -0,0 +1,282 @@
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from a cache hit to a slow web search
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Every metric created in this process, in the order they are exported
+_registry = []
+_collectors = []
+
+# Stage timings of the current task while `capture_stages()` is active
+_captured_stages = contextvars.ContextVar("captured_stages", default=None)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_sample(name: str, labels: dict, value) -> str:
+    if labels:
+        name += "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+    return f"{name} {value}"
+
+
+class Counter:
+    """A monotonically increasing count per label set."""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name + "_total", dict(zip(self.labelnames, key)), value
+
+
+class Gauge:
+    """A value per label set that can go up and down."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    """Observations counted into cumulative buckets per label set."""
+
+    type = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: [counts per bucket + one for +Inf, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the `with` block takes, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        entry = self._values.get(self._key(labels))
+        return sum(entry[0]) if entry else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((k, (list(c), s)) for k, (c, s) in self._values.items())
+        for key, (counts, total) in values:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield self.name + "_bucket", {**labels, "le": str(bound)}, cumulative
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, cumulative
+
+
+def register_collector(collector):
+    """Call `collector()` before each export, e.g. to set gauges from live state."""
+    _collectors.append(collector)
+
+
+def render() -> str:
+    """Export every metric in the Prometheus text format."""
+    for collector in _collectors:
+        collector()
+
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(_format_sample(*sample) for sample in metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "mira_stage_seconds",
+    "Time spent in each step of answering a question",
+    ["stage"],
+)
+TIME_TO_FIRST_TOKEN_SECONDS = Histogram(
+    "mira_time_to_first_token_seconds",
+    "Time from receiving a question to the first answer token, by route",
+    ["route"],
+)
+ANSWER_SECONDS = Histogram(
+    "mira_answer_seconds",
+    "Time from receiving a question to the end of the answer stream, by route",
+    ["route"],
+)
+ROUTE_DECISIONS = Counter(
+    "mira_route_decisions",
+    "Evaluator verdicts on how to answer a question",
+    ["route"],
+)
+WEB_SEARCH_ANSWERS = Counter(
+    "mira_web_search_answers",
+    "Web search answers by how trusted-source filtering went",
+    ["outcome"],
+)
+LLM_TOKENS = Counter(
+    "mira_llm_tokens",
+    "Tokens reported by the OpenAI API, by model and prompt/completion",
+    ["model", "kind"],
+)
+
+SPECULATIONS = Counter(
+    "mira_speculations",
+    "Speculative local answers by whether the evaluator kept them (hit) or "
+    "they were cancelled (miss)",
+    ["result"],
+)
+SPECULATION_SECONDS_SAVED = Counter(
+    "mira_speculation_seconds_saved",
+    "Seconds by which speculative local answers were ahead when the evaluator "
+    "kept them: their time to first token, up to the evaluation time",
+)
+SPECULATION_WASTED_CALLS = Counter(
+    "mira_speculation_wasted_calls",
+    "Local answer generations started speculatively and then cancelled",
+)
+SPECULATION_WASTED_TOKENS = Counter(
+    "mira_speculation_wasted_tokens",
+    "Prompt and answer tokens of speculative local answers that were thrown away",
+)
+
+
+def record_usage(model: str, usage):
+    """Count the tokens of an OpenAI response's `usage`, if it has one."""
+    if usage is None:
+        return
+    LLM_TOKENS.inc(usage.prompt_tokens or 0, model=model, kind="prompt")
+    LLM_TOKENS.inc(usage.completion_tokens or 0, model=model, kind="completion")
+
+
+def observe_stage(stage: str, seconds: float):
+    """Record a stage's duration, also into an active `capture_stages()`."""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    captured = _captured_stages.get()
+    if captured is not None:
+        captured[stage] = captured.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def time_stage(stage: str):
+    """Record how long the `with` block takes as `stage`, also when it raises."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+class StageTimer:
+    """Records the time spent inside `running()` blocks as one `stage`.
+
+    For stages that are suspended in between, e.g. a generator that yields
+    tokens to a slow consumer or a call that waits its turn: only the
+    `running()` parts count. Used as a context manager, the total is
+    recorded on exit, also when the block raises.
+    """
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.seconds = 0.0
+
+    @contextmanager
+    def running(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds += time.perf_counter() - started
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        observe_stage(self.stage, self.seconds)
+
+
+@contextmanager
+def capture_stages():
+    """Collect the seconds spent per stage within the block, e.g. per question.
+
+    Tasks and blocking calls started inside the block inherit the context,
+    so their stages are collected as well.
+    """
+    captured = {}
+    token = _captured_stages.set(captured)
+    try:
+        yield captured
+    finally:
+        _captured_stages.reset(token)
@@ -0,0 +1,227 @@
+import logging
+import random
+import re
+
+import numpy as np
+
+from lib.embeddings import normalize_vector
+from lib.executor import run_blocking
+from lib.metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+# Whole messages that are greetings, thanks or other small talk
+_SMALL_TALK = re.compile(
+    r"^\W*(?:hi+|hey+|hello+|yo|hiya|howdy|good (?:morning|afternoon|evening)|"
+    r"thanks?(?: you)?(?: so much| a lot)?|thx|ty|cheers|ok(?:ay)?|cool|great|"
+    r"nice|bye|goodbye|see you|how are you(?: doing)?|what'?s up|sup)"
+    r"(?:\W+(?:mira|there|again|everyone))*\W*$",
+    re.IGNORECASE,
+)
+
+# Words that only come up in questions about Molecule and DeSci
+TOPIC_KEYWORDS = frozenset(
+    {
+        "molecule",
+        "desci",
+        "ipnft",
+        "ipnfts",
+        "ipt",
+        "ipts",
+        "vitadao",
+        "biodao",
+        "biodaos",
+        "bio.xyz",
+        "labdao",
+        "hairdao",
+        "cerebrumdao",
+        "psydao",
+        "cryodao",
+        "athenadao",
+        "valleydao",
+        "tokenize",
+        "tokenization",
+        "tokenizing",
+    }
+)
+
+_TOPIC_PHRASES = re.compile(
+    r"decentrali[sz]ed science|ip[- ]?nft|ip[- ]?tokens?|research (?:funding|dao)|"
+    r"(?:science|biotech|research) dao",
+    re.IGNORECASE,
+)
+
+_WORD = re.compile(r"[\w.]+")
+
+# What an on-topic question is about, compared with the query embedding
+TOPIC_PROTOTYPES = (
+    "What is Molecule and how does it help fund scientific research?",
+    "Decentralized science (DeSci) communities funding biotech research",
+    "Tokenizing intellectual property of research projects as IP-NFTs",
+    "Research DAOs like VitaDAO funding longevity science",
+    "How can a scientist raise funding for a drug discovery project onchain?",
+)
+
+SUFFICIENT = "SUFFICIENT"
+OUT_OF_SCOPE = "INSUFFICIENT_AND_IRRELEVANT"
+
+DECISIONS = Counter(
+    "mira_prerouter_decisions",
+    "Pre-router outcomes; DEFERRED questions go to the LLM evaluator",
+    ["verdict"],
+)
+CHECKS = Counter(
+    "mira_prerouter_checks",
+    "Pre-router verdicts compared against the LLM evaluator",
+    ["verdict", "agreed"],
+)
+
+
+class PreRouter:
+    """Decides clear-cut questions locally, before the LLM evaluator.
+
+    Small talk is out of scope. A question about Molecule/DeSci whose top
+    retrieved chunks have high hybrid (RRF) scores is SUFFICIENT. A question
+    with no topic keyword, low similarity to the topic and weak retrieval is
+    out of scope. Everything else returns None and goes to the evaluator.
+
+    The score thresholds are tuned to the RRF scores of the default
+    reranker. Other rerankers score on other scales (the cross-encoder
+    returns raw logits), so with any other `reranker` the score rules are
+    turned off and only small talk is decided locally.
+
+    Topic decisions are only made for first questions, since a follow-up
+    like "tell me more" depends on the conversation. A `check_rate` share of
+    the local verdicts is still sent to the evaluator to measure agreement,
+    1.0 runs in shadow mode.
+    """
+
+    def __init__(
+        self,
+        # RRF scores: 1/(60 + rank) summed over the vector and full-text ranks
+        sufficient_score: float = 0.032,
+        supporting_score: float = 0.025,
+        supporting_documents: int = 3,
+        out_of_scope_score: float = 0.03,
+        off_topic_similarity: float = 0.15,
+        check_rate: float = 0.0,
+        reranker: str = "rrf",
+    ):
+        self.score_rules = reranker == "rrf"
+        if not self.score_rules:
+            logger.warning(
+                "⚠️ Pre-router score thresholds are tuned for RRF, not '%s'; "
+                "only small talk is decided locally",
+                reranker,
+            )
+        self.sufficient_score = sufficient_score
+        self.supporting_score = supporting_score
+        self.supporting_documents = supporting_documents
+        self.out_of_scope_score = out_of_scope_score
+        self.off_topic_similarity = off_topic_similarity
+        self.check_rate = check_rate
+        self._prototypes = None
+        self.stats = {
+            "decided": 0,
+            "deferred": 0,
+            "checked": 0,
+            "agreed": 0,
+        }
+
+    @property
+    def agreement_rate(self) -> float:
+        checked = self.stats["checked"]
+        return self.stats["agreed"] / checked if checked else 0.0
+
+    def _has_topic_keyword(self, query: str) -> bool:
+        if _TOPIC_PHRASES.search(query):
+            return True
+        words = {w.strip(".").lower() for w in _WORD.findall(query)}
+        return not words.isdisjoint(TOPIC_KEYWORDS)
+
+    async def _topic_similarity(self, query: str, embed_query, query_vector) -> float:
+        if self._prototypes is None:
+            vectors = [
+                await run_blocking(embed_query, text) for text in TOPIC_PROTOTYPES
+            ]
+            self._prototypes = np.stack([normalize_vector(v) for v in vectors])
+        if query_vector is None:
+            query_vector = await run_blocking(embed_query, query)
+        return float(np.max(self._prototypes @ normalize_vector(query_vector)))
+
+    async def route(
+        self,
+        query: str,
+        documents: list,
+        embed_query,
+        query_vector=None,
+        has_history: bool = False,
+    ):
+        """Return a verdict for a clear-cut question, or None to ask the evaluator.
+
+        Args:
+            query: User's question
+            documents: Retrieved ContextDocument list, best first
+            embed_query: Blocking callable embedding a text
+            query_vector: The question's embedding, if already computed
+            has_history: Whether the question follows earlier turns
+
+        Returns:
+            tuple: (verdict or None, reason)
+        """
+        verdict, reason = None, "ambiguous"
+
+        if _SMALL_TALK.match(query):
+            verdict, reason = OUT_OF_SCOPE, "small_talk"
+        elif not has_history and self.score_rules:
+            scores = [d.score or 0.0 for d in documents]
+            top_score = max(scores, default=0.0)
+            supporting = sum(s >= self.supporting_score for s in scores)
+
+            if self._has_topic_keyword(query):
+                if (
+                    top_score >= self.sufficient_score
+                    and supporting >= self.supporting_documents
+                ):
+                    verdict, reason = SUFFICIENT, "keyword_and_retrieval"
+            elif top_score < self.out_of_scope_score:
+                similarity = await self._topic_similarity(
+                    query, embed_query, query_vector
+                )
+                if similarity < self.off_topic_similarity:
+                    verdict, reason = OUT_OF_SCOPE, "off_topic"
+
+        if verdict is None:
+            self.stats["deferred"] += 1
+            DECISIONS.inc(verdict="DEFERRED")
+        else:
+            self.stats["decided"] += 1
+            DECISIONS.inc(verdict=verdict)
+        logger.debug("🚦 Pre-router: %s (%s)", verdict or "deferred", reason)
+
+        return verdict, reason
+
+    def should_check(self) -> bool:
+        """Whether to also ask the evaluator about a locally decided question."""
+        return self.check_rate > 0 and random.random() < self.check_rate
+
+    def record_check(self, query: str, verdict: str, reason: str, llm_verdict: str):
+        """Compare a local verdict with the evaluator's, for tuning thresholds."""
+        agreed = verdict == llm_verdict
+        self.stats["checked"] += 1
+        self.stats["agreed"] += agreed
+        CHECKS.inc(verdict=verdict, agreed=str(agreed).lower())
+
+        if not agreed:
+            logger.info(
+                "🚦 Pre-router disagreed (%s): %s vs evaluator %s for '%s...'",
+                reason,
+                verdict,
+                llm_verdict,
+                query[:100],
+            )
+        logger.debug(
+            "🚦 Pre-router agreement %.1f%% over %d checks",
+            self.agreement_rate * 100,
+            self.stats["checked"],
+        )
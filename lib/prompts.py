@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import time
+
+from lib.executor import run_blocking
+
+logger = logging.getLogger(__name__)
+
+# Every Langfuse prompt the app compiles while answering a question
+PROMPT_NAMES = (
+    "Simple Q&A prompt",
+    "Local-Or-Websearch-Eval",
+    "Websearch-Prompt",
+)
+
+
+class PromptRegistry:
+    """In-memory Langfuse prompts, prefetched once and refreshed in the background.
+
+    Prompts are served from memory. Once a prompt is older than `ttl` seconds
+    the next lookup still returns it but schedules a refresh. If Langfuse is
+    slow or down the last good version keeps being served.
+    """
+
+    def __init__(self, langfuse, names=PROMPT_NAMES, ttl: float = 60):
+        self.langfuse = langfuse
+        self.names = names
+        self.ttl = ttl
+        self._prompts = {}
+        self._fetched_at = {}
+        self._refreshing = {}
+
+    def _fetch(self, name: str):
+        # Bypass the SDK's own cache, freshness is handled here
+        prompt = self.langfuse.get_prompt(name, cache_ttl_seconds=0)
+        self._prompts[name] = prompt
+        self._fetched_at[name] = time.monotonic()
+        return prompt
+
+    def prefetch(self, names=None) -> dict:
+        """Fetch `names`, by default every known prompt.
+
+        Failures are logged and retried on first use.
+
+        Returns:
+            dict: Error message of each prompt that could not be fetched
+        """
+        failed = {}
+        for name in names or self.names:
+            try:
+                self._fetch(name)
+            except Exception as e:
+                logger.warning("⚠️ Could not prefetch prompt '%s': %s", name, e)
+                failed[name] = str(e)
+        return failed
+
+    async def _refresh(self, name: str):
+        try:
+            await run_blocking(self._fetch, name)
+            logger.debug("🔄 Refreshed prompt '%s'", name)
+        except Exception as e:
+            logger.warning(
+                "⚠️ Prompt refresh failed for '%s', keeping last good: %s", name, e
+            )
+        finally:
+            del self._refreshing[name]
+
+    async def get(self, name: str):
+        """Return a prompt, fetching it only if no version has been loaded yet.
+
+        Args:
+            name: Langfuse prompt name
+
+        Returns:
+            The Langfuse prompt client
+        """
+        prompt = self._prompts.get(name)
+
+        if prompt is None:
+            return await run_blocking(self._fetch, name)
+
+        age = time.monotonic() - self._fetched_at[name]
+        if age > self.ttl and name not in self._refreshing:
+            self._refreshing[name] = asyncio.create_task(self._refresh(name))
+
+        return prompt
@@ -0,0 +1,80 @@
+import re
+import unicodedata
+from functools import lru_cache
+
+_WHITESPACE = re.compile(r"\s+")
+
+# An apostrophe ending a word, with a possessive or contraction suffix
+_SUFFIX = re.compile(r"(?<=\w)['’‘`´](?:s|t|re|ve|ll|d|m)?\b")
+
+_TOKEN = re.compile(r"[^\W_]+")
+
+# Other spellings of known DeSci terms, as normalized tokens. A match adds
+# the other spellings to the full-text query. Definitions ("intellectual
+# property", "decentralized science") are left out on purpose: they pull in
+# loosely related chunks and lowered recall in `bench.retrieval`.
+SYNONYMS = {
+    "ipnft": "ip nft",
+    "ipnfts": "ip nfts",
+    "ip nft": "ipnft",
+    "ip nfts": "ipnfts",
+    "ipt": "ip token",
+    "ipts": "ip tokens",
+    "ip token": "ipt",
+    "ip tokens": "ipts",
+    "vitadao": "vita dao",
+    "vita dao": "vitadao",
+    "biodao": "bio dao",
+    "bio dao": "biodao",
+    "biodaos": "bio daos",
+    "bio daos": "biodaos",
+}
+
+# Precomputed from SYNONYMS: token tuple -> tokens to add
+_EXPANSIONS = {
+    tuple(key.split()): tuple(value.split()) for key, value in SYNONYMS.items()
+}
+_LONGEST_KEY = max(len(key) for key in _EXPANSIONS)
+
+
+def normalize_query(query: str) -> str:
+    """Unicode- and case-normalized text under which equal questions match."""
+    query = unicodedata.normalize("NFKC", query)
+    return _WHITESPACE.sub(" ", query).strip().casefold()
+
+
+def _fold(text: str) -> str:
+    # Same as the index's ASCII folding: é -> e, ö -> o
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+@lru_cache(maxsize=4096)
+def prepare_fts_query(query: str, expand: bool = True) -> str:
+    """Turn a question into plain search terms for the full-text index.
+
+    The text is Unicode-, case- and accent-normalized and split into word
+    tokens like the index tokenizer does, without possessive and
+    contraction suffixes ("Molecule's" -> "molecule"). Only the tokens are
+    kept, so quotes, operators and other query syntax can't change the
+    meaning of the query or make it fail. With `expand`, known DeSci terms
+    add their other spellings from SYNONYMS.
+
+    Returns:
+        str: Space-separated tokens, empty if the query has no words
+    """
+    text = _SUFFIX.sub("", _fold(normalize_query(query)))
+    tokens = _TOKEN.findall(text)
+    if not expand:
+        return " ".join(tokens)
+
+    terms = list(tokens)
+    seen = set(tokens)
+    for start in range(len(tokens)):
+        for length in range(1, _LONGEST_KEY + 1):
+            expansion = _EXPANSIONS.get(tuple(tokens[start : start + length]))
+            for token in expansion or ():
+                if token not in seen:
+                    seen.add(token)
+                    terms.append(token)
+    return " ".join(terms)
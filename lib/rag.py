@@ -1,99 +1,414 @@
+import asyncio
+import functools
+import logging
 import os
+import re
+import time
 
-import lancedb
-from lancedb.rerankers import RRFReranker
 from langfuse import Langfuse, observe
-from langfuse.openai import OpenAI
+from langfuse.openai import AsyncOpenAI
+from openai import RateLimitError
+
+from lib.admission import AdmissionController, estimate_tokens, without_session
+from lib.answer_cache import SemanticAnswerCache
+from lib.coalescing import AnswerCoalescer
+from lib.concurrency import AdaptiveConcurrency, retry_delay
+from lib.context_budget import ContextBudget
+from lib.executor import run_blocking
+from lib.knowledge import KnowledgeVersionWatcher
+from lib.metrics import (
+    ANSWER_SECONDS,
+    ROUTE_DECISIONS,
+    SPECULATION_SECONDS_SAVED,
+    SPECULATION_WASTED_CALLS,
+    SPECULATION_WASTED_TOKENS,
+    SPECULATIONS,
+    TIME_TO_FIRST_TOKEN_SECONDS,
+    WEB_SEARCH_ANSWERS,
+    StageTimer,
+    capture_stages,
+    observe_stage,
+    record_usage,
+    time_stage,
+)
+from lib.prerouter import PreRouter
+from lib.prompts import PROMPT_NAMES, PromptRegistry
+from lib.query import normalize_query
+from lib.reranking import RelevanceCutoff
+from lib.startup import StartupProfile
+from lib.tracing import (
+    TraceBuffer,
+    parse_sample_rates,
+    sampled_tracer_provider,
+    trace_route,
+)
+from lib.transport import HttpTransport
+from lib.trusted_sources import TrustedDomainMatcher
+
+logger = logging.getLogger(__name__)
+
+DB_URI = "s3://mol-mira-v0"
+
+# Loaded in the background by a lazy RAG, see `RAG.startup`
+STARTUP_COMPONENTS = ("knowledge_base", "tokenizer", "prompts")
+
+# Only needed for web search answers, so fetched on first use
+_ON_DEMAND_PROMPTS = ("Websearch-Prompt",)
+
+# Rewrites a web search answer to the trusted sources it cites
+TRUSTED_SOURCES_FILTER_PROMPT = """You are tasked with filtering an answer to only include information that can be verified from trusted sources.
+
+You have been provided with:
+1. An original answer that may contain information from various sources
+2. A list of TRUSTED sources that you should use
+3. The original user query
+
+Your task is to rewrite the answer to ONLY include information that can be attributed to the trusted sources listed below.
+
+IMPORTANT RULES:
+- Only include facts, claims, or information that come from the trusted sources
+- Do not include any information from sources not in the trusted list
+- Maintain the helpful tone and structure of the original answer
+- If the trusted sources don't contain enough information to fully answer the query, acknowledge this limitation
+- Always cite the trusted sources when making claims
+
+TRUSTED SOURCES:
+{trusted_sources}
+
+ORIGINAL QUERY:
+{query}
+
+ORIGINAL ANSWER TO FILTER:
+{original_answer}
+
+Please provide a filtered answer that only uses information from the trusted sources listed above:"""
+
+# Splits a cached answer into word-sized tokens to replay it as a stream
+_ANSWER_CHUNK = re.compile(r"\S+\s*|\s+")
 
 
 class RAG:
-    def __init__(self, model="gpt-4o", temperature=0.6):
-        self.db = lancedb.connect(
-            "s3://mol-mira-v0",
-            storage_options={
-                "aws_access_key_id": os.getenv("DO_SPACES_ACCESS_KEY_ID"),
-                "aws_secret_access_key": os.getenv("DO_SPACES_SECRET_ACCESS_KEY"),
-                "aws_endpoint": "https://fra1.digitaloceanspaces.com",
-                "aws_region": "fra1",
-            },
+    """Agentic RAG over the LanceDB knowledge base.
+
+    Unless `lazy`, the knowledge base and prompts are loaded when the RAG is
+    created. A lazy RAG only sets up its clients and loads them, and the
+    tokenizer, in the background once `start()` is called, so a server comes
+    up before S3 or Langfuse respond; answering waits until the knowledge
+    base is open and the tokenizer is loaded. The web search prompt and trusted domains are loaded on
+    first use.
+    """
+
+    def __init__(
+        self,
+        model="gpt-4o",
+        temperature=0.6,
+        speculative=False,
+        prompt_ttl=60,
+        local_mirror_path=None,
+        answer_cache: SemanticAnswerCache = None,
+        coalescer: AnswerCoalescer = None,
+        knowledge_refresh_interval=30,
+        context_budget: ContextBudget = None,
+        db_uri=None,
+        prerouter: PreRouter = None,
+        transport: HttpTransport = None,
+        admission: AdmissionController = None,
+        reranker="rrf",
+        cutoff: RelevanceCutoff = None,
+        retrieval_candidates: int = None,
+        lazy=False,
+    ):
+        # One set of connection pools for OpenAI, Langfuse and S3
+        self.transport = transport or HttpTransport.from_env()
+        self.storage_options = {
+            "aws_access_key_id": os.getenv("DO_SPACES_ACCESS_KEY_ID"),
+            "aws_secret_access_key": os.getenv("DO_SPACES_SECRET_ACCESS_KEY"),
+            "aws_endpoint": "https://fra1.digitaloceanspaces.com",
+            "aws_region": "fra1",
+            **self.transport.storage_options(),
+        }
+        # A local path works as well, e.g. for benchmarks and load tests
+        self.db_uri = db_uri or os.getenv("RAG_DB_URI", DB_URI)
+        # Optionally search a local copy of the knowledge base instead of S3
+        self.local_mirror_path = local_mirror_path or os.getenv("RAG_LOCAL_MIRROR_PATH")
+        # A `make_reranker` name or a reranker
+        self.reranker = reranker
+        self.cutoff = cutoff
+        self.retrieval_candidates = retrieval_candidates
+        self.knowledge = KnowledgeVersionWatcher(
+            self._read_knowledge_version, interval=knowledge_refresh_interval
         )
-        self.table = self.db.open_table("molrag")
-        self.config_table = self.db.open_table("config")
-        self.reranker = RRFReranker()
+        # Set by `_open_knowledge_base`
+        self.db = None
+        self.config_table = None
+        self.local_mirror = None
+        self.retriever = None
+        self._mirror_sync = None
+
+        self.context_budget = context_budget or ContextBudget(model=model)
         self.client_settings = {
             "model": model,
             "temperature": temperature,
         }
-        self.client = OpenAI()
-        self.langfuse = Langfuse(blocked_instrumentation_scopes=["chainlit"])
-        self.langfuse_prompt = self.langfuse.get_prompt("Simple Q&A prompt")
-
-        # self.table.create_fts_index("text", replace=True)
-
-    def get_knowledge_version(self):
-        knowledge_version_result = (
-            self.config_table.search().where("key = 'knowledge_version'").to_pandas()
+        self.client = AsyncOpenAI(**self.transport.openai_options())
+        # Every chat completion waits for admission, see `_complete`
+        self.admission = admission or AdmissionController.from_env()
+        # Per-route head sampling, e.g. RAG_TRACE_SAMPLE_RATES=chat=0.1,batch=1
+        sample_rates = parse_sample_rates(os.getenv("RAG_TRACE_SAMPLE_RATES", ""))
+        self.langfuse = Langfuse(
+            blocked_instrumentation_scopes=["chainlit"],
+            httpx_client=self.transport.langfuse_client,
+            tracer_provider=(
+                sampled_tracer_provider(sample_rates) if sample_rates else None
+            ),
         )
-        if not knowledge_version_result.empty:
-            return "knowledge-" + knowledge_version_result.iloc[0]["value"]
-        else:
-            return "N/A (Error)"
-
-    @observe()
-    def get_context(self, query: str, num_results: int = 8):
-        """Search the database for relevant context.
+        # Trace updates and scores, sent in the background
+        self.tracing = TraceBuffer.from_env(self.langfuse)
+        self.prompts = PromptRegistry(self.langfuse, ttl=prompt_ttl)
+
+        # Speculative mode starts the local answer while the evaluator runs
+        self.speculative = speculative
+        self.speculation_stats = {
+            "hits": 0,
+            "misses": 0,
+            "seconds_saved": 0.0,
+            "wasted_tokens": 0,
+        }
 
-        Args:
-            query: User's question
-            table: LanceDB table object
-            num_results: Number of results to return
+        # Answers to first questions, reused for near-duplicate questions
+        self.answer_cache = answer_cache
+
+        # Identical first questions in flight share one answer
+        self.coalescer = coalescer
+
+        # Decides clear-cut questions without the LLM evaluator
+        self.prerouter = prerouter
+
+        self.knowledge.subscribe(self._on_knowledge_version_change)
+
+        self.startup = StartupProfile(STARTUP_COMPONENTS)
+        self._ready = asyncio.Event()
+        self._warm_up = None
+        if not lazy:
+            self._open_knowledge_base()
+            self._load_tokenizer()
+            self._prefetch_prompts(PROMPT_NAMES)
+            self._ready.set()
+
+    @functools.cached_property
+    def trusted_domains(self):
+        """Domains web search answers may be based on."""
+        return TrustedDomainMatcher()
+
+    def _open_knowledge_base(self):
+        with self.startup.measure("knowledge_base", "import"):
+            # LanceDB pulls in pyarrow and pandas, a large share of startup
+            import lancedb
+
+            from lib.local_mirror import LocalMirror
+            from lib.reranking import make_reranker
+            from lib.retrieval import Retriever
+
+        with self.startup.measure("knowledge_base"):
+            self.db = lancedb.connect(self.db_uri, storage_options=self.storage_options)
+            self.config_table = self.db.open_table("config")
+            self.knowledge.load()
+
+            if self.local_mirror_path:
+                self.local_mirror = LocalMirror(
+                    self.db_uri, self.storage_options, self.local_mirror_path
+                )
+                if self.local_mirror.synced_version != self.knowledge.version:
+                    self.local_mirror.sync(self.knowledge.version)
+                table = self.local_mirror.open_table("molrag")
+            else:
+                table = self.db.open_table("molrag")
+
+            reranker = self.reranker
+            if isinstance(reranker, str):
+                reranker = make_reranker(reranker)
+            self.retriever = Retriever(
+                table,
+                self.context_budget,
+                reranker=reranker,
+                cutoff=self.cutoff,
+                candidates=self.retrieval_candidates,
+            )
 
-        Returns:
-            str: Concatenated context from relevant chunks with source information
-        """
+    def _load_tokenizer(self):
+        with self.startup.measure("tokenizer"):
+            # Downloads the BPE file on a cold start
+            loaded = self.context_budget.load()
+        if not loaded and self.context_budget.model is not None:
+            self.startup.degrade(
+                "tokenizer",
+                f"no tokenizer for {self.context_budget.model}, estimating tokens",
+            )
 
-        # Sanitize the query to handle apostrophes and backticks
-        # TODO: Find a more robust solution
-        sanitized_query = query.replace("'", "").replace("`", "")
+    def _prefetch_prompts(self, names):
+        with self.startup.measure("prompts"):
+            failed = self.prompts.prefetch(names)
+        if failed:
+            # Still fetched on first use, so answering may work once Langfuse does
+            self.startup.degrade(
+                "prompts",
+                "; ".join(f"{name}: {error}" for name, error in failed.items()),
+            )
 
-        results = (
-            self.table.search(
-                sanitized_query,
-                query_type="hybrid",
-                vector_column_name="vector",
-                fts_columns="text",
+    @property
+    def ready(self) -> bool:
+        """Whether the knowledge base and tokenizer are loaded and questions
+        can be answered."""
+        return self._ready.is_set()
+
+    def start(self):
+        """Warm up in the background; a no-op if started already or not lazy."""
+        if self._warm_up is None and not self.ready:
+            self._warm_up = asyncio.create_task(self._warm_up_components())
+
+    async def wait_until_ready(self):
+        """Start warming up if needed and wait for the knowledge base and
+        tokenizer."""
+        self.start()
+        await self._ready.wait()
+
+    async def warmed_up(self):
+        """Wait until every component, not only the knowledge base, is loaded."""
+        if self._warm_up is not None:
+            await self._warm_up
+
+    async def _warm_up_components(self):
+        started = time.perf_counter()
+        # Token counting needs the tokenizer, so answering waits for it too
+        tokenizer = asyncio.ensure_future(run_blocking(self._load_tokenizer))
+        prompts = asyncio.ensure_future(
+            run_blocking(
+                self._prefetch_prompts,
+                [name for name in PROMPT_NAMES if name not in _ON_DEMAND_PROMPTS],
             )
-            .rerank(self.reranker)
-            .limit(num_results)
-            .to_pandas()
         )
 
-        contexts = []
+        attempt = 0
+        while True:
+            try:
+                await run_blocking(self._open_knowledge_base)
+                break
+            except Exception as e:
+                # Keep the server up, it reports not ready until this works
+                delay = min(2**attempt, 30)
+                attempt += 1
+                logger.warning(
+                    "⚠️ Opening the knowledge base failed, retrying in %ds: %s",
+                    delay,
+                    e,
+                )
+                await asyncio.sleep(delay)
+        await asyncio.gather(tokenizer, return_exceptions=True)
+        self._ready.set()
+        self.knowledge.start()
+        logger.info("✅ Ready in %.2fs", time.perf_counter() - started)
+
+        await asyncio.gather(prompts, return_exceptions=True)
+        if os.getenv("RAG_STARTUP_PROFILE", "false").lower() == "true":
+            logger.info("⏱️ Startup profile:\n%s", self.startup.format())
+
+    async def close(self):
+        """Stop background work and flush pending traces."""
+        if self._warm_up is not None:
+            self._warm_up.cancel()
+            await asyncio.gather(self._warm_up, return_exceptions=True)
+        await self.knowledge.stop()
+        await self.tracing.close()
+        await run_blocking(self.langfuse.flush)
+
+    def _read_knowledge_version(self):
+        # Tables don't pick up writes from other processes on their own
+        self.config_table.checkout_latest()
+        knowledge_version_result = (
+            self.config_table.search()
+            .where("key = 'knowledge_version'")
+            .select(["value"])
+            .limit(1)
+            .to_list()
+        )
+        if knowledge_version_result:
+            return "knowledge-" + knowledge_version_result[0]["value"]
+        else:
+            return "N/A (Error)"
+
+    @property
+    def table(self):
+        return self.retriever.table
 
-        for _, row in results.iterrows():
-            context = "<document>"
+    @property
+    def knowledge_version(self):
+        return self.knowledge.version
 
-            url = row["metadata"]["url"]
-            title = row["metadata"]["page_title"]
-            source = row["metadata"]["source"]
+    async def get_knowledge_version(self):
+        """Return the current knowledge version without any I/O.
 
-            if title:
-                context += f"\nTitle: {title}"
+        The version is kept up to date by a background watcher, which is
+        started on first use.
+        """
+        await self.wait_until_ready()
+        self.knowledge.start()
+        return self.knowledge.version
 
-            if source:
-                context += f"\nSource: {source}"
+    def _on_knowledge_version_change(self, old_version: str, new_version: str):
+        if self.answer_cache is not None:
+            self.answer_cache.invalidate()
 
-            if url:
-                context += f"\nURL: {url}"
+        if (
+            self.local_mirror is not None
+            and new_version != "N/A (Error)"
+            and self._mirror_sync is None
+        ):
+            self._mirror_sync = asyncio.create_task(self._sync_local_mirror())
+
+    async def _sync_local_mirror(self):
+        """Resync the local mirror in the background and switch searches to it."""
+        try:
+            while (knowledge_version := self.knowledge.version) not in (
+                self.local_mirror.synced_version,
+                "N/A (Error)",
+            ):
+                try:
+                    logger.info(
+                        "🪞 Knowledge base changed, syncing %s", knowledge_version
+                    )
+                    await run_blocking(self.local_mirror.sync, knowledge_version)
+                    self.retriever.table = await run_blocking(
+                        self.local_mirror.open_table, "molrag"
+                    )
+                except Exception as e:
+                    # Keep searching the previous copy and retry after a poll interval
+                    logger.warning("⚠️ Local mirror sync failed: %s", e)
+                    await asyncio.sleep(self.knowledge.interval)
+        finally:
+            self._mirror_sync = None
 
-            contexts.append(context + "\nContent: " + row["text"] + "\n</document>\n")
+    @observe()
+    async def get_context(self, query: str, num_results: int = 8, query_vector=None):
+        """Search the database for relevant context.
 
-        final_context = "\n\n".join(contexts)
+        Args:
+            query: User's question
+            num_results: Most results to return
+            query_vector: The question's embedding, if already computed
 
-        return [final_context, results]
+        Returns:
+            list: [context, documents] with the concatenated context from relevant
+                chunks with source information, and the list of ContextDocument
+        """
+        await self.wait_until_ready()
+        context_data = await self.retriever.get_context(
+            query, num_results, query_vector=query_vector
+        )
+        self.langfuse.update_current_span(metadata={"chunks": len(context_data[1])})
+        return context_data
 
     @observe()
-    def evaluate_context_and_relevance(self, query: str, context: str) -> str:
+    async def evaluate_context_and_relevance(self, query: str, context: str) -> str:
         """Evaluate if the retrieved context is sufficient and/or if the query is relevant to Molecule/DeSci.
 
         Args:
@@ -104,11 +419,12 @@ class RAG:
             str: One of "SUFFICIENT", "INSUFFICIENT_BUT_RELEVANT", "INSUFFICIENT_AND_IRRELEVANT"
         """
 
-        print(
-            f"🔍 [DEBUG] Evaluating context sufficiency and relevance for query: '{query[:100]}...'"
+        logger.debug(
+            "🔍 Evaluating context sufficiency and relevance for query: '%s...'",
+            query[:100],
         )
 
-        langfuse_eval_prompt = self.langfuse.get_prompt("Local-Or-Websearch-Eval")
+        langfuse_eval_prompt = await self.prompts.get("Local-Or-Websearch-Eval")
         compiled_eval_prompt = langfuse_eval_prompt.compile(
             query=query, context=context
         )
@@ -120,13 +436,17 @@ class RAG:
             }
         ]
 
-        response = self.client.chat.completions.create(
-            messages=messages,
-            model="gpt-4o",
-            temperature=0.1,  # Low temperature for consistent evaluation
-            max_tokens=50,  # Allow slightly more tokens for reasoning
-            langfuse_prompt=langfuse_eval_prompt,
-        )
+        with StageTimer("evaluation") as timer:
+            response = await self._complete(
+                "evaluation",
+                timer,
+                messages=messages,
+                model="gpt-4o",
+                temperature=0.1,  # Low temperature for consistent evaluation
+                max_tokens=50,  # Allow slightly more tokens for reasoning
+                langfuse_prompt=langfuse_eval_prompt,
+            )
+        record_usage("gpt-4o", response.usage)
 
         result = response.choices[0].message.content.strip().upper()
 
@@ -139,17 +459,49 @@ class RAG:
             "INSUFFICIENT_BUT_RELEVANT",
             "INSUFFICIENT_AND_IRRELEVANT",
         ]:
-            print(
-                f"⚠️ [DEBUG] Unexpected evaluation result: {result}, defaulting to INSUFFICIENT_AND_IRRELEVANT"
+            logger.warning(
+                "⚠️ Unexpected evaluation result: %s, defaulting to INSUFFICIENT_AND_IRRELEVANT",
+                result,
             )
             result = "INSUFFICIENT_AND_IRRELEVANT"
 
-        print(f"📊 [DEBUG] Context and relevance evaluation result: {result}")
+        logger.debug("📊 Context and relevance evaluation result: %s", result)
 
         return result
 
-    @observe()
-    def generate_web_search_answer(
+    async def _complete(self, priority: str, timer: StageTimer = None, **request):
+        """Create a chat completion once the admission controller admits it.
+
+        Args:
+            priority: "evaluation" or "generation"
+            timer: Times the call itself, without the wait for admission,
+                which is recorded as the `admission` stage
+            **request: Arguments of `chat.completions.create`
+
+        Raises:
+            AdmissionRejected: The call was not admitted
+        """
+        model = request["model"]
+        started = time.perf_counter()
+        try:
+            await self.admission.admit(
+                model,
+                priority,
+                estimate_tokens(request["messages"], request.get("max_tokens")),
+            )
+        finally:
+            observe_stage("admission", time.perf_counter() - started)
+        try:
+            if timer is None:
+                return await self.client.chat.completions.create(**request)
+            with timer.running():
+                return await self.client.chat.completions.create(**request)
+        except RateLimitError as e:
+            # Left over after the client's own retries: hold everyone's calls
+            self.admission.throttle(model, retry_delay(e, 0))
+            raise
+
+    async def generate_web_search_answer(
         self, query: str, message_history: list = None
     ) -> str:
         """Generate an answer using OpenAI's web search when local context is insufficient.
@@ -161,29 +513,54 @@ class RAG:
         Returns:
             str: Answer generated using web search
         """
+        return "".join(
+            [
+                token
+                async for token in self.stream_web_search_answer(query, message_history)
+            ]
+        )
+
+    @observe()
+    async def stream_web_search_answer(self, query: str, message_history: list = None):
+        """Stream an answer based on web search results from trusted sources.
+
+        The search answer is only complete once its citations are known. If
+        every citation is from a trusted domain it is sent as is, otherwise it
+        is rewritten to the trusted sources and the rewrite is streamed.
+
+        Args:
+            query: User's question
+            message_history: Previous conversation messages
+
+        Yields:
+            str: Pieces of the answer as they arrive
+        """
 
-        print(f"🔎 [DEBUG] Performing web search for query: '{query[:100]}...'")
+        logger.debug("🔎 Performing web search for query: '%s...'", query[:100])
 
         # Ensure message_history is a list and handle None case
         if message_history is None:
             message_history = []
 
-        print(f"🔍 [DEBUG] Web search message history length: {len(message_history)}")
+        logger.debug("🔍 Web search message history length: %d", len(message_history))
 
-        websearch_prompt = self.langfuse.get_prompt("Websearch-Prompt")
+        websearch_prompt = await self.prompts.get("Websearch-Prompt")
         compiled_websearch_prompt = websearch_prompt.compile(
             query=query,
         )
 
         # Prepare messages: include conversation history if available
-        messages = []
+        history = []
         if message_history and len(message_history) > 0:
             # Validate message history format
             for msg in message_history:
                 if isinstance(msg, dict) and "role" in msg and "content" in msg:
-                    messages.append(msg)
+                    history.append(msg)
                 else:
-                    print(f"⚠️ [DEBUG] Skipping invalid message in history: {msg}")
+                    logger.warning("⚠️ Skipping invalid message in history: %s", msg)
+
+        # Keep the most recent turns within the history token budget
+        messages = self.context_budget.window_history(history)
 
         messages.append(
             {
@@ -192,199 +569,666 @@ class RAG:
             }
         )
 
-        response = self.client.chat.completions.create(
-            model="gpt-4o-search-preview",
-            web_search_options={},
-            messages=messages,
-            langfuse_prompt=websearch_prompt,
-        )
+        with StageTimer("web_search") as timer:
+            response = await self._complete(
+                "generation",
+                timer,
+                model="gpt-4o-search-preview",
+                web_search_options={},
+                messages=messages,
+                langfuse_prompt=websearch_prompt,
+            )
+        record_usage("gpt-4o-search-preview", response.usage)
 
         answer = response.choices[0].message.content
 
-        # Log annotations if present
-        trusted_domains = [
-            "molecule.to",
-            "molecule.xyz",
-            "bio.xyz",
-            "vitadao.com",
-        ]
         trusted_sources = []
-
-        if (
-            hasattr(response.choices[0].message, "annotations")
-            and response.choices[0].message.annotations
-        ):
-            print(
-                f"📎 [DEBUG] Found {len(response.choices[0].message.annotations)} annotations in web search response:"
+        untrusted_citations = 0
+
+        annotations = getattr(response.choices[0].message, "annotations", None) or []
+        logger.debug("📎 Found %d annotations in web search response", len(annotations))
+        for i, annotation in enumerate(annotations):
+            if annotation.type != "url_citation" or not hasattr(
+                annotation, "url_citation"
+            ):
+                continue
+
+            citation = annotation.url_citation
+            domain = self.trusted_domains.match(citation.url)
+            logger.debug(
+                "📌 Citation %d: %s (%s) [%s:%s] %s",
+                i + 1,
+                citation.url,
+                citation.title,
+                citation.start_index,
+                citation.end_index,
+                "✅ trusted" if domain else "❌ untrusted",
             )
-            for i, annotation in enumerate(response.choices[0].message.annotations):
-                if annotation.type == "url_citation" and hasattr(
-                    annotation, "url_citation"
-                ):
-                    citation = annotation.url_citation
-                    print(f"  📌 Citation {i + 1}:")
-                    print(f"     - URL: {citation.url}")
-                    print(f"     - Title: {citation.title}")
-                    print(
-                        f"     - Text range: [{citation.start_index}:{citation.end_index}]"
-                    )
 
-                    # Check if the citation is from a trusted domain
-                    from urllib.parse import urlparse
-
-                    parsed_url = urlparse(citation.url)
-                    domain = parsed_url.netloc.lower()
-
-                    # Remove www. prefix if present
-                    if domain.startswith("www."):
-                        domain = domain[4:]
-
-                    if any(trusted in domain for trusted in trusted_domains):
-                        trusted_sources.append(
-                            {
-                                "url": citation.url,
-                                "title": citation.title,
-                                "start_index": citation.start_index,
-                                "end_index": citation.end_index,
-                                "domain": domain,
-                            }
-                        )
-                        print(f"     ✅ TRUSTED DOMAIN: {domain}")
-                    else:
-                        print(f"     ❌ UNTRUSTED DOMAIN: {domain}")
-        else:
-            print("📎 [DEBUG] No annotations found in web search response")
+            if domain is None:
+                untrusted_citations += 1
+                continue
+
+            trusted_sources.append(
+                {
+                    "url": citation.url,
+                    "title": citation.title,
+                    "start_index": citation.start_index,
+                    "end_index": citation.end_index,
+                    "domain": domain,
+                }
+            )
 
-        print(
-            f"✨ [DEBUG] Web search completed, found {len(trusted_sources)} trusted sources"
+        logger.debug(
+            "✨ Web search completed, found %d trusted and %d untrusted sources",
+            len(trusted_sources),
+            untrusted_citations,
         )
 
-        # Filter the answer to only include information from trusted sources
-        if trusted_sources:
-            # Create a filter prompt to rewrite the answer with only trusted sources
-            filter_prompt = """You are tasked with filtering an answer to only include information that can be verified from trusted sources.
+        if not trusted_sources:
+            # No trusted sources found, return a message indicating this
+            WEB_SEARCH_ANSWERS.inc(outcome="no_trusted_sources")
+            logger.debug("⚠️ No trusted sources found, returning default message")
+            yield (
+                "Sorry, I couldn't find any information from trusted sources "
+                "regarding your question."
+            )
+            return
 
-You have been provided with:
-1. An original answer that may contain information from various sources
-2. A list of TRUSTED sources that you should use
-3. The original user query
+        if not untrusted_citations:
+            # Everything cited is trusted already, no need to rewrite
+            WEB_SEARCH_ANSWERS.inc(outcome="all_trusted")
+            logger.debug("🔐 All citations are trusted, skipping the rewrite")
+            yield answer
+            return
 
-Your task is to rewrite the answer to ONLY include information that can be attributed to the trusted sources listed below.
+        # Filter the answer to only include information from trusted sources
+        WEB_SEARCH_ANSWERS.inc(outcome="rewritten")
 
-IMPORTANT RULES:
-- Only include facts, claims, or information that come from the trusted sources
-- Do not include any information from sources not in the trusted list
-- Maintain the helpful tone and structure of the original answer
-- If the trusted sources don't contain enough information to fully answer the query, acknowledge this limitation
-- Always cite the trusted sources when making claims
+        # Prepare the trusted sources information
+        trusted_sources_text = "\n".join(
+            [f"- {source['title']} ({source['url']})" for source in trusted_sources]
+        )
 
-TRUSTED SOURCES:
-{trusted_sources}
+        compiled_filter_prompt = TRUSTED_SOURCES_FILTER_PROMPT.format(
+            original_answer=answer,
+            trusted_sources=trusted_sources_text,
+            query=query,
+        )
 
-ORIGINAL QUERY:
-{query}
+        filter_messages = [{"role": "user", "content": compiled_filter_prompt}]
 
-ORIGINAL ANSWER TO FILTER:
-{original_answer}
+        # Leaves out the time the consumer takes between tokens
+        with StageTimer("trusted_filter") as timer:
+            stream = await self._complete(
+                "generation",
+                timer,
+                model="gpt-4o",
+                messages=filter_messages,
+                temperature=0.3,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
 
-Please provide a filtered answer that only uses information from the trusted sources listed above:"""
+            try:
+                parts = aiter(stream)
+                while True:
+                    with timer.running():
+                        part = await anext(parts, None)
+                    if part is None:
+                        break
+                    if part.choices and (token := part.choices[0].delta.content):
+                        yield token
+                    elif part.usage is not None:
+                        record_usage("gpt-4o", part.usage)
+            finally:
+                # Release the connection when the stream is abandoned early
+                await stream.close()
+
+        logger.debug("🔐 Answer filtered to include only trusted sources")
+
+    async def _local_answer_stream(
+        self, query: str, context_str: str, message_history: list, call: dict = None
+    ):
+        """Stream answer tokens generated from the local knowledge base context.
 
-            # Prepare the trusted sources information
-            trusted_sources_text = "\n".join(
-                [f"- {source['title']} ({source['url']})" for source in trusted_sources]
-            )
+        Args:
+            query: User's question
+            context_str: Retrieved context from the knowledge base
+            message_history: Previous conversation messages
+            call: Given `prompt_tokens`, the prompt's token count, once the
+                call is made
 
-            compiled_filter_prompt = filter_prompt.format(
-                original_answer=answer,
-                trusted_sources=trusted_sources_text,
-                query=query,
-            )
+        Yields:
+            str: Pieces of the answer as they arrive
+        """
+        langfuse_prompt = await self.prompts.get("Simple Q&A prompt")
+        dynamic_system_prompt = langfuse_prompt.compile(context=context_str)
 
-            filter_messages = [{"role": "user", "content": compiled_filter_prompt}]
+        # Prepare messages: system prompt + conversation history + current user message
+        messages = [{"role": "system", "content": dynamic_system_prompt}]
 
-            filter_response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=filter_messages,
-                temperature=0.3,
-            )
+        # Add conversation history if available and valid
+        history = []
+        if message_history and len(message_history) > 0:
+            for msg in message_history:
+                if isinstance(msg, dict) and "role" in msg and "content" in msg:
+                    history.append(msg)
+                else:
+                    logger.warning("⚠️ Skipping invalid message in history: %s", msg)
 
-            filtered_answer = filter_response.choices[0].message.content
-            print("🔐 [DEBUG] Answer filtered to include only trusted sources")
+        # Keep the most recent turns within the history token budget
+        messages.extend(self.context_budget.window_history(history))
 
-            return filtered_answer
-        else:
-            # No trusted sources found, return a message indicating this
-            no_trusted_info_message = (
-                "Sorry, I couldn't find any information from trusted sources "
-                "regarding your question."
+        messages.append({"role": "user", "content": query})
+
+        stream = await self._complete(
+            "generation",
+            messages=messages,
+            stream=True,
+            # The last chunk then carries the token counts
+            stream_options={"include_usage": True},
+            langfuse_prompt=langfuse_prompt,  # capture used prompt version in trace
+            **self.client_settings,
+        )
+        if call is not None:
+            # Billed from here on, even if the answer is thrown away
+            call["prompt_tokens"] = sum(
+                self.context_budget.count(message["content"]) for message in messages
             )
-            print("⚠️ [DEBUG] No trusted sources found, returning default message")
-            return no_trusted_info_message
+
+        try:
+            async for part in stream:
+                if part.choices and (token := part.choices[0].delta.content):
+                    yield token
+                elif part.usage is not None:
+                    record_usage(self.client_settings["model"], part.usage)
+        finally:
+            # Release the connection when the stream is abandoned early
+            await stream.close()
+
+    async def _buffer_local_answer(
+        self, query: str, context_str: str, message_history: list, buffer, call: dict
+    ):
+        """Generate the local answer into `buffer` before it is known to be needed.
+
+        A `None` sentinel is always put last, even on failure or cancellation.
+        `call` gets the prompt's token count and `first_token_at`, the time
+        the first token arrived.
+        """
+        try:
+            async for token in self._local_answer_stream(
+                query, context_str, message_history, call
+            ):
+                call.setdefault("first_token_at", time.perf_counter())
+                call["completion_tokens"] = call.get("completion_tokens", 0) + 1
+                buffer.put_nowait(token)
+        finally:
+            buffer.put_nowait(None)
+
+    def _record_speculation(self, hit: bool, seconds_saved: float, wasted_tokens: int):
+        stats = self.speculation_stats
+        stats["hits" if hit else "misses"] += 1
+        stats["seconds_saved"] += seconds_saved
+        stats["wasted_tokens"] += wasted_tokens
+        SPECULATIONS.inc(result="hit" if hit else "miss")
+        SPECULATION_SECONDS_SAVED.inc(seconds_saved)
+        if not hit:
+            SPECULATION_WASTED_CALLS.inc()
+            SPECULATION_WASTED_TOKENS.inc(wasted_tokens)
+
+        logger.debug(
+            "🏎️ Speculation %s: saved %.3fs, wasted %d tokens",
+            "hit" if hit else "miss",
+            seconds_saved,
+            wasted_tokens,
+        )
+        self.langfuse.update_current_span(
+            metadata={
+                "speculation_hit": hit,
+                "speculation_seconds_saved": seconds_saved,
+                "speculation_wasted_tokens": wasted_tokens,
+            }
+        )
 
     @observe()
-    def generate_answer(self, query: str, message_history: list = None):
-        """Generate an answer using agentic RAG approach.
+    async def stream_answer(
+        self, query: str, message_history: list = None, speculative: bool = None
+    ):
+        """Stream an answer using agentic RAG approach.
+
+        Each answer is produced by a single generation; callers render the
+        tokens as they arrive instead of waiting for a complete answer.
+
+        In speculative mode the local answer is generated into a buffer while
+        the evaluator runs. The buffer is released on SUFFICIENT and the
+        generation is cancelled on any other result.
+
+        With an answer cache, a first question that closely matches an earlier
+        one is answered from the cache, replayed as the same events. With a
+        coalescer, a first question asked again while it is being answered
+        (same normalized text and knowledge version) receives the events of
+        that answer instead of starting its own.
 
         Args:
             query: User's question
             message_history: Previous conversation messages
+            speculative: Override the instance's speculative setting
 
-        Returns:
-            tuple: (answer, context_data, used_web_search)
+        Yields:
+            tuple: ("route", result) with the evaluation result, then
+                ("context", context_data), then ("token", str) for each
+                piece of the answer
         """
-        print(f"🚀 [DEBUG] Starting agentic RAG for query: '{query[:100]}...'")
+        logger.debug("🚀 Starting agentic RAG for query: '%s...'", query[:100])
 
         # Ensure message_history is a list and handle None case
         if message_history is None:
             message_history = []
 
-        print(f"🔍 [DEBUG] Message history length: {len(message_history)}")
+        if speculative is None:
+            speculative = self.speculative
+
+        logger.debug("🔍 Message history length: %d", len(message_history))
+
+        # Per asker, also when joining an answer someone else started
+        self.admission.check_session()
+
+        await self.wait_until_ready()
+
+        if message_history:
+            # The answer to a follow-up depends on the conversation
+            async for event in self._answer_pipeline(
+                query, message_history, speculative
+            ):
+                yield event
+            return
+
+        if self.coalescer is None:
+            events = self._first_answer(query, speculative)
+        else:
+            key = (normalize_query(query), self.knowledge_version)
+            if key in self.coalescer:
+                self.langfuse.update_current_span(metadata={"coalesced": True})
+            # Shared by every asker, so its calls count against none of them
+            events = self.coalescer.stream(
+                key, lambda: without_session(self._first_answer(query, speculative))
+            )
+        async for event in events:
+            yield event
+
+    async def _first_answer(self, query: str, speculative: bool):
+        """Yield the events of a first question, through the answer cache."""
+        if self.answer_cache is None:
+            async for event in self._answer_pipeline(query, [], speculative):
+                yield event
+            return
+
+        knowledge_version = self.knowledge_version
+        query_vector = await self.retriever.embed(query)
+        cached = self.answer_cache.lookup(query_vector, knowledge_version)
+        self.langfuse.update_current_span(
+            metadata={"answer_cache_hit": cached is not None}
+        )
+
+        if cached is not None:
+            yield "route", cached["route"]
+            yield "context", cached["context_data"]
+            for token in _ANSWER_CHUNK.findall(cached["answer"]):
+                yield "token", token
+            return
+
+        result = context_data = None
+        tokens = []
+        async for kind, data in self._answer_pipeline(
+            query, [], speculative, query_vector
+        ):
+            if kind == "route":
+                result = data
+            elif kind == "context":
+                context_data = data
+            else:
+                tokens.append(data)
+            yield kind, data
+
+        self.answer_cache.store(
+            query_vector, knowledge_version, "".join(tokens), context_data, result
+        )
+
+    async def _answer_pipeline(
+        self,
+        query: str,
+        message_history: list,
+        speculative: bool,
+        query_vector=None,
+        context_data: list = None,
+    ):
+        """Yield the events of `_answer_events`, recording route and timings."""
+        started = time.perf_counter()
+        route = None
+        first_token = True
+
+        async for kind, data in self._answer_events(
+            query, message_history, speculative, query_vector, context_data
+        ):
+            if kind == "route":
+                route = data
+                ROUTE_DECISIONS.inc(route=route)
+            elif kind == "token" and first_token:
+                first_token = False
+                TIME_TO_FIRST_TOKEN_SECONDS.observe(
+                    time.perf_counter() - started, route=route
+                )
+            yield kind, data
+
+        ANSWER_SECONDS.observe(time.perf_counter() - started, route=route)
+
+    async def _answer_events(
+        self,
+        query: str,
+        message_history: list,
+        speculative: bool,
+        query_vector=None,
+        context_data: list = None,
+    ):
+        """Retrieve, evaluate and answer; yields the events of `stream_answer`.
+
+        `context_data` skips the search when the context was already
+        retrieved, e.g. in a batch.
+        """
 
         # First, get context from local knowledge base
-        context_data = self.get_context(query)
+        if context_data is None:
+            if query_vector is None:
+                # Also used by the pre-router, so it's only embedded once
+                query_vector = await self.retriever.embed(query)
+            context_data = await self.get_context(query, query_vector=query_vector)
         context_str = context_data[0]
 
-        print(
-            f"📚 [DEBUG] Retrieved {len(context_data[1])} documents from local knowledge base"
+        logger.debug(
+            "📚 Retrieved %d documents from local knowledge base", len(context_data[1])
         )
 
-        # Evaluate if context is sufficient and relevant
-        result = self.evaluate_context_and_relevance(query, context_str)
+        verdict = None
+        if self.prerouter is not None:
+            with time_stage("prerouting"):
+                verdict, reason = await self.prerouter.route(
+                    query,
+                    context_data[1],
+                    self.retriever.embed_query,
+                    query_vector,
+                    has_history=bool(message_history),
+                )
+            self.langfuse.update_current_span(
+                metadata={"prerouter_verdict": verdict, "prerouter_reason": reason}
+            )
+        # A sample of local verdicts still goes to the evaluator for comparison
+        checked = verdict is not None and self.prerouter.should_check()
+
+        speculation = None
+        if speculative and (verdict is None or checked):
+            buffer = asyncio.Queue()
+            call = {}
+            speculation_started = time.perf_counter()
+            speculation = asyncio.create_task(
+                self._buffer_local_answer(
+                    query, context_str, message_history, buffer, call
+                )
+            )
+
+        try:
+            if verdict is not None and not checked:
+                result = verdict
+            else:
+                # Evaluate if context is sufficient and relevant
+                result = await self.evaluate_context_and_relevance(query, context_str)
+                if checked:
+                    self.prerouter.record_check(query, verdict, reason, result)
+
+            if speculation is not None:
+                if result == "SUFFICIENT":
+                    # The answer is ahead by its time to first token, or by
+                    # the evaluation time if that token hasn't come yet
+                    routed_at = time.perf_counter()
+                    first_token_at = min(
+                        call.get("first_token_at", routed_at), routed_at
+                    )
+                    self._record_speculation(
+                        True, first_token_at - speculation_started, 0
+                    )
+                else:
+                    speculation.cancel()
+                    await asyncio.gather(speculation, return_exceptions=True)
+                    # The prompt, context included, and every token generated
+                    self._record_speculation(
+                        False,
+                        0.0,
+                        call.get("prompt_tokens", 0) + call.get("completion_tokens", 0),
+                    )
+                    speculation = None
+
+            yield "route", result
+            yield "context", context_data
+
+            if result == "SUFFICIENT":
+                logger.debug("✅ Using LOCAL RAG - context is sufficient")
+                # Use local RAG approach
+                if speculation is not None:
+                    while (token := await buffer.get()) is not None:
+                        yield "token", token
+                    # Surface any error raised while generating
+                    await speculation
+                else:
+                    async for token in self._local_answer_stream(
+                        query, context_str, message_history
+                    ):
+                        yield "token", token
+            elif result == "INSUFFICIENT_BUT_RELEVANT":
+                logger.debug(
+                    "🌐 Using WEB SEARCH - local context is insufficient but relevant"
+                )
+                # Use web search
+                async for token in self.stream_web_search_answer(
+                    query, message_history
+                ):
+                    yield "token", token
+            else:  # INSUFFICIENT_AND_IRRELEVANT
+                logger.debug(
+                    "📝 Question appears outside scope - returning fixed message"
+                )
+                # Return fixed message for irrelevant questions
+                yield "token", "Sorry, I can't help you with that question"
+        finally:
+            # Don't leave a generation running if the caller stops early
+            if speculation is not None and not speculation.done():
+                speculation.cancel()
+
+    async def generate_answer(
+        self, query: str, message_history: list = None, speculative: bool = None
+    ):
+        """Generate a complete answer by draining `stream_answer`.
 
-        if result == "SUFFICIENT":
-            print("✅ [DEBUG] Using LOCAL RAG - context is sufficient")
-            # Use local RAG approach
-            dynamic_system_prompt = self.langfuse_prompt.compile(context=context_str)
+        Args:
+            query: User's question
+            message_history: Previous conversation messages
+            speculative: Override the instance's speculative setting
 
-            # Prepare messages: system prompt + conversation history + current user message
-            messages = [{"role": "system", "content": dynamic_system_prompt}]
+        Returns:
+            tuple: (answer, context_data, used_web_search)
+        """
+        tokens = []
+        result = context_data = None
+
+        async for kind, data in self.stream_answer(query, message_history, speculative):
+            if kind == "route":
+                result = data
+            elif kind == "context":
+                context_data = data
+            else:
+                tokens.append(data)
+
+        return "".join(tokens), context_data, result == "INSUFFICIENT_BUT_RELEVANT"
+
+    async def answer_batch(
+        self,
+        questions: list,
+        concurrency: int = 8,
+        batch_size: int = 32,
+        num_results: int = 8,
+        max_attempts: int = 5,
+        limiter: AdaptiveConcurrency = None,
+    ):
+        """Answer independent questions in bulk, e.g. for offline evaluation.
+
+        Questions are deduplicated by their normalized text. Retrieval runs
+        `batch_size` questions per vector search, while evaluation and
+        answering run with bounded concurrency that backs off on rate limits.
+        Questions are answered without history, speculation or answer cache.
 
-            # Add conversation history if available and valid
-            if message_history and len(message_history) > 0:
-                for msg in message_history:
-                    if isinstance(msg, dict) and "role" in msg and "content" in msg:
-                        messages.append(msg)
-                    else:
-                        print(f"⚠️ [DEBUG] Skipping invalid message in history: {msg}")
+        Args:
+            questions: Dicts with `id` and `query`
+            concurrency: Questions evaluated and answered at once
+            batch_size: Questions per batched vector search
+            num_results: Number of results per question
+            max_attempts: Attempts per question when rate limited
+            limiter: Shared concurrency limit, instead of `concurrency`
+
+        Yields:
+            dict: One row per question in completion order, with `id`,
+                `query`, `route`, `answer`, `context_ids`, `timings` and
+                `knowledge_version`, `duplicate_of` for repeated questions
+                or `error` if it failed
+        """
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+        await self.wait_until_ready()
+        limiter = limiter or AdaptiveConcurrency(concurrency)
+        groups = {}
+        for question in questions:
+            groups.setdefault(normalize_query(question["query"]), []).append(question)
+        queue = asyncio.Queue()
+        # Don't retrieve far ahead of the questions being answered
+        backlog = asyncio.Semaphore(max(batch_size, limiter.max_limit) * 2)
+
+        def fan_out(group, row):
+            first = group[0]
+            queue.put_nowait({**first, **row})
+            for question in group[1:]:
+                queue.put_nowait({**question, **row, "duplicate_of": first["id"]})
+
+        async def answer(group, context_data, query_vector, batch):
+            try:
+                row = await self._answer_batch_question(
+                    group[0]["query"], context_data, query_vector, limiter, max_attempts
+                )
+                fan_out(group, {**row, "batch": batch})
+            finally:
+                backlog.release()
+
+        async def produce():
+            groups_list = list(groups.values())
+            for start in range(0, len(groups_list), batch_size):
+                chunk = groups_list[start : start + batch_size]
+                for _ in chunk:
+                    await backlog.acquire()
+
+                queries = [group[0]["query"] for group in chunk]
+                try:
+                    with capture_stages() as stages:
+                        contexts, vectors = await self.retriever.get_contexts(
+                            queries, num_results
+                        )
+                except Exception as e:
+                    logger.warning("⚠️ Batch retrieval failed: %s", e)
+                    for group in chunk:
+                        fan_out(group, {"error": f"retrieval failed: {e}"})
+                        backlog.release()
+                    continue
+
+                batch = {"size": len(chunk), **stages}
+                for group, context_data, vector in zip(chunk, contexts, vectors):
+                    tasks.add(
+                        asyncio.create_task(answer(group, context_data, vector, batch))
+                    )
 
-            messages.append({"role": "user", "content": query})
+        tasks = set()
+        with trace_route("batch"):
+            # The answer tasks it starts inherit the route
+            producer = asyncio.create_task(produce())
+        try:
+            for _ in range(len(questions)):
+                yield await queue.get()
+            await producer
+        finally:
+            for task in [producer, *tasks]:
+                task.cancel()
+            await asyncio.gather(producer, *tasks, return_exceptions=True)
 
-            response = self.client.chat.completions.create(
-                messages=messages,
-                **self.client_settings,
-            )
+    @observe()
+    async def _answer_batch_question(
+        self,
+        query: str,
+        context_data: list,
+        query_vector,
+        limiter: AdaptiveConcurrency,
+        max_attempts: int,
+    ) -> dict:
+        """Answer one batch question from its retrieved context, retrying on
+        rate limits."""
+        knowledge_version = self.knowledge_version
+        for attempt in range(max_attempts):
+            async with limiter.slot():
+                try:
+                    row = await self._answer_from_context(
+                        query, context_data, query_vector, knowledge_version
+                    )
+                except RateLimitError as e:
+                    # Left over after the client's own retries
+                    error = e
+                    if attempt + 1 < max_attempts:
+                        limiter.throttle(retry_delay(e, attempt))
+                        continue
+                except Exception as e:
+                    error = e
+                else:
+                    limiter.succeeded()
+                    return row
+            break
+
+        logger.warning("⚠️ Batch question failed: %s", error)
+        return {
+            "error": f"{type(error).__name__}: {error}",
+            "context_ids": [d.id or d.url for d in context_data[1]],
+            "knowledge_version": knowledge_version,
+        }
 
-            answer = response.choices[0].message.content
-            return answer, context_data, False
-        elif result == "INSUFFICIENT_BUT_RELEVANT":
-            print(
-                "🌐 [DEBUG] Using WEB SEARCH - local context is insufficient but relevant"
-            )
-            # Use web search
-            answer = self.generate_web_search_answer(query, message_history)
-            return answer, context_data, True
-        else:  # INSUFFICIENT_AND_IRRELEVANT
-            print("📝 [DEBUG] Question appears outside scope - returning fixed message")
-            # Return fixed message for irrelevant questions
-            answer = "Sorry, I can't help you with that question"
-            return answer, context_data, False
+    async def _answer_from_context(
+        self, query: str, context_data: list, query_vector, knowledge_version: str
+    ) -> dict:
+        started = time.perf_counter()
+        route = None
+        tokens = []
+        first_token = None
+
+        with capture_stages() as stages:
+            async for kind, data in self._answer_pipeline(
+                query, [], False, query_vector, context_data
+            ):
+                if kind == "route":
+                    route = data
+                elif kind == "token":
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+                    tokens.append(data)
+
+        return {
+            "route": route,
+            "answer": "".join(tokens),
+            "context_ids": [d.id or d.url for d in context_data[1]],
+            "knowledge_version": knowledge_version,
+            "timings": {
+                **stages,
+                "time_to_first_token": first_token,
+                "total": time.perf_counter() - started,
+            },
+        }
@@ -0,0 +1,106 @@
+import logging
+import os
+
+from lib.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+RETRIEVED_CHUNKS = Histogram(
+    "mira_retrieved_chunks",
+    "Chunks per query: `candidates` searched, `kept` after the relevance "
+    "cutoff, `packed` into the prompt",
+    ["step"],
+    buckets=(0, 1, 2, 3, 4, 5, 6, 8, 12, 16, 24, 32, 48),
+)
+
+
+def _cross_encoder_available() -> bool:
+    try:
+        import sentence_transformers  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def make_reranker(name: str = "rrf"):
+    """Build the reranker that orders the hybrid search candidates.
+
+    Args:
+        name: "rrf" for reciprocal rank fusion, or "cross-encoder" with an
+            optional ":<model>" to score each candidate against the question
+            with a small local cross-encoder (needs sentence-transformers)
+
+    Returns:
+        lancedb.rerankers.Reranker
+    """
+    from lancedb.rerankers import RRFReranker
+
+    kind, _, model = name.partition(":")
+    if kind == "rrf":
+        return RRFReranker()
+    if kind == "cross-encoder":
+        if not _cross_encoder_available():
+            logger.warning(
+                "⚠️ The cross-encoder reranker needs sentence-transformers, using RRF"
+            )
+            return RRFReranker()
+        from lancedb.rerankers import CrossEncoderReranker
+
+        # LanceDB's default model is a small TinyBERT that runs fine on CPU
+        options = {"model_name": model} if model else {}
+        return CrossEncoderReranker(device="cpu", **options)
+    raise ValueError(f"Unknown reranker '{name}'")
+
+
+class RelevanceCutoff:
+    """Keeps the reranked chunks that score close to the best one.
+
+    Meant for reranked hybrid results. Scores are scaled so the best one is
+    1: RRF scores relative to it, scores that can be negative (cross-encoder
+    logits) to the range of the candidates. Chunks are kept in rank order while their scaled score
+    is at least `min_score` and the drop from the previous kept chunk is at
+    most `max_gap`. At least `min_keep` chunks are always kept.
+    """
+
+    def __init__(self, min_score: float = 0.5, max_gap: float = 0.2, min_keep: int = 1):
+        self.min_score = min_score
+        self.max_gap = max_gap
+        self.min_keep = min_keep
+
+    @classmethod
+    def from_env(cls):
+        """Build a cutoff from the RAG_CUTOFF_* variables."""
+        return cls(
+            min_score=float(os.getenv("RAG_CUTOFF_MIN_SCORE", "0.5")),
+            max_gap=float(os.getenv("RAG_CUTOFF_MAX_GAP", "0.2")),
+        )
+
+    def select(self, documents: list, max_keep: int) -> list:
+        """Return the first 1 to `max_keep` documents worth keeping.
+
+        Args:
+            documents: ContextDocument list, best first
+            max_keep: Most documents to keep
+
+        Returns:
+            list[ContextDocument]
+        """
+        scores = [document.score for document in documents]
+        if None in scores or len(scores) < 2:
+            # Nothing to compare, e.g. vector-only results
+            return documents[:max_keep]
+
+        bottom = min(min(scores), 0.0)
+        span = scores[0] - bottom
+        if span <= 0:
+            return documents[:max_keep]
+
+        keep = max(min(self.min_keep, max_keep), 1)
+        previous = (scores[keep - 1] - bottom) / span
+        for score in scores[keep:max_keep]:
+            scaled = (score - bottom) / span
+            if scaled < self.min_score or previous - scaled > self.max_gap:
+                break
+            keep += 1
+            previous = scaled
+        return documents[:keep]
@@ -0,0 +1,354 @@
+import asyncio
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+
+import pyarrow as pa
+import pyarrow.compute as pc
+from lancedb.embeddings import TextEmbeddingFunction
+from lancedb.query import LanceHybridQueryBuilder
+from lancedb.rerankers import Reranker, RRFReranker
+
+from lib.context_budget import ContextBudget
+from lib.documents import documents_from_arrow, format_context
+from lib.embeddings import QueryEmbedder
+from lib.executor import run_blocking
+from lib.metrics import observe_stage, time_stage
+from lib.query import prepare_fts_query
+from lib.reranking import RETRIEVED_CHUNKS, RelevanceCutoff
+
+logger = logging.getLogger(__name__)
+
+# Seconds spent reranking during the current `_time_search` block
+_rerank_seconds = contextvars.ContextVar("rerank_seconds", default=None)
+
+
+class TimedReranker(Reranker):
+    """Records how long `reranker` takes as the `rerank` stage.
+
+    LanceDB reranks inside its hybrid search call, so this is the only way
+    to tell the reranker's time (a cross-encoder scores every candidate)
+    apart from the search itself.
+    """
+
+    def __init__(self, reranker: Reranker):
+        super().__init__(return_score=reranker.score)
+        self.reranker = reranker
+
+    def rerank_hybrid(self, query: str, vector_results, fts_results):
+        started = time.perf_counter()
+        try:
+            return self.reranker.rerank_hybrid(query, vector_results, fts_results)
+        finally:
+            elapsed = time.perf_counter() - started
+            observe_stage("rerank", elapsed)
+            spent = _rerank_seconds.get()
+            if spent is not None:
+                spent.append(elapsed)
+
+    def __getattr__(self, name):
+        return getattr(self.reranker, name)
+
+
+@contextmanager
+def _time_search():
+    """Record the block as the `retrieval` stage, without its reranking."""
+    spent = []
+    token = _rerank_seconds.set(spent)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _rerank_seconds.reset(token)
+        observe_stage("retrieval", time.perf_counter() - started - sum(spent))
+
+
+def _fuse_hybrid(query: str, vector_results, fts_results, reranker, limit: int):
+    """Normalize and fuse vector and full-text results like a hybrid query.
+
+    Uses LanceDB's own (private) fusion step, so batched and single hybrid
+    searches rank alike; lancedb is pinned in requirements.txt for this.
+    """
+    return LanceHybridQueryBuilder._combine_hybrid_results(
+        fts_results=fts_results,
+        vector_results=vector_results,
+        norm="score",
+        fts_query=query,
+        reranker=reranker,
+        limit=limit,
+        with_row_ids=False,
+    )
+
+
+# Without it, batches fall back to one hybrid search per query
+_CAN_FUSE = hasattr(LanceHybridQueryBuilder, "_combine_hybrid_results")
+
+
+class Retriever:
+    """Searches the knowledge base table and assembles the prompt context."""
+
+    def __init__(
+        self,
+        table,
+        context_budget: ContextBudget = None,
+        reranker=None,
+        embedder: QueryEmbedder = None,
+        expand_synonyms: bool = True,
+        cutoff: RelevanceCutoff = None,
+        candidates: int = None,
+    ):
+        self.table = table
+        self.context_budget = context_budget or ContextBudget()
+        # Timed, so reranking shows up as its own stage
+        self.reranker = TimedReranker(reranker or RRFReranker())
+        # With a cutoff, `candidates` results are reranked and only those
+        # close to the best one are kept, instead of always the top N
+        self.cutoff = cutoff
+        self.candidates = candidates
+        # Full-text queries also match other spellings of known DeSci terms
+        self.expand_synonyms = expand_synonyms
+        # Query vectors are computed here, cached and batched, and passed
+        # to the searches instead of letting LanceDB embed every query
+        self.embedder = embedder or QueryEmbedder.from_env(self.embed_queries)
+
+    def embed_query(self, query: str):
+        embedding = self.table.embedding_functions["vector"].function
+        return embedding.compute_query_embeddings(query)[0]
+
+    def embed_queries(self, queries: list) -> list:
+        """Embed several queries, in one call when the model allows it."""
+        embedding = self.table.embedding_functions["vector"].function
+        # Models with a separate query form (e.g. an instruction prefix)
+        # override `compute_query_embeddings` and are called per query
+        if (
+            isinstance(embedding, TextEmbeddingFunction)
+            and type(embedding).compute_query_embeddings
+            is TextEmbeddingFunction.compute_query_embeddings
+        ):
+            return list(embedding.compute_source_embeddings(queries))
+        return [embedding.compute_query_embeddings(query)[0] for query in queries]
+
+    async def embed(self, query: str):
+        """Embed a query through the cache and micro-batcher."""
+        with time_stage("embedding"):
+            return await self.embedder.embed(query)
+
+    def _columns(self) -> list:
+        # Tables written by `lib.ingest` identify chunks by their content hash
+        if "chunk_hash" in self.table.schema.names:
+            return ["text", "metadata", "chunk_hash"]
+        return ["text", "metadata"]
+
+    def _fts_results(self, query: str, columns: list, num_results: int):
+        if not query:
+            # Nothing to match, e.g. a question made of punctuation
+            fields = [self.table.schema.field(column) for column in columns]
+            return pa.schema(
+                fields
+                + [pa.field("_score", pa.float32()), pa.field("_rowid", pa.uint64())]
+            ).empty_table()
+        return (
+            self.table.search(query, query_type="fts", fts_columns="text")
+            .select(columns)
+            .with_row_id(True)
+            .limit(num_results)
+            .to_arrow()
+        )
+
+    def search(
+        self,
+        query: str,
+        num_results: int,
+        query_type: str = "hybrid",
+        query_vector=None,
+    ):
+        """Search with a prepared full-text query, see `prepare_fts_query`."""
+        # LanceDB reads the indexes (and embeds the query if no vector is
+        # given) synchronously, so this always runs on the blocking executor.
+        columns = self._columns()
+        if query_type == "hybrid" and not query:
+            # LanceDB's hybrid query needs text; fuse with no full-text hits
+            if query_vector is None:
+                query_vector = self.embed_query(query)
+            return self.search_batch([query], [query_vector], num_results)[0]
+        elif query_type == "fts" and not query:
+            return self._fts_results(query, columns, num_results)
+
+        if query_type == "hybrid":
+            if query_vector is None:
+                search = self.table.search(
+                    query,
+                    query_type="hybrid",
+                    vector_column_name="vector",
+                    fts_columns="text",
+                )
+            else:
+                search = (
+                    self.table.search(
+                        query_type="hybrid",
+                        vector_column_name="vector",
+                        fts_columns="text",
+                    )
+                    .vector(query_vector)
+                    .text(query)
+                )
+            search = search.select(columns).rerank(self.reranker)
+        elif query_type == "vector":
+            search = self.table.search(
+                query if query_vector is None else query_vector,
+                query_type="vector",
+                vector_column_name="vector",
+            ).select(columns)
+        else:
+            search = self.table.search(
+                query, query_type="fts", fts_columns="text"
+            ).select(columns)
+
+        return search.limit(num_results).to_arrow()
+
+    def search_batch(self, queries: list, vectors: list, num_results: int) -> list:
+        """Hybrid search for several queries with a single vector search.
+
+        All vectors are searched in one call; the full-text search still runs
+        per query, and each query's results are fused by the reranker exactly
+        as in a hybrid `search`.
+
+        Args:
+            queries: Prepared full-text queries
+            vectors: Query embeddings, in the same order
+            num_results: Number of results per query
+
+        Returns:
+            list[pyarrow.Table]: One result per query
+        """
+        if not _CAN_FUSE:
+            return [
+                self.search(query, num_results, query_vector=vector)
+                for query, vector in zip(queries, vectors)
+            ]
+
+        columns = self._columns()
+        vector_results = (
+            self.table.search(vectors, query_type="vector", vector_column_name="vector")
+            .select(columns)
+            .with_row_id(True)
+            .limit(num_results)
+            .to_arrow()
+        )
+
+        results = []
+        for index, query in enumerate(queries):
+            # A single vector is searched without a `query_index` column
+            matches = vector_results
+            if "query_index" in vector_results.column_names:
+                matches = vector_results.filter(
+                    pc.equal(vector_results["query_index"], index)
+                ).drop(["query_index"])
+            fts_results = self._fts_results(query, columns, num_results)
+            results.append(
+                _fuse_hybrid(query, matches, fts_results, self.reranker, num_results)
+            )
+        return results
+
+    async def get_context(
+        self,
+        query: str,
+        num_results: int = 8,
+        query_type: str = "hybrid",
+        query_vector=None,
+    ):
+        """Search the database for relevant context.
+
+        Args:
+            query: User's question
+            num_results: Most results to return
+            query_type: "hybrid", "vector" or "fts"
+            query_vector: The question's embedding, if already computed
+
+        Returns:
+            list: [context, documents] with the concatenated context from relevant
+                chunks with source information, and the list of ContextDocument
+        """
+
+        fts_query = prepare_fts_query(query, self.expand_synonyms)
+        if query_vector is None and query_type != "fts":
+            query_vector = await self.embed(query)
+
+        # Hybrid results are fused by the reranker inside the search call
+        with _time_search():
+            results = await run_blocking(
+                self.search,
+                fts_query,
+                self._candidates(num_results, query_type),
+                query_type,
+                query_vector,
+            )
+
+        return self._pack(results, num_results, query_type)
+
+    async def get_contexts(self, queries: list, num_results: int = 8):
+        """Search the database for several queries at once.
+
+        The queries are embedded through the micro-batcher, together unless
+        they are cached, and searched with one batched vector search, see
+        `search_batch`.
+
+        Args:
+            queries: User questions
+            num_results: Number of results per question
+
+        Returns:
+            tuple: ([context, documents] per query in the same order as
+                `get_context`, query vectors)
+        """
+        with time_stage("embedding"):
+            vectors = await asyncio.gather(
+                *(self.embedder.embed(query) for query in queries)
+            )
+        with _time_search():
+            results = await run_blocking(
+                self.search_batch,
+                [prepare_fts_query(query, self.expand_synonyms) for query in queries],
+                vectors,
+                self._candidates(num_results, "hybrid"),
+            )
+        return [
+            self._pack(result, num_results, "hybrid") for result in results
+        ], vectors
+
+    def _cuts(self, query_type: str) -> bool:
+        # The cutoff is for reranked hybrid scores. Raw BM25 scores fall off
+        # steeply after the best match, so it dropped relevant chunks there
+        return self.cutoff is not None and query_type == "hybrid"
+
+    def _candidates(self, num_results: int, query_type: str) -> int:
+        if not self._cuts(query_type) or self.candidates is None:
+            return num_results
+        return max(self.candidates, num_results)
+
+    def _pack(self, results, num_results: int, query_type: str):
+        started = time.perf_counter()
+        documents = documents_from_arrow(results)
+        RETRIEVED_CHUNKS.observe(len(documents), step="candidates")
+        if self._cuts(query_type):
+            documents = self.cutoff.select(documents, num_results)
+        RETRIEVED_CHUNKS.observe(len(documents), step="kept")
+        kept = len(documents)
+        documents = self.context_budget.pack_documents(documents)
+        RETRIEVED_CHUNKS.observe(len(documents), step="packed")
+        logger.debug(
+            "🎯 Kept %d of %d candidates, packed %d",
+            kept,
+            results.num_rows,
+            len(documents),
+        )
+
+        final_context = format_context(documents)
+        elapsed = time.perf_counter() - started
+        observe_stage("context_packing", elapsed)
+        logger.debug(
+            "🧾 Formatted %d documents in %.2f ms", len(documents), elapsed * 1000
+        )
+
+        return [final_context, documents]
@@ -0,0 +1,82 @@
+"""The RAG and session store served by the chat app, configured from the
+environment.
+
+`app.py` and the FastAPI server in `main.py` share one instance of each.
+The RAG is created lazily: nothing connects to S3 or Langfuse until
+`RAG.start()` is called by the server's lifespan, or by Chainlit when run
+on its own.
+"""
+
+import os
+
+from lib.answer_cache import WEB_SEARCH_ROUTES, SemanticAnswerCache
+from lib.coalescing import AnswerCoalescer
+from lib.prerouter import PreRouter
+from lib.rag import RAG
+from lib.reranking import RelevanceCutoff
+from lib.sessions import SessionStore
+
+client_settings = {
+    "model": "gpt-4o",
+    "temperature": 0.3,
+}
+
+_rag = None
+_sessions = None
+
+
+def build_rag() -> RAG:
+    """Create a lazy RAG from the RAG_* environment variables."""
+    return RAG(
+        **client_settings,
+        speculative=os.getenv("RAG_SPECULATIVE", "false").lower() == "true",
+        answer_cache=(
+            SemanticAnswerCache(
+                threshold=float(os.getenv("RAG_ANSWER_CACHE_THRESHOLD", "0.97")),
+                route_ttls=dict.fromkeys(
+                    WEB_SEARCH_ROUTES,
+                    float(os.getenv("RAG_ANSWER_CACHE_WEB_SEARCH_TTL", "0")),
+                ),
+            )
+            if os.getenv("RAG_ANSWER_CACHE", "false").lower() == "true"
+            else None
+        ),
+        coalescer=(
+            AnswerCoalescer()
+            if os.getenv("RAG_COALESCE", "false").lower() == "true"
+            else None
+        ),
+        prerouter=(
+            PreRouter(
+                check_rate=float(os.getenv("RAG_PREROUTER_CHECK_RATE", "0.05")),
+                # Its score thresholds only hold for RRF
+                reranker=os.getenv("RAG_RERANKER", "rrf"),
+            )
+            if os.getenv("RAG_PREROUTER", "false").lower() == "true"
+            else None
+        ),
+        reranker=os.getenv("RAG_RERANKER", "rrf"),
+        cutoff=(
+            RelevanceCutoff.from_env()
+            if os.getenv("RAG_RELEVANCE_CUTOFF", "false").lower() == "true"
+            else None
+        ),
+        retrieval_candidates=int(os.getenv("RAG_RETRIEVAL_CANDIDATES", "0")) or None,
+        lazy=True,
+    )
+
+
+def get_rag() -> RAG:
+    """Return the process-wide RAG, creating it on first call."""
+    global _rag
+    if _rag is None:
+        _rag = build_rag()
+    return _rag
+
+
+def get_sessions() -> SessionStore:
+    """Return the process-wide session store, creating it on first call."""
+    global _sessions
+    if _sessions is None:
+        _sessions = SessionStore.from_env()
+    return _sessions
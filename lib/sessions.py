@@ -0,0 +1,440 @@
+import abc
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from urllib.parse import urlparse
+
+from lib.executor import run_blocking
+
+logger = logging.getLogger(__name__)
+
+# Roles are stored as one letter to keep history compact
+_ROLE_CODES = {"user": "u", "assistant": "a", "system": "s"}
+_ROLES = {code: role for role, code in _ROLE_CODES.items()}
+
+
+def _pack(message: dict) -> tuple:
+    return _ROLE_CODES[message["role"]], message["content"]
+
+
+def _unpack(role: str, content: str) -> dict:
+    return {"role": _ROLES[role], "content": content}
+
+
+class SessionStore(abc.ABC):
+    """Chat session state shared by every worker: fields, history, feedback.
+
+    A session has a few small fields (its Langfuse session id, knowledge
+    version) and a chat history that is only ever appended to. The feedback
+    buttons of an answer are stored by the id of its message, so whichever
+    worker gets the click can remove them. Sessions expire `ttl` seconds
+    after their last write, which also covers a browser that reconnects to
+    the same session, and only the last `max_messages` messages are kept;
+    the context budget trims history further for the prompt.
+
+    `from_url` picks the backend: in memory for a single process, or SQLite
+    or Redis (any server speaking its protocol) for several.
+    """
+
+    def __init__(self, ttl: float = 86400, max_messages: int = 200):
+        self.ttl = ttl
+        self.max_messages = max_messages
+
+    @classmethod
+    def from_url(cls, url: str = "memory://", **options):
+        """Build a store from `memory://`, `sqlite:///<path>` or `redis://...`."""
+        scheme = urlparse(url).scheme
+        logger.debug("💬 Sessions are stored in %s", scheme)
+        if scheme == "memory":
+            return InMemorySessionStore(**options)
+        if scheme == "sqlite":
+            return SQLiteSessionStore(url.removeprefix("sqlite://"), **options)
+        if scheme in ("redis", "rediss", "unix"):
+            return RedisSessionStore(url, **options)
+        raise ValueError(f"Unknown session store '{url}'")
+
+    @classmethod
+    def from_env(cls):
+        """Build the store configured by the RAG_SESSION_* variables."""
+        return cls.from_url(
+            os.getenv("RAG_SESSION_STORE", "memory://"),
+            ttl=float(os.getenv("RAG_SESSION_TTL", "86400")),
+            max_messages=int(os.getenv("RAG_SESSION_MAX_MESSAGES", "200")),
+        )
+
+    @abc.abstractmethod
+    async def get_fields(self, session_id: str) -> dict:
+        """Return the session's fields, empty if it doesn't exist."""
+
+    @abc.abstractmethod
+    async def set_fields(self, session_id: str, **fields):
+        """Set some of the session's fields, creating it if needed."""
+
+    @abc.abstractmethod
+    async def history(self, session_id: str) -> list:
+        """Return the session's messages as `{"role", "content"}` dicts."""
+
+    @abc.abstractmethod
+    async def append_history(self, session_id: str, *messages: dict):
+        """Add messages to the end of the session's history."""
+
+    @abc.abstractmethod
+    async def delete_session(self, session_id: str):
+        """Forget the session's fields and history."""
+
+    @abc.abstractmethod
+    async def save_actions(self, message_id: str, actions: list):
+        """Store the serialized actions shown with message `message_id`."""
+
+    @abc.abstractmethod
+    async def pop_actions(self, message_id: str) -> list:
+        """Remove and return the actions of `message_id`, if any are left."""
+
+    async def close(self):
+        pass
+
+
+class InMemorySessionStore(SessionStore):
+    """Sessions in this process's memory, like Chainlit's user session."""
+
+    def __init__(self, ttl: float = 86400, max_messages: int = 200):
+        super().__init__(ttl, max_messages)
+        # Both ordered by last write, so expired entries are at the front
+        self._sessions = OrderedDict()
+        self._actions = OrderedDict()
+
+    def _expire(self, entries: OrderedDict):
+        now = time.monotonic()
+        while entries and next(iter(entries.values()))["expires_at"] <= now:
+            entries.popitem(last=False)
+
+    def _session(self, session_id: str, write: bool = False) -> dict:
+        self._expire(self._sessions)
+        session = self._sessions.get(session_id)
+        if session is None:
+            if not write:
+                return None
+            session = self._sessions[session_id] = {
+                "fields": {},
+                "history": deque(maxlen=self.max_messages),
+            }
+        if write:
+            session["expires_at"] = time.monotonic() + self.ttl
+            self._sessions.move_to_end(session_id)
+        return session
+
+    async def get_fields(self, session_id: str) -> dict:
+        session = self._session(session_id)
+        return dict(session["fields"]) if session else {}
+
+    async def set_fields(self, session_id: str, **fields):
+        self._session(session_id, write=True)["fields"].update(fields)
+
+    async def history(self, session_id: str) -> list:
+        session = self._session(session_id)
+        return [_unpack(*message) for message in session["history"]] if session else []
+
+    async def append_history(self, session_id: str, *messages: dict):
+        history = self._session(session_id, write=True)["history"]
+        history.extend(_pack(message) for message in messages)
+
+    async def delete_session(self, session_id: str):
+        self._sessions.pop(session_id, None)
+
+    async def save_actions(self, message_id: str, actions: list):
+        self._expire(self._actions)
+        self._actions[message_id] = {
+            "actions": actions,
+            "expires_at": time.monotonic() + self.ttl,
+        }
+
+    async def pop_actions(self, message_id: str) -> list:
+        self._expire(self._actions)
+        entry = self._actions.pop(message_id, None)
+        return entry["actions"] if entry else []
+
+
+class SQLiteSessionStore(SessionStore):
+    """Sessions in a SQLite file that every worker on the host opens.
+
+    History is one row per message. Expired sessions are deleted by the
+    next write after `prune_interval` seconds.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            expires_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS session_fields (
+            session_id TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (session_id, key)
+        );
+        CREATE TABLE IF NOT EXISTS session_messages (
+            id INTEGER PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS session_messages_session
+            ON session_messages (session_id, id);
+        CREATE TABLE IF NOT EXISTS feedback_actions (
+            message_id TEXT PRIMARY KEY,
+            actions TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+    """
+
+    _APPEND_MESSAGES = (
+        "INSERT INTO session_messages (session_id, role, content) VALUES (?, ?, ?)"
+    )
+    # Keeps the last `max_messages`
+    _TRIM_MESSAGES = (
+        "DELETE FROM session_messages WHERE session_id = ? AND id <= ("
+        "SELECT id FROM session_messages WHERE session_id = ?"
+        " ORDER BY id DESC LIMIT 1 OFFSET ?)"
+    )
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = 86400,
+        max_messages: int = 200,
+        prune_interval: float = 300,
+    ):
+        super().__init__(ttl, max_messages)
+        self.path = path
+        self.prune_interval = prune_interval
+        self._connection = None
+        self._lock = threading.Lock()
+        self._pruned_at = 0.0
+
+    def _connect(self):
+        # Opened on first use, so creating the store does no I/O
+        if self._connection is None:
+            connection = sqlite3.connect(
+                self.path, timeout=5, check_same_thread=False, isolation_level=None
+            )
+            # Readers don't block the writer, other workers included
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(self._SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    def _read(self, sql: str, parameters: tuple) -> list:
+        with self._lock:
+            return self._connect().execute(sql, parameters).fetchall()
+
+    def _write(self, session_id: str, statements: list):
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                if session_id is not None:
+                    connection.execute(
+                        "INSERT INTO sessions VALUES (?, ?) ON CONFLICT (session_id)"
+                        " DO UPDATE SET expires_at = excluded.expires_at",
+                        (session_id, now + self.ttl),
+                    )
+                for sql, parameters in statements:
+                    connection.executemany(sql, parameters)
+                if now - self._pruned_at > self.prune_interval:
+                    self._prune(connection, now)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def _prune(self, connection, now: float):
+        self._pruned_at = now
+        expired = "SELECT session_id FROM sessions WHERE expires_at <= ?"
+        connection.execute(
+            f"DELETE FROM session_fields WHERE session_id IN ({expired})", (now,)
+        )
+        connection.execute(
+            f"DELETE FROM session_messages WHERE session_id IN ({expired})", (now,)
+        )
+        connection.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+        connection.execute("DELETE FROM feedback_actions WHERE expires_at <= ?", (now,))
+
+    def _live(self, session_id: str) -> tuple:
+        return (
+            "EXISTS (SELECT 1 FROM sessions WHERE session_id = ? AND expires_at > ?)",
+            (session_id, time.time()),
+        )
+
+    async def get_fields(self, session_id: str) -> dict:
+        live, parameters = self._live(session_id)
+        rows = await run_blocking(
+            self._read,
+            f"SELECT key, value FROM session_fields WHERE session_id = ? AND {live}",
+            (session_id, *parameters),
+        )
+        return {key: json.loads(value) for key, value in rows}
+
+    async def set_fields(self, session_id: str, **fields):
+        rows = [(session_id, key, json.dumps(value)) for key, value in fields.items()]
+        await run_blocking(
+            self._write,
+            session_id,
+            [("INSERT OR REPLACE INTO session_fields VALUES (?, ?, ?)", rows)],
+        )
+
+    async def history(self, session_id: str) -> list:
+        live, parameters = self._live(session_id)
+        rows = await run_blocking(
+            self._read,
+            "SELECT role, content FROM session_messages"
+            f" WHERE session_id = ? AND {live} ORDER BY id",
+            (session_id, *parameters),
+        )
+        return [_unpack(role, content) for role, content in rows]
+
+    async def append_history(self, session_id: str, *messages: dict):
+        rows = [(session_id, *_pack(message)) for message in messages]
+        await run_blocking(
+            self._write,
+            session_id,
+            [
+                (self._APPEND_MESSAGES, rows),
+                (
+                    self._TRIM_MESSAGES,
+                    [(session_id, session_id, self.max_messages)],
+                ),
+            ],
+        )
+
+    async def delete_session(self, session_id: str):
+        await run_blocking(
+            self._write,
+            None,
+            [
+                (f"DELETE FROM {table} WHERE session_id = ?", [(session_id,)])
+                for table in ("session_fields", "session_messages", "sessions")
+            ],
+        )
+
+    async def save_actions(self, message_id: str, actions: list):
+        await run_blocking(
+            self._write,
+            None,
+            [
+                (
+                    "INSERT OR REPLACE INTO feedback_actions VALUES (?, ?, ?)",
+                    [(message_id, json.dumps(actions), time.time() + self.ttl)],
+                )
+            ],
+        )
+
+    def _pop_actions(self, message_id: str) -> list:
+        with self._lock:
+            row = (
+                self._connect()
+                .execute(
+                    "DELETE FROM feedback_actions WHERE message_id = ?"
+                    " AND expires_at > ? RETURNING actions",
+                    (message_id, time.time()),
+                )
+                .fetchone()
+            )
+        return json.loads(row[0]) if row else []
+
+    async def pop_actions(self, message_id: str) -> list:
+        return await run_blocking(self._pop_actions, message_id)
+
+    async def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class RedisSessionStore(SessionStore):
+    """Sessions in Redis or any server speaking its protocol (Valkey, KeyDB).
+
+    Each session is a hash of JSON fields and a list of compact
+    `[role, content]` messages; both expire together.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        ttl: float = 86400,
+        max_messages: int = 200,
+        prefix: str = "mira",
+    ):
+        super().__init__(ttl, max_messages)
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError(
+                "The Redis session store needs the redis package"
+            ) from None
+        # Connects on first command
+        self.redis = redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+
+    def _key(self, kind: str, key: str) -> str:
+        return f"{self.prefix}:{kind}:{key}"
+
+    async def get_fields(self, session_id: str) -> dict:
+        fields = await self.redis.hgetall(self._key("fields", session_id))
+        return {key: json.loads(value) for key, value in fields.items()}
+
+    async def set_fields(self, session_id: str, **fields):
+        fields_key = self._key("fields", session_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(
+                fields_key,
+                mapping={key: json.dumps(value) for key, value in fields.items()},
+            )
+            pipe.expire(fields_key, int(self.ttl))
+            pipe.expire(self._key("history", session_id), int(self.ttl))
+            await pipe.execute()
+
+    async def history(self, session_id: str) -> list:
+        messages = await self.redis.lrange(self._key("history", session_id), 0, -1)
+        return [_unpack(*json.loads(message)) for message in messages]
+
+    async def append_history(self, session_id: str, *messages: dict):
+        history_key = self._key("history", session_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(
+                history_key,
+                *(
+                    json.dumps(_pack(message), ensure_ascii=False)
+                    for message in messages
+                ),
+            )
+            pipe.ltrim(history_key, -self.max_messages, -1)
+            pipe.expire(history_key, int(self.ttl))
+            pipe.expire(self._key("fields", session_id), int(self.ttl))
+            await pipe.execute()
+
+    async def delete_session(self, session_id: str):
+        await self.redis.delete(
+            self._key("fields", session_id), self._key("history", session_id)
+        )
+
+    async def save_actions(self, message_id: str, actions: list):
+        await self.redis.set(
+            self._key("feedback", message_id), json.dumps(actions), ex=int(self.ttl)
+        )
+
+    async def pop_actions(self, message_id: str) -> list:
+        key = self._key("feedback", message_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.get(key)
+            pipe.delete(key)
+            actions, _ = await pipe.execute()
+        return json.loads(actions) if actions else []
+
+    async def close(self):
+        await self.redis.aclose()
@@ -0,0 +1,120 @@
+"""Startup profiling: import and initialization cost of each component.
+
+The RAG records how long each of its components took to import and
+initialize while warming up; `/readyz` reports it and setting
+`RAG_STARTUP_PROFILE=true` logs it once warm-up is done. Run as a module to
+profile a cold start of the app, including the imports that happen before
+the RAG exists:
+
+    python -m lib.startup
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+from contextlib import contextmanager
+
+from lib.metrics import Gauge
+
+logger = logging.getLogger(__name__)
+
+STARTUP_SECONDS = Gauge(
+    "mira_startup_seconds",
+    "Seconds spent importing and initializing each component at startup",
+    ["component", "phase"],
+)
+
+
+class StartupProfile:
+    """Import and initialization time and status of each startup component.
+
+    Components start out `pending`, are `imported` once their modules are,
+    become `ready` once their `init` phase completes and `failed` when a
+    phase raises; a component that is retried adds up the time of every
+    attempt. A component that initialized without raising but works in a
+    reduced way is marked `degraded` with `degrade`.
+    """
+
+    def __init__(self, components=()):
+        self.components = {name: {"status": "pending"} for name in components}
+
+    @contextmanager
+    def measure(self, component: str, phase: str = "init"):
+        entry = self.components.setdefault(component, {"status": "pending"})
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            entry["status"] = "failed"
+            entry["error"] = str(e)
+            raise
+        else:
+            if phase == "init":
+                entry["status"] = "ready"
+                entry.pop("error", None)
+            elif entry["status"] == "pending":
+                entry["status"] = "imported"
+        finally:
+            entry[phase] = entry.get(phase, 0.0) + time.perf_counter() - started
+            STARTUP_SECONDS.set(entry[phase], component=component, phase=phase)
+
+    def degrade(self, component: str, error: str):
+        """Mark `component` as working, but not as configured."""
+        entry = self.components.setdefault(component, {"status": "pending"})
+        entry["status"] = "degraded"
+        entry["error"] = error
+
+    def report(self) -> dict:
+        """Return `{component: {"status", "import", "init", "error"}}`."""
+        return {name: dict(entry) for name, entry in self.components.items()}
+
+    def format(self) -> str:
+        lines = [f"{'component':<16}{'import':>9}{'init':>9}  status"]
+        for name, entry in self.components.items():
+            lines.append(
+                f"{name:<16}{entry.get('import', 0.0):>8.2f}s"
+                f"{entry.get('init', 0.0):>8.2f}s  {entry['status']}"
+            )
+        return "\n".join(lines)
+
+
+async def profile_startup() -> StartupProfile:
+    """Import the app's modules and warm up its RAG, timing each step."""
+    profile = StartupProfile()
+    with profile.measure("chat_ui", "import"):
+        import chainlit  # noqa: F401
+    with profile.measure("app", "import"):
+        from lib.service import get_rag
+
+    with profile.measure("clients"):
+        rag = get_rag()
+    await rag.wait_until_ready()
+    await rag.warmed_up()
+    profile.components.update(rag.startup.report())
+    await rag.close()
+    return profile
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--json", action="store_true", help="Print a JSON report")
+    args = parser.parse_args(argv)
+
+    from lib.logs import configure_logging
+
+    configure_logging()
+
+    started = time.perf_counter()
+    profile = asyncio.run(profile_startup())
+    if args.json:
+        print(json.dumps(profile.report(), indent=2))
+    else:
+        print(profile.format())
+        print(f"total: {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
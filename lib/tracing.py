@@ -0,0 +1,279 @@
+import asyncio
+import contextvars
+import datetime
+import logging
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+from langfuse.api import (
+    IngestionEvent_ScoreCreate,
+    IngestionEvent_TraceCreate,
+    ScoreBody,
+    TraceBody,
+)
+from opentelemetry import trace as otel_trace
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.sampling import (
+    ParentBased,
+    Sampler,
+    TraceIdRatioBased,
+)
+
+from lib.executor import run_blocking
+from lib.metrics import Counter, Gauge, Histogram, register_collector
+
+logger = logging.getLogger(__name__)
+
+TRACE_EVENTS = Counter(
+    "mira_trace_events",
+    "Trace updates and scores by what happened to them: queued, sent, "
+    "dropped because the buffer was full, failed to send, or sampled out",
+    ["kind", "result"],
+)
+TRACE_FLUSH_SECONDS = Histogram(
+    "mira_trace_flush_seconds",
+    "Time to send one batch of trace updates and scores to Langfuse",
+)
+TRACE_BUFFER = Gauge(
+    "mira_trace_buffer",
+    "Trace updates and scores waiting to be sent",
+)
+
+_route = contextvars.ContextVar("trace_route", default=None)
+
+
+@contextmanager
+def trace_route(route: str):
+    """Sample the traces started inside the block at the rate of `route`."""
+    token = _route.set(route)
+    try:
+        yield
+    finally:
+        _route.reset(token)
+
+
+def parse_sample_rates(text: str) -> dict:
+    """Parse `chat=0.1,batch=1` into `{"chat": 0.1, "batch": 1.0}`.
+
+    `default=<rate>` applies to routes that aren't listed.
+    """
+    rates = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        route, _, rate = item.partition("=")
+        rates[route.strip()] = float(rate)
+        if not 0.0 <= rates[route.strip()] <= 1.0:
+            raise ValueError(f"Sample rate for '{route}' must be between 0 and 1")
+    return rates
+
+
+class RouteSampler(Sampler):
+    """Head sampling of new traces at the rate of the current `trace_route`.
+
+    The decision is made when a trace's root span starts and is derived
+    from the trace id, so it is the same in every process.
+    """
+
+    def __init__(self, rates: dict):
+        self.rates = rates
+        default = rates.get("default", 1.0)
+        self._samplers = {
+            route: TraceIdRatioBased(rate) for route, rate in rates.items()
+        }
+        self._default = TraceIdRatioBased(default)
+
+    def should_sample(self, parent_context, trace_id, name, *args, **kwargs):
+        sampler = self._samplers.get(_route.get(), self._default)
+        return sampler.should_sample(parent_context, trace_id, name, *args, **kwargs)
+
+    def get_description(self) -> str:
+        return f"RouteSampler{self.rates}"
+
+
+def sampled_tracer_provider(rates: dict) -> TracerProvider:
+    """A tracer provider for Langfuse that samples traces per route."""
+    # Child spans follow their trace's decision
+    return TracerProvider(sampler=ParentBased(root=RouteSampler(rates)))
+
+
+def _timestamp() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+class TraceBuffer:
+    """Trace updates and scores, queued in memory and sent to Langfuse in batches.
+
+    Updates to a trace are merged while they wait: metadata is combined,
+    tags are added up and other fields keep their latest value. Nothing is
+    serialized on the request path. A background task sends everything
+    that is queued as ingestion batches of up to `flush_at` events, every
+    `flush_interval` seconds or as soon as `flush_at` events are waiting.
+    At most `max_events` wait; further ones are dropped and counted.
+    Updates to traces that were sampled out are skipped.
+
+    With `batched=False` updates go straight to the Langfuse SDK instead.
+    """
+
+    def __init__(
+        self,
+        langfuse,
+        enabled: bool = True,
+        batched: bool = True,
+        max_events: int = 10000,
+        flush_at: int = 100,
+        flush_interval: float = 1.0,
+    ):
+        self.langfuse = langfuse
+        self.enabled = enabled
+        self.batched = batched
+        self.max_events = max_events
+        self.flush_at = flush_at
+        self.flush_interval = flush_interval
+        # Trace fields by trace id, in the order they were first updated
+        self._traces = {}
+        self._scores = []
+        self._wakeup = None
+        self._task = None
+        self.stats = {"queued": 0, "sent": 0, "dropped": 0, "failed": 0}
+        register_collector(lambda: TRACE_BUFFER.set(self.pending))
+
+    @classmethod
+    def from_env(cls, langfuse):
+        """Build a buffer configured by the RAG_TRACE_* variables."""
+        return cls(
+            langfuse,
+            enabled=os.getenv("LANGFUSE_TRACING_ENABLED", "true").lower() != "false",
+            batched=os.getenv("RAG_TRACE_BATCHING", "true").lower() == "true",
+            max_events=int(os.getenv("RAG_TRACE_BUFFER_SIZE", "10000")),
+            flush_interval=float(os.getenv("RAG_TRACE_FLUSH_INTERVAL", "1.0")),
+        )
+
+    @property
+    def pending(self) -> int:
+        return len(self._traces) + len(self._scores)
+
+    def current_trace_sampled(self) -> bool:
+        """Whether the current trace is recorded, i.e. on and sampled in."""
+        return self.enabled and otel_trace.get_current_span().is_recording()
+
+    def _count(self, kind: str, result: str, amount: int = 1):
+        self.stats[result] = self.stats.get(result, 0) + amount
+        TRACE_EVENTS.inc(amount, kind=kind, result=result)
+
+    def _queue(self, kind: str) -> bool:
+        if self.pending >= self.max_events:
+            self._count(kind, "dropped")
+            return False
+        self._count(kind, "queued")
+        self.start()
+        if self.pending + 1 >= self.flush_at:
+            self._wakeup.set()
+        return True
+
+    def update_trace(self, **fields):
+        """Update the current trace like `Langfuse.update_current_trace`."""
+        if not self.enabled:
+            return
+        span = otel_trace.get_current_span()
+        if not span.is_recording():
+            self._count("trace", "sampled_out")
+            return
+        if not self.batched:
+            self.langfuse.update_current_trace(**fields)
+            return
+
+        trace_id = format(span.get_span_context().trace_id, "032x")
+        trace = self._traces.get(trace_id)
+        if trace is None:
+            if not self._queue("trace"):
+                return
+            trace = self._traces[trace_id] = {"id": trace_id}
+        else:
+            self._count("trace", "queued")
+
+        for key, value in fields.items():
+            if key == "metadata" and isinstance(trace.get(key), dict):
+                trace[key] = {**trace[key], **value}
+            elif key == "tags" and key in trace:
+                trace[key] = [*trace[key], *(t for t in value if t not in trace[key])]
+            else:
+                trace[key] = value
+
+    def score(self, trace_id: str, name: str, value, **fields):
+        """Score a trace like `Langfuse.create_score`."""
+        if not self.enabled:
+            return
+        if not self.batched:
+            self.langfuse.create_score(
+                trace_id=trace_id, name=name, value=value, **fields
+            )
+            return
+        if self._queue("score"):
+            self._scores.append(
+                {
+                    "id": uuid.uuid4().hex,
+                    "trace_id": trace_id,
+                    "name": name,
+                    "value": value,
+                    **fields,
+                }
+            )
+
+    def start(self):
+        """Start flushing in the background; a no-op if already running."""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def _take_batch(self) -> list:
+        events = []
+        while self._traces and len(events) < self.flush_at:
+            trace_id = next(iter(self._traces))
+            events.append(
+                IngestionEvent_TraceCreate(
+                    id=uuid.uuid4().hex,
+                    timestamp=_timestamp(),
+                    body=TraceBody(**self._traces.pop(trace_id)),
+                )
+            )
+        while self._scores and len(events) < self.flush_at:
+            events.append(
+                IngestionEvent_ScoreCreate(
+                    id=uuid.uuid4().hex,
+                    timestamp=_timestamp(),
+                    body=ScoreBody(**self._scores.pop(0)),
+                )
+            )
+        return events
+
+    async def flush(self):
+        """Send everything that is queued now."""
+        while self.pending:
+            events = self._take_batch()
+            started = time.perf_counter()
+            try:
+                await run_blocking(self.langfuse.api.ingestion.batch, batch=events)
+            except Exception as e:
+                logger.warning("⚠️ Sending %d trace events failed: %s", len(events), e)
+                self._count("batch", "failed", len(events))
+                continue
+            TRACE_FLUSH_SECONDS.observe(time.perf_counter() - started)
+            self._count("batch", "sent", len(events))
+
+    async def close(self):
+        """Stop the background task and send what is left."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
@@ -0,0 +1,220 @@
+import logging
+import os
+import time
+
+import httpx
+
+from lib.concurrency import backoff
+from lib.metrics import Counter, Gauge, register_collector
+
+logger = logging.getLogger(__name__)
+
+# Statuses worth another attempt: rate limits and transient server errors
+RETRY_STATUSES = frozenset({408, 409, 429, 500, 502, 503, 504})
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+HTTP_REQUESTS = Counter(
+    "mira_http_requests",
+    "HTTP requests sent through the shared transport, by client",
+    ["client"],
+)
+HTTP_CONNECTIONS_OPENED = Counter(
+    "mira_http_connections_opened",
+    "New TCP connections, and TLS handshakes when `tls` is true, by client",
+    ["client", "tls"],
+)
+HTTP_RETRIES = Counter(
+    "mira_http_retries",
+    "Requests retried after a connection error or a retryable status",
+    ["client"],
+)
+HTTP_POOL_CONNECTIONS = Gauge(
+    "mira_http_pool_connections",
+    "Connections held in the pool, by client and idle/active state",
+    ["client", "state"],
+)
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class _RetryingTransport(httpx.HTTPTransport):
+    """Retries idempotent requests on connection errors and retryable statuses."""
+
+    def __init__(self, name: str, max_retries: int, backoff: float, **kwargs):
+        super().__init__(**kwargs)
+        self.name = name
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    def handle_request(self, request):
+        retryable = request.method in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            try:
+                response = super().handle_request(request)
+            except httpx.TransportError:
+                if not retryable or attempt >= self.max_retries:
+                    raise
+            else:
+                if (
+                    not retryable
+                    or attempt >= self.max_retries
+                    or response.status_code not in RETRY_STATUSES
+                ):
+                    return response
+                response.close()
+
+            HTTP_RETRIES.inc(client=self.name)
+            time.sleep(backoff(attempt, self.backoff, cap=8.0))
+            attempt += 1
+
+
+class HttpTransport:
+    """Connection pools and HTTP settings shared by every outbound client.
+
+    OpenAI calls go through one async pool and Langfuse API calls (prompts,
+    scores) through one sync pool, both kept alive between requests and on
+    HTTP/2 when the `h2` package is installed. OpenAI retries with the SDK's
+    own jittered backoff; Langfuse requests retry here. LanceDB's S3 object
+    store gets matching timeouts, pool and retry settings as storage options.
+
+    Request, connection and pool counts are exported as `mira_http_*` metrics.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 60.0,
+        timeout: float = 60.0,
+        connect_timeout: float = 5.0,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        http2: bool = True,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.http2 = http2 and _http2_available()
+        if http2 and not self.http2:
+            logger.warning("⚠️ HTTP/2 needs the h2 package, using HTTP/1.1")
+
+        self._transports = {}
+        self._openai_client = None
+        self._langfuse_client = None
+        register_collector(self._collect_pool_stats)
+
+    @classmethod
+    def from_env(cls):
+        """Build a transport from the RAG_HTTP_* environment variables."""
+        return cls(
+            max_connections=int(os.getenv("RAG_HTTP_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.getenv("RAG_HTTP_MAX_KEEPALIVE", "20")),
+            keepalive_expiry=float(os.getenv("RAG_HTTP_KEEPALIVE_EXPIRY", "60")),
+            timeout=float(os.getenv("RAG_HTTP_TIMEOUT", "60")),
+            connect_timeout=float(os.getenv("RAG_HTTP_CONNECT_TIMEOUT", "5")),
+            max_retries=int(os.getenv("RAG_HTTP_RETRIES", "3")),
+            http2=os.getenv("RAG_HTTP2", "true").lower() == "true",
+        )
+
+    def _event_hooks(self, name: str, is_async: bool) -> dict:
+        def count_connection(event: str):
+            if event == "connection.connect_tcp.complete":
+                HTTP_CONNECTIONS_OPENED.inc(client=name, tls="false")
+            elif event == "connection.start_tls.complete":
+                HTTP_CONNECTIONS_OPENED.inc(client=name, tls="true")
+
+        if is_async:
+
+            async def trace(event, info):
+                count_connection(event)
+
+            async def on_request(request):
+                HTTP_REQUESTS.inc(client=name)
+                request.extensions["trace"] = trace
+
+        else:
+
+            def trace(event, info):
+                count_connection(event)
+
+            def on_request(request):
+                HTTP_REQUESTS.inc(client=name)
+                request.extensions["trace"] = trace
+
+        return {"request": [on_request]}
+
+    @property
+    def openai_client(self) -> httpx.AsyncClient:
+        if self._openai_client is None:
+            transport = httpx.AsyncHTTPTransport(limits=self.limits, http2=self.http2)
+            self._transports["openai"] = transport
+            self._openai_client = httpx.AsyncClient(
+                transport=transport,
+                timeout=self.timeout,
+                event_hooks=self._event_hooks("openai", is_async=True),
+            )
+        return self._openai_client
+
+    @property
+    def langfuse_client(self) -> httpx.Client:
+        if self._langfuse_client is None:
+            transport = _RetryingTransport(
+                "langfuse",
+                self.max_retries,
+                self.backoff,
+                limits=self.limits,
+                http2=self.http2,
+            )
+            self._transports["langfuse"] = transport
+            self._langfuse_client = httpx.Client(
+                transport=transport,
+                timeout=self.timeout,
+                event_hooks=self._event_hooks("langfuse", is_async=False),
+            )
+        return self._langfuse_client
+
+    def openai_options(self) -> dict:
+        """Keyword arguments for `AsyncOpenAI` to use the shared pool."""
+        return {
+            "http_client": self.openai_client,
+            "timeout": self.timeout,
+            "max_retries": self.max_retries,
+        }
+
+    def storage_options(self) -> dict:
+        """LanceDB object store options with the same timeouts and retries."""
+        return {
+            "timeout": f"{self.timeout.read:g}s",
+            "connect_timeout": f"{self.timeout.connect:g}s",
+            "pool_idle_timeout": f"{self.limits.keepalive_expiry:g}s",
+            "pool_max_idle_per_host": str(self.limits.max_keepalive_connections),
+            "client_max_retries": str(self.max_retries),
+        }
+
+    def pool_stats(self) -> dict:
+        """Idle and active connections in each client's pool."""
+        stats = {}
+        for name, transport in self._transports.items():
+            # httpx doesn't expose its connection pool publicly
+            connections = getattr(getattr(transport, "_pool", None), "connections", [])
+            idle = sum(connection.is_idle() for connection in connections)
+            stats[name] = {"idle": idle, "active": len(connections) - idle}
+        return stats
+
+    def _collect_pool_stats(self):
+        for name, counts in self.pool_stats().items():
+            for state, count in counts.items():
+                HTTP_POOL_CONNECTIONS.set(count, client=name, state=state)
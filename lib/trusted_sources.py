@@ -0,0 +1,34 @@
+from functools import lru_cache
+from urllib.parse import urlparse
+
+# Sites web-search answers may be based on, including their subdomains
+TRUSTED_DOMAINS = (
+    "molecule.to",
+    "molecule.xyz",
+    "bio.xyz",
+    "vitadao.com",
+)
+
+
+class TrustedDomainMatcher:
+    """Checks citation URLs against trusted domains by hostname suffix.
+
+    `molecule.to` and `docs.molecule.to` match `molecule.to`, while lookalikes
+    such as `notmolecule.to` or `molecule.to.example.com` don't. Hostnames
+    are checked label by label against a set, and results are memoized.
+    """
+
+    def __init__(self, domains=TRUSTED_DOMAINS):
+        self.domains = frozenset(domain.lower().strip(".") for domain in domains)
+        self._match_host = lru_cache(maxsize=4096)(self._match_host)
+
+    def _match_host(self, host: str) -> bool:
+        labels = host.split(".")
+        return any(".".join(labels[i:]) in self.domains for i in range(len(labels) - 1))
+
+    def match(self, url: str):
+        """Return the URL's domain, without `www.`, if it is trusted, else None."""
+        host = (urlparse(url).hostname or "").rstrip(".")
+        if not host or not self._match_host(host):
+            return None
+        return host[4:] if host.startswith("www.") else host
@@ -1,8 +1,25 @@
+from contextlib import asynccontextmanager
+
 from chainlit.utils import mount_chainlit
 from fastapi import FastAPI
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
+
+from lib import metrics
+from lib.service import get_rag, get_sessions
+
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Serve right away and load the knowledge base, tokenizer and prompts
+    # in the background; /readyz reports when questions can be answered
+    rag = get_rag()
+    rag.start()
+    yield
+    await rag.close()
+    await get_sessions().close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/robots.txt")
@@ -10,4 +27,27 @@ async def robots():
     return FileResponse("public/robots.txt")
 
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/healthz")
+async def liveness():
+    """The process is up and its event loop responds."""
+    return {"status": "alive"}
+
+
+@app.get("/readyz")
+async def readiness():
+    """Ready once the knowledge base is open, with per-component startup state."""
+    rag = get_rag()
+    return JSONResponse(
+        {"ready": rag.ready, "components": rag.startup.report()},
+        status_code=200 if rag.ready else 503,
+    )
+
+
 mount_chainlit(app=app, target="app.py", path="/")
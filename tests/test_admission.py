@@ -0,0 +1,143 @@
+import asyncio
+import time
+
+import pytest
+
+from lib.admission import (
+    BUSY_MESSAGE,
+    SESSION_MESSAGE,
+    AdmissionController,
+    AdmissionRejected,
+    TokenBucket,
+    admission_session,
+    parse_limits,
+    without_session,
+)
+
+
+def test_token_bucket_allows_bursts_then_the_rate():
+    bucket = TokenBucket(rate=1.0, capacity=2)
+    assert bucket.full
+    bucket.take()
+    bucket.take()
+    assert bucket.delay() == pytest.approx(1.0, abs=0.05)
+    # Larger than the bucket, waits for a full one
+    assert bucket.delay(5) == pytest.approx(2.0, abs=0.05)
+
+
+def test_parse_limits():
+    assert parse_limits("gpt-4o=500, gpt-4o-search-preview=100,") == {
+        "gpt-4o": 500.0,
+        "gpt-4o-search-preview": 100.0,
+    }
+
+
+def test_from_env_divides_model_limits_among_workers(monkeypatch):
+    monkeypatch.setenv("RAG_LLM_RPM", "gpt-4o=600")
+    monkeypatch.setenv("RAG_LLM_TPM", "gpt-4o=30000")
+    monkeypatch.setenv("RAG_LLM_WORKERS", "3")
+    controller = AdmissionController.from_env()
+    requests, tokens = (bucket for bucket, _ in controller.limits["gpt-4o"].buckets)
+    assert requests.rate == pytest.approx(200 / 60)
+    assert tokens.rate == pytest.approx(10000 / 60)
+
+
+def test_calls_within_the_limit_are_admitted_right_away():
+    async def main():
+        controller = AdmissionController({"m": {"rpm": 60}})
+        for _ in range(10):
+            await controller.admit("m")
+        # Models without limits are never held
+        await controller.admit("other")
+        assert controller.stats == {"admitted": 11, "queued": 0, "rejected": 0}
+
+    asyncio.run(main())
+
+
+def test_evaluation_goes_first_and_sessions_take_turns():
+    async def main():
+        # One call a tenth of a second after the burst of 10
+        controller = AdmissionController({"m": {"rpm": 600}}, max_wait=5)
+        for _ in range(100):
+            await controller.admit("m")
+        order = []
+
+        async def call(session, priority, number):
+            with admission_session(session):
+                await controller.admit("m", priority)
+            order.append((session, number))
+
+        tasks = [asyncio.create_task(call("greedy", "generation", i)) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(call("other", "generation", 0)))
+        tasks.append(asyncio.create_task(call("third", "evaluation", 0)))
+        await asyncio.gather(*tasks)
+        assert order == [
+            ("third", 0),
+            ("greedy", 0),
+            ("other", 0),
+            ("greedy", 1),
+            ("greedy", 2),
+        ]
+
+    asyncio.run(main())
+
+
+def test_full_queue_and_timeout_reject_as_busy():
+    async def main():
+        controller = AdmissionController({"m": {"rpm": 6}}, max_queue=1, max_wait=0.1)
+        await controller.admit("m")
+        waiting = asyncio.create_task(controller.admit("m"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as full:
+            await controller.admit("m")
+        assert full.value.reason == "queue_full"
+        with pytest.raises(AdmissionRejected) as timeout:
+            await waiting
+        assert timeout.value.reason == "timeout"
+        assert timeout.value.message == BUSY_MESSAGE
+
+    asyncio.run(main())
+
+
+def test_throttle_holds_the_model():
+    async def main():
+        controller = AdmissionController({})
+        controller.throttle("m", 0.1)
+        started = time.monotonic()
+        await controller.admit("m")
+        assert time.monotonic() - started >= 0.09
+
+    asyncio.run(main())
+
+
+def test_session_limit_counts_questions():
+    controller = AdmissionController({}, session_rpm=60, session_burst=2)
+    with admission_session("s1"):
+        controller.check_session()
+        controller.check_session()
+        with pytest.raises(AdmissionRejected) as rejected:
+            controller.check_session()
+        assert rejected.value.reason == "session_rate"
+        assert rejected.value.message == SESSION_MESSAGE
+    with admission_session("s2"):
+        controller.check_session()
+    # Work outside of a session isn't limited
+    for _ in range(5):
+        controller.check_session()
+
+
+def test_shared_work_runs_outside_of_sessions():
+    controller = AdmissionController({}, session_rpm=60, session_burst=1)
+
+    async def shared():
+        # Would be rejected if it counted against the asker's session
+        controller.check_session()
+        yield "token"
+
+    async def main():
+        with admission_session("s1"):
+            controller.check_session()
+            return [event async for event in without_session(shared())]
+
+    assert asyncio.run(main()) == ["token"]
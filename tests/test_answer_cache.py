@@ -0,0 +1,46 @@
+import time
+
+from lib.answer_cache import SemanticAnswerCache
+
+
+def store(cache, vector, route="SUFFICIENT", version="v1"):
+    cache.store(vector, version, f"answer to {vector}", ("context", []), route)
+
+
+def test_similar_questions_hit():
+    cache = SemanticAnswerCache(threshold=0.97)
+    store(cache, [1.0, 0.0])
+    assert cache.lookup([10.0, 0.1], "v1")["answer"] == "answer to [1.0, 0.0]"
+    assert cache.lookup([1.0, 1.0], "v1") is None
+    assert cache.stats["hits"] == cache.stats["misses"] == 1
+
+
+def test_new_knowledge_version_empties_the_cache():
+    cache = SemanticAnswerCache()
+    store(cache, [1.0, 0.0])
+    assert cache.lookup([1.0, 0.0], "v2") is None
+    assert len(cache) == 0
+
+
+def test_web_search_answers_are_not_cached_by_default():
+    cache = SemanticAnswerCache()
+    store(cache, [1.0, 0.0], route="INSUFFICIENT_BUT_RELEVANT")
+    assert len(cache) == 0
+
+    cache = SemanticAnswerCache(route_ttls={"INSUFFICIENT_BUT_RELEVANT": 0.01})
+    store(cache, [1.0, 0.0], route="INSUFFICIENT_BUT_RELEVANT")
+    store(cache, [0.0, 1.0])
+    time.sleep(0.02)
+    # Only the web search answer has expired
+    assert cache.lookup([1.0, 0.0], "v1") is None
+    assert cache.lookup([0.0, 1.0], "v1") is not None
+
+
+def test_least_recently_used_answers_are_dropped():
+    cache = SemanticAnswerCache(max_entries=2)
+    store(cache, [1.0, 0.0, 0.0])
+    store(cache, [0.0, 1.0, 0.0])
+    cache.lookup([1.0, 0.0, 0.0], "v1")
+    store(cache, [0.0, 0.0, 1.0])
+    assert cache.lookup([0.0, 1.0, 0.0], "v1") is None
+    assert cache.lookup([1.0, 0.0, 0.0], "v1") is not None
@@ -0,0 +1,118 @@
+import asyncio
+import importlib
+import uuid
+
+import chainlit as cl
+import pytest
+from chainlit.config import config
+from chainlit.context import ChainlitContext, context_var
+from chainlit.emitter import BaseChainlitEmitter
+from chainlit.session import HTTPSession
+
+from lib.sessions import InMemorySessionStore
+
+
+class RecordingEmitter(BaseChainlitEmitter):
+    """Records what the chat handler sends to the browser."""
+
+    def __init__(self, session):
+        super().__init__(session)
+        self.events = []
+
+    async def emit(self, event, data):
+        self.events.append((event, data))
+
+    async def send_step(self, step_dict):
+        self.events.append(("send_step", step_dict))
+
+    async def stream_start(self, step_dict):
+        self.events.append(("stream_start", step_dict))
+
+    async def send_token(self, id, token, is_sequence=False):
+        self.events.append(("send_token", token))
+
+    async def update_step(self, step_dict):
+        self.events.append(("update_step", step_dict))
+
+    async def delete_step(self, step_dict):
+        self.events.append(("delete_step", step_dict))
+
+
+class FakeRAG:
+    """Answers every question with the same local answer."""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    async def get_knowledge_version(self):
+        return "v1"
+
+    async def stream_answer(self, query, message_history=None):
+        yield "route", "SUFFICIENT"
+        yield "context", ("context", [])
+        for token in self.tokens:
+            yield "token", token
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setenv("LANGFUSE_TRACING_ENABLED", "false")
+    return importlib.import_module("app")
+
+
+def chat(app, monkeypatch, tokens):
+    """Handle one message and return the events sent and the session store."""
+    sessions = InMemorySessionStore()
+    monkeypatch.setattr(app, "rag", FakeRAG(tokens))
+    monkeypatch.setattr(app, "sessions", sessions)
+
+    async def main():
+        session = HTTPSession(
+            id=str(uuid.uuid4()), thread_id=str(uuid.uuid4()), client_type="webapp"
+        )
+        emitter = RecordingEmitter(session)
+        context_var.set(ChainlitContext(session, emitter))
+        await app.handle_message(cl.Message(content="What is DeSci?"))
+        return emitter.events
+
+    return asyncio.run(main()), sessions
+
+
+def test_answer_is_sent_with_its_feedback_actions(app, monkeypatch):
+    events, sessions = chat(app, monkeypatch, ["DeSci ", "is ", "open science."])
+
+    assert [token for event, token in events if event == "send_token"] == [
+        "is ",
+        "open science.",
+    ]
+    [answer] = [data for event, data in events if event == "send_step"][-1:]
+    assert answer["output"] == "DeSci is open science."
+
+    actions = [data for event, data in events if event == "action"]
+    assert [action["name"] for action in actions] == [
+        "thumbs_up_button",
+        "thumbs_down_button",
+    ]
+    assert {action["forId"] for action in actions} == {answer["id"]}
+    assert {action["payload"]["message_id"] for action in actions} == {answer["id"]}
+
+    # Stored so a click on any worker can remove them
+    stored = asyncio.run(sessions.pop_actions(answer["id"]))
+    assert [action["name"] for action in stored] == [
+        "thumbs_up_button",
+        "thumbs_down_button",
+    ]
+
+
+def test_empty_answer_removes_the_thinking_indicator(app, monkeypatch):
+    events, _ = chat(app, monkeypatch, [])
+    [thinking] = [data for event, data in events if event == "delete_step"]
+    assert thinking["output"] == "🤔 Thinking..."
+    assert [data for event, data in events if event == "action"]
+
+
+def test_sessions_outlive_disconnects(app):
+    # Chainlit ends the chat on every socket disconnect, so deleting the
+    # session there would lose the history of a client that reconnects
+    assert config.code.on_chat_end is None
@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+import pytest
+
+from lib.batch import load_checkpoint, parse_args, run_batch
+
+
+class FakeRAG:
+    """Fails the questions in `failing`, answers the rest."""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.asked = []
+
+    async def answer_batch(self, questions, max_attempts, limiter, **options):
+        for question in questions:
+            self.asked.append(question["id"])
+            if question["id"] in self.failing:
+                yield {**question, "error": "RateLimitError: slow down"}
+            else:
+                yield {**question, "route": "SUFFICIENT", "answer": "yes"}
+
+
+def read_rows(path) -> list:
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_retried_questions_keep_one_row(tmp_path):
+    output = str(tmp_path / "answers.jsonl")
+    questions = [{"id": i, "query": f"question {i}"} for i in range(3)]
+
+    stats = asyncio.run(run_batch(FakeRAG(failing={1}), questions, output))
+    assert (stats["answered"], stats["failed"]) == (2, 1)
+    # Killed while writing a row
+    with open(output, "a") as f:
+        f.write('{"id": 3, "que')
+
+    rag = FakeRAG()
+    stats = asyncio.run(run_batch(rag, questions, output))
+    assert rag.asked == [1]
+    assert (stats["answered"], stats["resumed"]) == (1, 2)
+    rows = read_rows(output)
+    assert sorted(row["id"] for row in rows) == [0, 1, 2]
+    assert not [row for row in rows if "error" in row]
+
+
+def test_load_checkpoint_leaves_clean_files_alone(tmp_path):
+    output = tmp_path / "answers.jsonl"
+    output.write_text('{"id": 1, "query": "q", "route": "SUFFICIENT"}\n')
+    modified = output.stat().st_mtime_ns
+    assert list(load_checkpoint(str(output))) == [1]
+    assert output.stat().st_mtime_ns == modified
+
+
+def test_max_attempts_must_be_positive(tmp_path, capsys):
+    with pytest.raises(SystemExit):
+        parse_args(["q.jsonl", "--output", "a.jsonl", "--max-attempts", "0"])
+    assert "must be at least 1" in capsys.readouterr().err
+
+    output = str(tmp_path / "answers.jsonl")
+    with pytest.raises(ValueError):
+        asyncio.run(run_batch(FakeRAG(), [], output, max_attempts=0))
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from lib.coalescing import AnswerCoalescer
+
+
+def collect(coalescer, key, produce):
+    async def run():
+        return [event async for event in coalescer.stream(key, produce)]
+
+    return asyncio.create_task(run())
+
+
+def test_identical_requests_share_one_pipeline():
+    started = []
+
+    async def produce(key):
+        started.append(key)
+        for i in range(3):
+            await asyncio.sleep(0.01)
+            yield key, i
+
+    async def main():
+        coalescer = AnswerCoalescer()
+        first = collect(coalescer, "a", lambda: produce("a"))
+        await asyncio.sleep(0.015)
+        # Joins late and catches up on the event it missed
+        second = collect(coalescer, "a", lambda: produce("a"))
+        other = collect(coalescer, "b", lambda: produce("b"))
+        results = await asyncio.gather(first, second, other)
+        assert "a" not in coalescer
+        return coalescer.stats, results
+
+    stats, (first, second, other) = asyncio.run(main())
+    assert started == ["a", "b"]
+    assert first == second == [("a", 0), ("a", 1), ("a", 2)]
+    assert other == [("b", 0), ("b", 1), ("b", 2)]
+    assert stats == {"started": 2, "coalesced": 1}
+
+
+def test_errors_reach_every_subscriber():
+    async def produce():
+        await asyncio.sleep(0.01)
+        yield 1
+        raise ValueError("boom")
+
+    async def main():
+        coalescer = AnswerCoalescer()
+        tasks = [collect(coalescer, "a", produce) for _ in range(2)]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert [type(result) for result in results] == [ValueError, ValueError]
+
+
+def test_pipeline_is_cancelled_once_nobody_listens():
+    async def main():
+        stopped = asyncio.Event()
+
+        async def produce():
+            try:
+                while True:
+                    await asyncio.sleep(0.01)
+                    yield "token"
+            finally:
+                stopped.set()
+
+        coalescer = AnswerCoalescer()
+        tasks = [collect(coalescer, "a", produce) for _ in range(2)]
+        await asyncio.sleep(0.02)
+        tasks[0].cancel()
+        await asyncio.sleep(0.02)
+        # One subscriber is still listening
+        assert not stopped.is_set()
+        tasks[1].cancel()
+        await asyncio.wait_for(stopped.wait(), 1)
+        assert "a" not in coalescer
+        with pytest.raises(asyncio.CancelledError):
+            await tasks[1]
+
+    asyncio.run(main())
@@ -0,0 +1,90 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from lib.embeddings import QueryEmbedder, normalize_vector
+
+
+class FakeEmbeddings:
+    """Records the batches it is asked to embed."""
+
+    def __init__(self, fail: bool = False):
+        self.batches = []
+        self.fail = fail
+
+    def __call__(self, texts):
+        self.batches.append(list(texts))
+        if self.fail:
+            raise RuntimeError("embedding service down")
+        return [[float(len(text))] for text in texts]
+
+
+def test_concurrent_queries_go_out_in_one_batch():
+    embeddings = FakeEmbeddings()
+
+    async def main():
+        embedder = QueryEmbedder(embeddings, batch_window=0.01)
+        vectors = await asyncio.gather(
+            embedder.embed("What is DeSci?"),
+            embedder.embed("what is desci?"),
+            embedder.embed("IP-NFT"),
+        )
+        return embedder.stats, vectors
+
+    stats, vectors = asyncio.run(main())
+    # Same normalized text, embedded once
+    assert embeddings.batches == [["What is DeSci?", "IP-NFT"]]
+    assert vectors == [[14.0], [14.0], [6.0]]
+    assert stats == {"hits": 0, "misses": 2, "coalesced": 1, "requests": 1}
+
+
+def test_full_batches_are_sent_without_waiting():
+    embeddings = FakeEmbeddings()
+
+    async def main():
+        embedder = QueryEmbedder(embeddings, batch_window=10, max_batch=2)
+        await asyncio.wait_for(
+            asyncio.gather(embedder.embed("a"), embedder.embed("bb")), 1
+        )
+
+    asyncio.run(main())
+    assert embeddings.batches == [["a", "bb"]]
+
+
+def test_cache_keeps_the_most_recent_queries():
+    embeddings = FakeEmbeddings()
+
+    async def main():
+        embedder = QueryEmbedder(embeddings, cache_size=2, batch_window=0)
+        for query in ("a", "b", "a", "c", "a", "b"):
+            await embedder.embed(query)
+        return embedder.stats
+
+    stats = asyncio.run(main())
+    # "b" was the least recently used when "c" came in
+    assert embeddings.batches == [["a"], ["b"], ["c"], ["b"]]
+    assert stats["hits"] == 2
+
+
+def test_errors_reach_every_caller_and_are_not_cached():
+    embeddings = FakeEmbeddings(fail=True)
+
+    async def main():
+        embedder = QueryEmbedder(embeddings, batch_window=0.01)
+        results = await asyncio.gather(
+            embedder.embed("a"), embedder.embed("a"), return_exceptions=True
+        )
+        embeddings.fail = False
+        return results, await embedder.embed("a")
+
+    results, vector = asyncio.run(main())
+    assert [type(result) for result in results] == [RuntimeError, RuntimeError]
+    assert vector == [1.0]
+
+
+def test_normalize_vector():
+    vector = normalize_vector([3, 4])
+    assert vector.dtype == np.float32
+    assert vector.tolist() == pytest.approx([0.6, 0.8])
+    assert normalize_vector([0, 0]).tolist() == [0, 0]
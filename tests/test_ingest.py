@@ -0,0 +1,150 @@
+import lancedb
+import pytest
+from lancedb.embeddings import get_registry
+from lancedb.pydantic import LanceModel, Vector
+
+# Registers the deterministic "bench-hash" embeddings
+import bench.retrieval  # noqa: F401
+from lib.ingest import chunk_text, ingest
+
+DOCUMENTS = [
+    {
+        "text": "Molecule funds early stage research.\n\nIP-NFTs hold the rights.",
+        "url": "https://example.com/molecule",
+        "page_title": "Molecule",
+        "source": "docs",
+    },
+    {
+        "text": "DeSci moves science onto open networks.",
+        "url": "https://example.com/desci",
+        "page_title": "DeSci",
+        "source": "blog",
+    },
+]
+
+
+@pytest.fixture
+def db(tmp_path):
+    return lancedb.connect(str(tmp_path))
+
+
+@pytest.fixture
+def embedding():
+    return get_registry().get("bench-hash").create(dim=16)
+
+
+def knowledge_version(db) -> str:
+    rows = db.open_table("config").to_arrow().to_pylist()
+    return {row["key"]: row["value"] for row in rows}["knowledge_version"]
+
+
+def texts(db) -> set:
+    return set(db.open_table("molrag").to_arrow().column("text").to_pylist())
+
+
+def ingest_small(db, documents, **options):
+    # Small chunks, so each paragraph is a chunk of its own
+    return ingest(db, documents, chunk_words=8, overlap_words=2, **options)
+
+
+def test_first_run_adds_every_chunk(db, embedding):
+    stats = ingest_small(db, DOCUMENTS, embedding=embedding, version="v1")
+    assert stats["documents"] == 2
+    assert stats["added"] == stats["chunks"] == 3
+    assert stats["deleted"] == stats["unchanged"] == 0
+    assert stats["knowledge_version"] == "v1"
+    assert knowledge_version(db) == "v1"
+    assert db.open_table("molrag").count_rows() == 3
+
+
+def test_rerun_is_a_no_op(db, embedding):
+    ingest_small(db, DOCUMENTS, embedding=embedding, version="v1")
+    table_version = db.open_table("molrag").version
+
+    stats = ingest_small(db, DOCUMENTS, version="v2")
+    assert stats["added"] == stats["deleted"] == 0
+    assert stats["unchanged"] == 3
+    assert stats["knowledge_version"] is None
+    # Neither the table nor the knowledge version was written
+    assert db.open_table("molrag").version == table_version
+    assert knowledge_version(db) == "v1"
+
+
+def test_changed_chunk_is_replaced(db, embedding):
+    ingest_small(db, DOCUMENTS, embedding=embedding, version="v1")
+    changed = [
+        {**DOCUMENTS[0], "text": DOCUMENTS[0]["text"].replace("rights", "IP")},
+        DOCUMENTS[1],
+    ]
+
+    stats = ingest_small(db, changed)
+    assert (stats["added"], stats["deleted"], stats["unchanged"]) == (1, 1, 2)
+    assert "IP-NFTs hold the IP." in texts(db)
+    assert "IP-NFTs hold the rights." not in texts(db)
+    # Bumped to the default version, a timestamp and content fingerprint
+    assert knowledge_version(db) == stats["knowledge_version"] != "v1"
+
+
+def test_partial_keeps_other_urls(db, embedding):
+    ingest_small(db, DOCUMENTS, embedding=embedding)
+    update = {**DOCUMENTS[1], "text": "DeSci funds research in the open."}
+
+    stats = ingest_small(db, [update], partial=True)
+    assert (stats["added"], stats["deleted"]) == (1, 1)
+    assert texts(db) == {
+        "Molecule funds early stage research.",
+        "IP-NFTs hold the rights.",
+        "DeSci funds research in the open.",
+    }
+
+    # Without --partial the input is the whole corpus
+    stats = ingest_small(db, [update])
+    assert stats["deleted"] == 2
+    assert texts(db) == {"DeSci funds research in the open."}
+
+
+def test_table_without_hashes_is_rebuilt(db, embedding):
+    class Metadata(LanceModel):
+        url: str
+        page_title: str
+        source: str
+
+    class OldChunk(LanceModel):
+        text: str = embedding.SourceField()
+        vector: Vector(embedding.ndims()) = embedding.VectorField()
+        metadata: Metadata
+
+    old = db.create_table("molrag", schema=OldChunk)
+    old.add(
+        [
+            {
+                "text": "Stale chunk",
+                "metadata": {"url": "old", "page_title": "Old", "source": "docs"},
+            }
+        ]
+    )
+
+    stats = ingest_small(db, DOCUMENTS, version="v1")
+    assert (stats["added"], stats["deleted"]) == (3, 1)
+    table = db.open_table("molrag")
+    assert "chunk_hash" in table.schema.names
+    assert "Stale chunk" not in texts(db)
+    assert knowledge_version(db) == "v1"
+
+    # Hashes are there now, so the next run changes nothing
+    assert ingest_small(db, DOCUMENTS)["knowledge_version"] is None
+
+
+def test_missing_table_needs_an_embedding(db):
+    with pytest.raises(ValueError):
+        ingest(db, DOCUMENTS)
+
+
+def test_chunk_text_packs_paragraphs_and_splits_long_ones():
+    assert chunk_text("a b\n\nc d\n\ne", chunk_words=4) == ["a b c d", "e"]
+    words = " ".join(str(i) for i in range(10))
+    assert chunk_text(words, chunk_words=4, overlap_words=1) == [
+        "0 1 2 3",
+        "3 4 5 6",
+        "6 7 8 9",
+    ]
@@ -0,0 +1,54 @@
+import os
+from datetime import timedelta
+
+import lancedb
+
+from lib.local_mirror import LocalMirror
+
+
+def files(root: str) -> set:
+    return {
+        os.path.relpath(os.path.join(directory, name), root)
+        for directory, _, names in os.walk(root)
+        for name in names
+    }
+
+
+def rows(start: int, count: int) -> list:
+    return [{"id": i, "text": f"chunk {i}"} for i in range(start, start + count)]
+
+
+def test_sync_copies_new_files_and_deletes_removed_ones(tmp_path):
+    # A local directory stands in for the S3 bucket
+    remote = lancedb.connect(str(tmp_path / "remote"))
+    table = remote.create_table("molrag", data=rows(0, 10))
+    mirror = LocalMirror(str(tmp_path / "remote"), {}, str(tmp_path / "local"))
+    assert mirror.synced_version is None
+
+    mirror.sync("v1")
+    assert mirror.synced_version == "v1"
+    assert mirror.open_table("molrag").count_rows() == 10
+
+    # Compacting rewrites the fragments and cleans up the old versions
+    for start in (10, 20):
+        table.add(rows(start, 10))
+    table.optimize(cleanup_older_than=timedelta(0))
+
+    mirror.sync("v2")
+    assert mirror.synced_version == "v2"
+    assert mirror.open_table("molrag").count_rows() == 30
+    assert files(tmp_path / "local" / "molrag.lance") == files(
+        tmp_path / "remote" / "molrag.lance"
+    )
+
+
+def test_unchanged_files_are_not_copied_again(tmp_path):
+    remote = lancedb.connect(str(tmp_path / "remote"))
+    remote.create_table("molrag", data=rows(0, 10))
+    mirror = LocalMirror(str(tmp_path / "remote"), {}, str(tmp_path / "local"))
+    mirror.sync("v1")
+
+    data_dir = tmp_path / "local" / "molrag.lance" / "data"
+    modified = {path: os.path.getmtime(path) for path in data_dir.iterdir()}
+    mirror.sync("v1")
+    assert {path: os.path.getmtime(path) for path in data_dir.iterdir()} == modified
@@ -0,0 +1,34 @@
+import asyncio
+import time
+
+import pytest
+
+from lib.metrics import StageTimer, capture_stages, render, time_stage
+
+
+def test_stage_timer_leaves_out_the_time_between_running_parts():
+    async def tokens():
+        with StageTimer("filter") as timer:
+            for token in ("a", "b"):
+                with timer.running():
+                    await asyncio.sleep(0.01)
+                yield token
+
+    async def main():
+        with capture_stages() as stages:
+            async for _ in tokens():
+                # A slow consumer
+                await asyncio.sleep(0.05)
+        return stages
+
+    stages = asyncio.run(main())
+    assert 0.02 <= stages["filter"] < 0.07
+
+
+def test_stages_are_recorded_when_the_block_raises():
+    with capture_stages() as stages, pytest.raises(ValueError):
+        with time_stage("evaluation"):
+            time.sleep(0.01)
+            raise ValueError
+    assert stages["evaluation"] >= 0.01
+    assert 'mira_stage_seconds_count{stage="evaluation"}' in render()
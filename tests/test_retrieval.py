@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+from bench.retrieval import FIXTURES, _read_jsonl, build_table
+from lib.context_budget import ContextBudget
+from lib.reranking import RelevanceCutoff
+from lib.retrieval import Retriever
+
+
+@pytest.fixture(scope="module")
+def table(tmp_path_factory):
+    corpus = _read_jsonl(f"{FIXTURES}/corpus.jsonl")
+    return build_table(str(tmp_path_factory.mktemp("db")), corpus)
+
+
+def urls(retriever, query_type) -> list:
+    async def search():
+        results = []
+        for query in _read_jsonl(f"{FIXTURES}/queries.jsonl"):
+            _, documents = await retriever.get_context(query["query"], 8, query_type)
+            results.append([document.url for document in documents])
+        return results
+
+    return asyncio.run(search())
+
+
+def test_cutoff_applies_to_hybrid_search_only(table):
+    budget = ContextBudget(model=None)
+    plain = Retriever(table, budget)
+    cut = Retriever(table, budget, cutoff=RelevanceCutoff(), candidates=24)
+
+    for query_type in ("vector", "fts"):
+        assert urls(cut, query_type) == urls(plain, query_type)
+
+    hybrid = urls(cut, "hybrid")
+    assert all(1 <= len(found) <= 8 for found in hybrid)
+    assert sum(map(len, hybrid)) < sum(map(len, urls(plain, "hybrid")))
@@ -0,0 +1,141 @@
+import asyncio
+
+import pytest
+
+from lib.sessions import (
+    InMemorySessionStore,
+    RedisSessionStore,
+    SessionStore,
+    SQLiteSessionStore,
+)
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def make_store(request, tmp_path):
+    """Build a store of each backend with the given options."""
+    if request.param == "memory":
+        return InMemorySessionStore
+    if request.param == "sqlite":
+        return lambda **options: SQLiteSessionStore(
+            str(tmp_path / "sessions.db"), **options
+        )
+
+    fakeredis = pytest.importorskip("fakeredis")
+
+    def make_redis(**options):
+        store = RedisSessionStore("redis://localhost", **options)
+        store.redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+        return store
+
+    return make_redis
+
+
+def run(store, check):
+    async def main():
+        try:
+            await check(store)
+        finally:
+            await store.close()
+
+    asyncio.run(main())
+
+
+def test_fields(make_store):
+    async def check(store):
+        assert await store.get_fields("s1") == {}
+        await store.set_fields("s1", uuid="u1", knowledge_version="v1")
+        await store.set_fields("s1", knowledge_version="v2")
+        assert await store.get_fields("s1") == {
+            "uuid": "u1",
+            "knowledge_version": "v2",
+        }
+        assert await store.get_fields("s2") == {}
+
+    run(make_store(), check)
+
+
+def test_history_keeps_the_last_messages(make_store):
+    async def check(store):
+        for turn in range(3):
+            await store.append_history(
+                "s1",
+                {"role": "user", "content": f"question {turn}"},
+                {"role": "assistant", "content": f"answer {turn}"},
+            )
+        assert await store.history("s1") == [
+            {"role": "assistant", "content": "answer 1"},
+            {"role": "user", "content": "question 2"},
+            {"role": "assistant", "content": "answer 2"},
+        ]
+        assert await store.history("s2") == []
+
+    run(make_store(max_messages=3), check)
+
+
+def test_delete_session(make_store):
+    async def check(store):
+        await store.set_fields("s1", uuid="u1")
+        await store.append_history("s1", {"role": "user", "content": "hi"})
+        await store.set_fields("s2", uuid="u2")
+        await store.delete_session("s1")
+        assert await store.get_fields("s1") == {}
+        assert await store.history("s1") == []
+        assert await store.get_fields("s2") == {"uuid": "u2"}
+
+    run(make_store(), check)
+
+
+def test_actions_are_popped_once(make_store):
+    async def check(store):
+        actions = [{"name": "thumbs_up_button", "forId": "m1"}]
+        await store.save_actions("m1", actions)
+        assert await store.pop_actions("m1") == actions
+        assert await store.pop_actions("m1") == []
+        assert await store.pop_actions("m2") == []
+
+    run(make_store(), check)
+
+
+def test_sessions_expire(make_store, request):
+    if "redis" in request.node.callspec.id:
+        pytest.skip("Redis expiry is the server's")
+
+    async def check(store):
+        await store.set_fields("s1", uuid="u1")
+        await store.append_history("s1", {"role": "user", "content": "hi"})
+        await store.save_actions("m1", [{"name": "thumbs_up_button"}])
+        await asyncio.sleep(0.05)
+        assert await store.get_fields("s1") == {}
+        assert await store.history("s1") == []
+        assert await store.pop_actions("m1") == []
+
+    run(make_store(ttl=0.01), check)
+
+
+def test_sqlite_is_shared_by_stores(tmp_path):
+    path = str(tmp_path / "sessions.db")
+
+    async def check(store):
+        await store.set_fields("s1", uuid="u1")
+        await store.save_actions("m1", [{"name": "thumbs_up_button"}])
+        # Another worker opening the same file
+        other = SQLiteSessionStore(path)
+        try:
+            assert await other.get_fields("s1") == {"uuid": "u1"}
+            assert await other.pop_actions("m1") == [{"name": "thumbs_up_button"}]
+        finally:
+            await other.close()
+        assert await store.pop_actions("m1") == []
+
+    run(SQLiteSessionStore(path), check)
+
+
+def test_from_url():
+    assert isinstance(SessionStore.from_url("memory://"), InMemorySessionStore)
+    store = SessionStore.from_url("sqlite:///tmp/sessions.db")
+    assert isinstance(store, SQLiteSessionStore)
+    assert store.path == "/tmp/sessions.db"
+    with pytest.raises(ValueError):
+        SessionStore.from_url("postgres://localhost")
+    with pytest.raises(TypeError):
+        SessionStore()
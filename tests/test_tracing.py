@@ -0,0 +1,98 @@
+import asyncio
+from types import SimpleNamespace
+
+from opentelemetry.sdk.trace import TracerProvider
+
+from lib.tracing import (
+    TraceBuffer,
+    parse_sample_rates,
+    sampled_tracer_provider,
+    trace_route,
+)
+
+# Spans of a provider without exporters are recorded, nothing is sent
+tracer = TracerProvider().get_tracer(__name__)
+
+
+class FakeLangfuse:
+    """Records the ingestion batches sent to it."""
+
+    def __init__(self, fail: bool = False):
+        self.batches = []
+        self.fail = fail
+        self.api = SimpleNamespace(ingestion=SimpleNamespace(batch=self._batch))
+
+    def _batch(self, batch):
+        if self.fail:
+            raise RuntimeError("Langfuse is down")
+        self.batches.append(batch)
+
+
+def test_updates_to_a_trace_are_merged():
+    langfuse = FakeLangfuse()
+
+    async def main():
+        buffer = TraceBuffer(langfuse, flush_interval=60)
+        with tracer.start_as_current_span("chat"):
+            buffer.update_trace(input="hi", tags=["v1"], metadata={"a": 1})
+            buffer.update_trace(tags=["v1", "local"], metadata={"b": 2})
+            buffer.update_trace(output="hello")
+        buffer.score("t1", name="user_feedback_helpful", value=1)
+        assert buffer.pending == 2
+        await buffer.close()
+        return buffer.stats
+
+    stats = asyncio.run(main())
+    [batch] = langfuse.batches
+    trace, score = (event.body for event in batch)
+    assert (trace.input, trace.output) == ("hi", "hello")
+    assert trace.tags == ["v1", "local"]
+    assert trace.metadata == {"a": 1, "b": 2}
+    assert (score.trace_id, score.value) == ("t1", 1)
+    assert stats["queued"] == 4
+    assert stats["sent"] == 2
+
+
+def test_full_buffer_drops_and_failed_sends_are_counted():
+    langfuse = FakeLangfuse(fail=True)
+
+    async def main():
+        buffer = TraceBuffer(langfuse, max_events=2, flush_interval=60)
+        for trace_id in ("t1", "t2", "t3"):
+            buffer.score(trace_id, name="user_feedback_helpful", value=0)
+        await buffer.close()
+        return buffer.stats
+
+    stats = asyncio.run(main())
+    assert (stats["queued"], stats["dropped"], stats["failed"]) == (2, 1, 2)
+    assert langfuse.batches == []
+
+
+def test_disabled_and_sampled_out_traces_are_skipped():
+    langfuse = FakeLangfuse()
+
+    async def main():
+        disabled = TraceBuffer(langfuse, enabled=False)
+        with tracer.start_as_current_span("chat"):
+            disabled.update_trace(input="hi")
+        disabled.score("t1", name="user_feedback_helpful", value=1)
+
+        buffer = TraceBuffer(langfuse)
+        # No span is current, as when the trace was sampled out
+        buffer.update_trace(input="hi")
+        return disabled.pending, buffer.pending, buffer.stats["sampled_out"]
+
+    assert asyncio.run(main()) == (0, 0, 1)
+
+
+def test_routes_are_sampled_at_their_rate():
+    rates = parse_sample_rates("chat=0, batch=1")
+    assert rates == {"chat": 0.0, "batch": 1.0}
+    sampled = sampled_tracer_provider(rates).get_tracer(__name__)
+
+    def recorded(route):
+        with trace_route(route), sampled.start_as_current_span(route) as span:
+            return span.is_recording()
+
+    assert not recorded("chat")
+    assert recorded("batch")